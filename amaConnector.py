@@ -1,16 +1,47 @@
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+from psycopg2 import sql
+import threading
+import time
+import uuid
+import weakref
+from contextlib import contextmanager
 
 import pandas.io.sql as sqlio
 from shapely import wkt, wkb
 import geopandas
 import pandas
 import warnings
+
+# local imports
+import queryCache as qC
+
 warnings.filterwarnings('ignore') # setting ignore as a parameter
 
 class amaAccess:
+    """ access to the Ama database through a pool of reusable connections
+
+        connections are opened lazily on first use and shared by all queries of this instance, at most
+        minConnections idle connections are kept warm; use the instance as a context manager (or call close())
+        to release them at the end of a run
+    """
     access = []
 
-    def __init__(self, inputfile, sep=':'):
+    def __init__(self, inputfile, sep=':', minConnections=1, maxConnections=4, healthCheckInterval=60.):
+        self.pool = None
+        self.minConnections = minConnections
+        self.maxConnections = maxConnections
+        # connections idle for longer than this [s] are pinged before they are handed out again
+        self.healthCheckInterval = healthCheckInterval
+        self._lastUsed = weakref.WeakKeyDictionary()
+        self._statsLock = threading.Lock()
+        self.connectionStats = {'opened': 0, 'reused': 0, 'discarded': 0}
+        # on-disk query cache, disabled until enableCache is called
+        self.cacheDir = None
+        self.cacheTTL = None
+        self.cacheProbeQuery = ''
         try:
             self.access = pandas.read_csv(inputfile,sep=sep)
         except:
@@ -26,21 +57,92 @@ class amaAccess:
             print(sep.join(['host','db','port','user','password']))
             print(sep.join(['example.ama.host','example_ama_db','12345','your_username','super secret!!!']))
             print("==================")
-    def insertQuery(self, schema, table, df):
-        columns = ','.join('"'+df.columns+'"')
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
+
+    def connectionString(self):
         server_ip = self.access['host'][0]
         db_name = self.access['db'][0]
         username = self.access['user'][0]
         pwd = self.access['password'][0]
         port = self.access['port'][0]
-        # ...and connect please
-        connstr = "host='{}' port={} dbname='{}' user={} password='{}'".format(server_ip, port, db_name, username,
-                                                                               pwd)
-        conn = psycopg2.connect(connstr
-                                )
+        return "host='{}' port={} dbname='{}' user={} password='{}'".format(server_ip, port, db_name, username, pwd)
+
+    def _getPool(self):
+        if self.pool is None or self.pool.closed:
+            self.pool = psycopg2.pool.ThreadedConnectionPool(self.minConnections, self.maxConnections,
+                                                             self.connectionString())
+        return self.pool
+
+    def _isHealthy(self, conn):
+        if conn.closed or conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if time.monotonic() - self._lastUsed.get(conn, 0.) < self.healthCheckInterval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+        return True
+
+    @contextmanager
+    def connection(self):
+        """ borrow a connection from the pool and give it back afterwards
+
+            connections that fail the health check or raise a connection error during use are closed
+            instead of being returned to the pool
+        """
+        pool = self._getPool()
+        conn = pool.getconn()
+        while conn in self._lastUsed and not self._isHealthy(conn):
+            self._countConnection('discarded')
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
+        self._countConnection('reused' if conn in self._lastUsed else 'opened')
+
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            if broken or conn.closed:
+                self._countConnection('discarded')
+            with self._statsLock:
+                self._lastUsed[conn] = time.monotonic()
+            pool.putconn(conn, close=broken)
+
+    def _countConnection(self, key):
+        with self._statsLock:
+            self.connectionStats[key] += 1
+
+    def close(self):
+        """ close all pooled connections and report how many connections were opened and reused """
+        if self.pool is not None and not self.pool.closed:
+            self.pool.closeall()
+            print('Closed connection pool: %d connections opened, %d reused, %d discarded' %
+                  (self.connectionStats['opened'], self.connectionStats['reused'],
+                   self.connectionStats['discarded']))
+
+    def insertQuery(self, schema, table, df, bulk=False, batchSize=1000):
+        """ insert all rows of df into schema.table, rows that conflict with existing entries are skipped
+
+            with bulk=True the rows are sent as parameterised multi-row VALUES batches of batchSize rows into a
+            temporary staging table and merged in one statement, see bulkInsert
+        """
+        if bulk:
+            return self.bulkInsert(schema, table, df, batchSize=batchSize)
+
+        columns = ','.join('"'+df.columns+'"')
 
-        cursor = conn.cursor()
         insert_req = []
         for index, data in df.iterrows():
             values=[]
@@ -55,37 +157,111 @@ class amaAccess:
             strval = ','.join(values)
             insert_req.append("INSERT into %s.%s(%s) values(%s) ON CONFLICT DO NOTHING" % (schema, table, columns, strval))
 
-        try:
-            for el in insert_req:
-                print(el)
-                cursor.execute(el)
-            conn.commit()
-        except (Exception, psycopg2.DatabaseError) as error:
-            print("Error: %s" % error)
-            conn.rollback()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                for el in insert_req:
+                    print(el)
+                    cursor.execute(el)
+                conn.commit()
+            except (Exception, psycopg2.DatabaseError) as error:
+                print("Error: %s" % error)
+                conn.rollback()
+                cursor.close()
+                return 1
             cursor.close()
-            return 1
-        cursor.close()
 
 
-    def query(self,query_list='SELECT * FROM event_full', constraint=''):
+    def bulkInsert(self, schema, table, df, batchSize=1000):
+        """ load df into schema.table via a staging table, keeping the ON CONFLICT DO NOTHING semantics
+
+            values are passed as query parameters (no string formatting), missing values (None/NaN) become NULL
+
+            Parameters
+            -----------
+            schema: str
+                name of the target schema
+            table: str
+                name of the target table
+            df: pandas DataFrame
+                rows to insert, column names must match the columns of the target table
+            batchSize: int
+                number of rows sent per multi-row VALUES statement
+
+            Returns
+            --------
+            counts: dict
+                number of 'inserted' rows and of rows 'skipped' due to conflicts, 1 if the insert failed
+        """
+        target = sql.Identifier(schema, table)
+        staging = sql.Identifier('ama_staging_%s' % table)
+        columns = sql.SQL(',').join(sql.Identifier(str(col)) for col in df.columns)
+        # object dtype so that missing values end up as None (NULL) instead of NaN
+        rows = df.astype(object).where(pandas.notna(df), None).itertuples(index=False, name=None)
+
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(sql.SQL('CREATE TEMP TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP').format(
+                    staging, target))
+                psycopg2.extras.execute_values(cursor,
+                    sql.SQL('INSERT INTO {} ({}) VALUES %s').format(staging, columns).as_string(cursor),
+                    rows, page_size=batchSize)
+                cursor.execute(sql.SQL('INSERT INTO {} ({}) SELECT {} FROM {} ON CONFLICT DO NOTHING').format(
+                    target, columns, columns, staging))
+                inserted = cursor.rowcount
+                conn.commit()
+            except (Exception, psycopg2.DatabaseError) as error:
+                print("Error: %s" % error)
+                conn.rollback()
+                cursor.close()
+                return 1
+            cursor.close()
+
+        counts = {'inserted': inserted, 'skipped': len(df) - inserted}
+        print('Inserted %d rows into %s.%s, skipped %d conflicting rows' % (counts['inserted'], schema, table,
+                                                                           counts['skipped']))
+        return counts
+
+    def enableCache(self, cacheDir, ttl=None, probeQuery=''):
+        """ serve repeated queries from an on-disk cache in cacheDir
+
+            ttl is the maximum age of cached data in seconds (None: no expiry); probeQuery is an optional cheap
+            query (e.g. row count and max(updated_at)) whose result must be unchanged for cached data to be used
+        """
+        self.cacheDir = cacheDir
+        self.cacheTTL = ttl
+        self.cacheProbeQuery = probeQuery
+
+    def invalidateCache(self, query_list=None, constraint=''):
+        """ remove the cached result of a query or, if query_list is None, all cached results """
+        if self.cacheDir is None:
+            return 0
+        if query_list is None:
+            return qC.invalidateCache(self.cacheDir)
+        return qC.invalidateCache(self.cacheDir, '{} {};'.format(query_list.strip(), constraint.strip()))
+
+    def query(self,query_list='SELECT * FROM event_full', constraint='', useCache=True, params=None):
         try:
             if (query_list.lower().find('from') != -1):
-                # Set up our connection
-                #access = getAccess(r'c:\temp\ama_out\access.txt')
-                server_ip = self.access['host'][0]
-                db_name = self.access['db'][0]
-                username = self.access['user'][0]
-                pwd = self.access['password'][0]
-                port = self.access['port'][0]
-                # ...and connect please
-                connstr = "host='{}' port={} dbname='{}' user={} password='{}'".format(server_ip, port, db_name, username, pwd)
-                conn = psycopg2.connect(connstr
-                    )
                 sql = '{} {};'.format(query_list.strip(), constraint.strip())
 
-                dat = sqlio.read_sql_query(sql, conn)
-                conn = None
+                # queries with parameters are not cached
+                useCache = useCache and self.cacheDir is not None and params is None
+                if useCache:
+                    probe = None
+                    if self.cacheProbeQuery:
+                        probe = self.query(self.cacheProbeQuery, useCache=False).to_json(date_format='iso')
+                    dat = qC.readCache(self.cacheDir, sql, ttl=self.cacheTTL, probe=probe)
+                    if dat is not None:
+                        return dat
+
+                # borrow a pooled connection, it is handed back once the data is read
+                with self.connection() as conn:
+                    dat = sqlio.read_sql_query(sql, conn, params=params)
+
+                if useCache:
+                    qC.writeCache(self.cacheDir, sql, dat, probe=probe)
                 return dat
 
             else:
@@ -94,6 +270,36 @@ class amaAccess:
             print('Error: Connection error.')
             raise
 
+    def queryChunks(self, query_list='SELECT * FROM event_full', constraint='', chunkSize=5000):
+        """ stream the result of a query as DataFrame chunks of at most chunkSize rows
+
+            uses a named (server-side) cursor, so only one chunk is held in memory at a time; the pooled
+            connection is kept until the generator is exhausted or closed
+        """
+        if (query_list.lower().find('from') == -1):
+            print('Something wrong with the query. No "select" and/or "from" encountered.')
+            return
+
+        sql = '{} {};'.format(query_list.strip(), constraint.strip())
+        with self.connection() as conn:
+            cursor = conn.cursor(name='ama_stream_%s' % uuid.uuid4().hex)
+            cursor.itersize = chunkSize
+            try:
+                cursor.execute(sql)
+                while True:
+                    rows = cursor.fetchmany(chunkSize)
+                    if not rows:
+                        break
+                    columns = [desc[0] for desc in cursor.description]
+                    yield pandas.DataFrame.from_records(rows, columns=columns)
+            except psycopg2.DatabaseError:
+                print('Error: Connection error.')
+                raise
+            finally:
+                if not conn.closed:
+                    cursor.close()
+                    conn.rollback()
+
 access =[]
 
 def getAccess(inputfile, sep=';'):
@@ -1,13 +1,18 @@
-from shapely import wkb, LineString, Point, length
-from shapely.ops import split
+import functools
+import inspect
+
+import shapely
+from shapely import LineString
 from scipy.optimize import curve_fit
 import numpy as np
 import pandas as pd
-import geopandas
+import pyproj
 import logging
 
 import avaframe.in3Utils.geoTrans as gT
 
+import pathStore as pS
+
 # create local logger
 log = logging.getLogger(__name__)
 
@@ -44,36 +49,60 @@ def fetchGeometryInfo(
         and transformed geometry info in desired crs (projstr), resampled path_ln3d and addAttributes
     """
 
-    # fetch info on desired crs
-    crsVal = projstr.split("epsg:")[1]
-
-    # filter DF for nonEmptyCols
-    for nECol in nonEmptyCols:
-        dbFiltered = dbData[~pd.isnull(dbData[nECol])]
-
-    # filter DF for all geometry columns
-    dbFilteredGeom = dbFiltered.filter(regex=geomStr).copy()
+    # filter DF for nonEmptyCols - events need non null entries for all of them
+    nonEmptyMask = dbData[nonEmptyCols].notna().all(axis=1)
+    dbFiltered = dbData[nonEmptyMask]
+
+    # decode all geometry columns from hex WKB (array functions, no per row parsing)
+    geomCols = list(dbFiltered.filter(regex=geomStr).columns)
+    decodedGeoms = {}
+    for col in geomCols:
+        hexWkb = dbFiltered[col].to_numpy(dtype=object, copy=True)
+        hexWkb[pd.isna(hexWkb)] = None
+        decodedGeoms[col] = shapely.from_wkb(hexWkb)
+
+    # transform the geometries of all columns in a single pass to projstr
+    allGeoms = np.concatenate(
+        [decodedGeoms[col] for col in geomCols] + [np.empty(0, dtype=object)]
+    )
+    transformedGeoms = np.split(
+        transformGeometries(allGeoms, srcprojstr, projstr), len(geomCols) or 1
+    )
 
-    # loop over all geom cols and transform geometry to projstr
-    for col in dbFilteredGeom.columns:
-        convertedGeo = dbFilteredGeom[col].apply(wkb.loads, hex=True)
-        dbFilteredGeom.loc[:, col] = convertedGeo
-        gdf = geopandas.GeoDataFrame(dbFilteredGeom, geometry=col, crs=srcprojstr)
-        gdfConvert = gdf.to_crs(epsg=crsVal)
-        dbFilteredGeom.insert(0, (col + "_" + projstr), gdfConvert[col])
+    # assemble output frame once: transformed columns (in reversed order) followed by source columns
+    geomData = {}
+    for col, geoms in reversed(list(zip(geomCols, transformedGeoms))):
+        geomData[col + "_" + projstr] = geoms
+    geomData.update(decodedGeoms)
+    dbFilteredGeom = pd.DataFrame(geomData, index=dbFiltered.index)
 
     # resample path line to get higher resolution
-    lineResampled = []
-    dbFilteredGeom["pathLength"] = np.empty(len(dbFilteredGeom))
-    for index, row in dbFilteredGeom.iterrows():
-        line = row["geom_path_ln3d_" + projstr]
-        distInt = int(np.ceil(line.length / resampleDist))
-        distances = np.linspace(0, line.length, distInt)
-        lineR = LineString([line.interpolate(dist) for dist in distances])
-        lineResampled.append(lineR)
-        dbFilteredGeom.loc[index, "pathLength"] = length(line)
-
-    # append resampled path line as column
+    pathLines = dbFilteredGeom["geom_path_ln3d_" + projstr].to_numpy()
+    resampledCoords = [
+        np.column_stack(
+            resampleLine(shapely.get_coordinates(line, include_z=True), resampleDist)[
+                :3
+            ]
+        )
+        for line in pathLines
+    ]
+    dbFilteredGeom["pathLength"] = shapely.length(pathLines)
+
+    # append resampled path line as column - all lines are created in one call
+    # paths resampled to less than two points (e.g. zero length) get an empty line
+    nPoints = np.array([len(coords) for coords in resampledCoords], dtype=np.int64)
+    valid = nPoints > 1
+    lineResampled = np.full(len(resampledCoords), LineString(), dtype=object)
+    if valid.any():
+        lineResampled[valid] = shapely.linestrings(
+            np.concatenate([resampledCoords[i] for i in np.flatnonzero(valid)]),
+            indices=np.repeat(np.arange(np.count_nonzero(valid)), nPoints[valid]),
+        )
+    if not valid.all():
+        log.warning(
+            "Path lines resampled to less than 2 points for events: %s"
+            % list(dbFiltered.index[~valid])
+        )
     dbFilteredGeom.insert(0, "geom_path_ln3d_%s_resampled" % projstr, lineResampled)
 
     # add desired attributes form dbData
@@ -83,9 +112,110 @@ def fetchGeometryInfo(
     return dbFilteredGeom
 
 
-def addXYDistAngle(dbData, line, point1, point2, projstr, name="event"):
+def resampleLine(coords, resampleDist):
+    """resample a line at equally spaced points with a spacing of about resampleDist along the line (xy plane)
+
+    the number of points is ceil(line length / resampleDist) including start and end point, z is interpolated
+    linearly along the xy distance - same points as calling shapely interpolate for each distance
+
+    Parameters
+    -----------
+    coords: numpy array
+        (n, 3) array of x, y, z coordinates of the line vertices
+    resampleDist: float
+        approximate resampling distance along line
+
+    Returns
+    --------
+    x, y, z, s: numpy arrays
+        coordinates of the resampled points and their distance along the line (xy plane)
+    """
+
+    segmentLength = np.hypot(np.diff(coords[:, 0]), np.diff(coords[:, 1]))
+    sVertices = np.concatenate([[0.0], np.cumsum(segmentLength)])
+    nPoints = int(np.ceil(sVertices[-1] / resampleDist))
+    s = np.linspace(0.0, sVertices[-1], nPoints)
+
+    x = np.interp(s, sVertices, coords[:, 0])
+    y = np.interp(s, sVertices, coords[:, 1])
+    z = np.interp(s, sVertices, coords[:, 2])
+
+    return x, y, z, s
+
+
+@functools.lru_cache(maxsize=None)
+def getTransformer(srcprojstr, projstr):
+    """return a (cached) pyproj transformer from srcprojstr to projstr, coordinates in x, y (lon, lat) order"""
+    return pyproj.Transformer.from_crs(srcprojstr, projstr, always_xy=True)
+
+
+def transformGeometries(geoms, srcprojstr, projstr):
+    """transform an array of shapely geometries from srcprojstr to projstr
+
+    all coordinates are transformed with one call of the transformer per dimensionality (2D and 3D geometries),
+    z coordinates are passed on to the transformer; missing geometries (None) are kept
+
+    Parameters
+    -----------
+    geoms: numpy array
+        array of shapely geometries
+    srcprojstr: str
+        name of source projection
+    projstr: str
+        name of desired projection
+
+    Returns
+    --------
+    geomsTransformed: numpy array
+        array of transformed shapely geometries
+    """
+
+    transformer = getTransformer(srcprojstr, projstr)
+    geomsTransformed = np.array(geoms, dtype=object)
+    hasZ = shapely.has_z(geomsTransformed)
+    for includeZ in [True, False]:
+        mask = (hasZ == includeZ) & ~shapely.is_missing(geomsTransformed)
+        if mask.any():
+            geomsTransformed[mask] = shapely.transform(
+                geomsTransformed[mask],
+                lambda coords: np.column_stack(transformer.transform(*coords.T)),
+                include_z=includeZ,
+            )
+
+    return geomsTransformed
+
+
+def geometryColumn(dbData, column):
+    """return column of dbData as numpy array of shapely geometries, missing entries (nan) as None"""
+
+    values = dbData[column].to_numpy(dtype=object)
+    return np.where(shapely.is_geometry(values), values, None)
+
+
+def subLine(line, point1, point2, start, end, tol=1.0e-6):
+    """return the part of line between point1 and point2 located at start and end along line
+
+    point1 and point2 are used as first and last vertex, so points snapped to vertices of line are not
+    duplicated by interpolation; vertices closer than tol to start or end are dropped
+    """
+
+    coords = shapely.get_coordinates(line, include_z=True)
+    distance = np.concatenate(
+        ([0.0], np.cumsum(np.hypot(np.diff(coords[:, 0]), np.diff(coords[:, 1]))))
+    )
+    inner = coords[(distance > start + tol) & (distance < end - tol)]
+    endCoords = shapely.get_coordinates([point1, point2], include_z=True)
+
+    return LineString(np.vstack((endCoords[:1], inner, endCoords[1:])))
+
+
+def addXYDistAngle(dbData, line, point1, point2, projstr, name="event", addLines=False):
     """compute the distance along line between point1 and point 2 and angle of this part of the line
 
+    point1 and point2 are located along line once (linear referencing in the xy plane), distance, start,
+    altitude drop and angle are computed for all events at once. Values are nan if a point is missing, not
+    on the line or if point2 is not located after point1
+
     Parameters
     -----------
     dbData: pandas dataframe
@@ -100,6 +230,9 @@ def addXYDistAngle(dbData, line, point1, point2, projstr, name="event"):
         name of projection
     name: str
         name of line and angle
+    addLines: bool
+        if True also add the line between point1 and point2 (name_Line) and the along line distances of the
+        path and of this line (name_PathDist, name_LineDist), e.g. required for plotting the profiles
 
     Returns
     --------
@@ -107,86 +240,50 @@ def addXYDistAngle(dbData, line, point1, point2, projstr, name="event"):
         dataframe with geometry info of events updated with xyDistance
     """
 
-    dbData["%s_Distance" % name] = np.empty(len(dbData))
-    dbData["%s_LineStart" % name] = np.empty(len(dbData))
-    dbData["%s_LineAltDrop" % name] = np.empty(len(dbData))
-    dbData["%s_xyLine" % name] = np.empty(len(dbData))
-    dbData["%s_xyAngle" % name] = np.empty(len(dbData))
-    dbData["%s_xyPathDist" % name] = np.empty(len(dbData))
-
-    distancePath = []
-    distanceEvent = []
-    for index, row in dbData.iterrows():
-        # first split the line using point1 and use second line segment (from point1 onwards)
-        line1 = split(row[line], row[point1])
-
-        # Check if point 1 or 2 is nan
-        if pd.notna(row[point1]) and pd.notna(row[point2]):
-
-            # check if point1 is located right at the start of the line - so when splitting line no effect
-            if len(line1.geoms) == 1 or line1.geoms[0].boundary.geoms[0] == row[point1]:
-                line1 = line1.geoms[0]
-
-            else:
-                # if point1 is located further down the line take the part of the line from the point1 onwards
-                line1 = line1.geoms[1]
-            # the split this line segment using point2 and use first line segment
-            # resulting line2 is the line segment between point1 and point2
-
-            # check if linestart und point 2 identical and if the point2 is on the track and not before
-            # add nan to all columns if this is the case
-            # print([line1.coords[0][1]], [row[point2].coords[0][1]])
-
-            if line1.coords[0][0] == row[point2].coords[0][0] or not row[
-                point2
-            ].intersects(line1):
-
-                dbData.loc[index, "%s_Distance" % name] = np.nan
-                dbData.loc[index, "%s_Line" % name] = np.nan
-                dbData.loc[index, "%s_LineStart" % name] = np.nan
-                dbData.loc[index, "%s_Angle" % name] = np.nan
-                dbData.loc[index, "%s_LineAltDrop" % name] = np.nan
-                distancePath.append(np.nan)
-                distanceEvent.append(np.nan)
-
-            # calculate the values for the columns if a line exists
-            else:
-
-                line2 = split(line1, row[point2]).geoms[0]
-                dbData.loc[index, "%s_Distance" % name] = length(
-                    line2
-                )  # line2.coords[-1][0]
-                dbData.loc[index, "%s_Line" % name] = line2
-                dbData.loc[index, "%s_LineStart" % name] = length(
-                    split(row[line], row[point1]).geoms[0]
-                )
-                elevationDrop = row[point1].z - row[point2].z
-                dbData.loc[index, "%s_Angle" % name] = np.rad2deg(
-                    np.arctan(elevationDrop / length(line2))
-                )
-                dbData.loc[index, "%s_LineAltDrop" % name] = elevationDrop
-                # compute path segment lengths and cumulative length
-                distP = gT.computeAlongLineDistance(
-                    row["geom_path_ln3d_%s" % projstr], dim="2D"
-                )
-                # compute xyLineh segment lengths and cumulative length
-                distP2 = gT.computeAlongLineDistance(line2, dim="2D")
-                # append to list for each event (row) in DF
-                distancePath.append(distP)
-                distanceEvent.append(distP2)
-
-        else:
-            dbData.loc[index, "%s_Distance" % name] = np.nan
-            dbData.loc[index, "%s_Line" % name] = np.nan
-            dbData.loc[index, "%s_LineStart" % name] = np.nan
-            dbData.loc[index, "%s_Angle" % name] = np.nan
-            dbData.loc[index, "%s_LineAltDrop" % name] = np.nan
-            distancePath.append(np.nan)
-            distanceEvent.append(np.nan)
-
-    # append to DF
-    dbData["%s_PathDist" % name] = distancePath
-    dbData["%s_LineDist" % name] = distanceEvent
+    lines = geometryColumn(dbData, line)
+    points1 = geometryColumn(dbData, point1)
+    points2 = geometryColumn(dbData, point2)
+
+    # distance of the points along the line, nan if point missing
+    start = shapely.line_locate_point(lines, points1)
+    end = shapely.line_locate_point(lines, points2)
+    valid = (
+        shapely.intersects(lines, points1)
+        & shapely.intersects(lines, points2)
+        & (end > start)
+    )
+
+    distance = np.where(valid, end - start, np.nan)
+    elevationDrop = np.where(
+        valid, shapely.get_z(points1) - shapely.get_z(points2), np.nan
+    )
+    dbData["%s_Distance" % name] = distance
+    dbData["%s_LineStart" % name] = np.where(valid, start, np.nan)
+    dbData["%s_Angle" % name] = np.rad2deg(np.arctan(elevationDrop / distance))
+    dbData["%s_LineAltDrop" % name] = elevationDrop
+    dbData["%s_xyLine" % name] = np.nan
+    dbData["%s_xyAngle" % name] = np.nan
+    dbData["%s_xyPathDist" % name] = np.nan
+
+    if addLines:
+        subLines = np.full(len(dbData), np.nan, dtype=object)
+        distancePath = [np.nan] * len(dbData)
+        distanceEvent = [np.nan] * len(dbData)
+        pathLines = dbData["geom_path_ln3d_%s" % projstr].to_numpy(dtype=object)
+        for index in np.flatnonzero(valid):
+            subLines[index] = subLine(
+                lines[index], points1[index], points2[index], start[index], end[index]
+            )
+            # path and line segment lengths and cumulative length
+            distancePath[index] = gT.computeAlongLineDistance(
+                pathLines[index], dim="2D"
+            )
+            distanceEvent[index] = gT.computeAlongLineDistance(
+                subLines[index], dim="2D"
+            )
+        dbData["%s_Line" % name] = subLines
+        dbData["%s_PathDist" % name] = distancePath
+        dbData["%s_LineDist" % name] = distanceEvent
 
     return dbData
 
@@ -213,9 +310,79 @@ def findAngleInProfile(pointAngle, avaPath, profile, dsMin):
     return pointFound
 
 
-def addGradientForPoint(db, pathName, pointList):
-    """calculates slope angle for all points in pointList; if available the angle is computed over a distance
-     stretching from 3 points before to 3 points after the point of interest; hence strongly dependent on the resampling distance of the path line
+def windowSlopeAngles(store, profileIds, indices, halfWindow, forward):
+    """compute the slope angle of a window around points of the profiles of store, for all points at once
+
+    the window spans halfWindow (distance along the profile) before to halfWindow after the point, or, if
+    forward is True, the point to halfWindow after the point; windows are cut at the start and end of
+    the profile
+
+    Parameters
+    -----------
+    store: PathStore
+        profiles with x, y, z
+    profileIds: numpy array
+        position of the profile of each point in store
+    indices: numpy array
+        index of each point on its profile, -1 for missing points
+    halfWindow: float
+        half length of window, in coordinate system units (m)
+    forward: numpy array
+        True for points with a window starting at the point (e.g. origin)
+
+    Returns
+    --------
+    slopeAngles: numpy array
+        absolute slope angle [°] between the window start and end of each point, nan for missing points
+    """
+
+    lengths = store.lengths()
+    abscissa = store.abscissa()
+    # shift the profiles so that the distance along all profiles is increasing and windows
+    # can be located for all points with one search
+    gap = 2.0 * halfWindow + 1.0
+    profileLength = np.zeros(len(lengths))
+    nonEmpty = lengths > 0
+    profileLength[nonEmpty] = abscissa[store.offsets[1:][nonEmpty] - 1]
+    shift = np.concatenate([[0.0], np.cumsum(profileLength + gap)])[:-1]
+    distance = abscissa + np.repeat(shift, lengths)
+
+    found = indices >= 0
+    slopeAngles = np.full(len(indices), np.nan)
+    first = store.offsets[profileIds[found]]
+    last = store.offsets[profileIds[found] + 1] - 1
+    positions = first + indices[found]
+
+    # window ends: last point at least halfWindow before, first point at least halfWindow after
+    tolerance = 1.0e-6 * max(halfWindow, 1.0)
+    start = (
+        np.searchsorted(
+            distance, distance[positions] - halfWindow + tolerance, side="right"
+        )
+        - 1
+    )
+    start = np.where(forward[found], positions, np.clip(start, first, last))
+    end = np.searchsorted(
+        distance, distance[positions] + halfWindow - tolerance, side="left"
+    )
+    end = np.clip(end, first, last)
+
+    x, y, z = store.fields["x"], store.fields["y"], store.fields["z"]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        slope = np.rad2deg(
+            np.arctan(
+                (z[start] - z[end]) / np.hypot(x[start] - x[end], y[start] - y[end])
+            )
+        )
+    slopeAngles[found] = np.abs(slope)
+
+    return slopeAngles
+
+
+def addGradientForPoint(db, pathName, pointList, pointIndex=None, halfWindow=3.0):
+    """calculates slope angle for all points in pointList; the angle is computed over a window stretching from
+    halfWindow before to halfWindow after the point of interest along the thalweg (origin points: from the point
+    to halfWindow after the point), cut at the start and end of the thalweg
 
      Parameters
      -----------
@@ -225,156 +392,264 @@ def addGradientForPoint(db, pathName, pointList):
         str with column name of the thalweg
     pointList:
         List of str with column names of points to be analysed
+    pointIndex:
+        optional - index of the points on the thalwegs (pS.locatePoints), located here if None
+    halfWindow:
+        half length of the window along the thalweg [m]
 
      Returns
      --------
-     db: dataframe with added slope angles
+     db: dataframe with added slope angles, 0 for missing points
     """
 
-    # for loop over point list, to calculate slope angles of all relevant points
-    for attr in pointList:
-        db[attr + "_gradient"] = 0
-        # for loop to calculate slope angle for all thalwegs
-        for index, row in db.iterrows():
-            path = row[pathName]
-            targetPoint = row[attr]
-            if type(targetPoint) == type(Point()):
-                # identification of the ID of the point of interest
-                targetPointDict = {"x": [targetPoint.x], "y": [targetPoint.y]}
-                targetPointID = gT.findClosestPoint(
-                    path.xy[0], path.xy[1], targetPointDict
-                )
-
-                # determine if point is the first point of line (origin)
-                if path.coords[targetPointID] == path.coords[0]:
-                    pointBefore = Point(path.coords[targetPointID])
-                    pointBehind = Point(path.coords[targetPointID + 1])
-
-                    # determine if point is the last one (runout)
-                if path.coords[targetPointID] == path.coords[-1]:
-                    pointBefore = Point(path.coords[targetPointID])
-                    pointBehind = Point(path.coords[targetPointID - 1])
-
-                if "orig" in attr:
-                    pointBefore = Point(path.coords[targetPointID])
-                    pointBehind = Point(path.coords[targetPointID + 2])
-
-                # 'normal' slope angle calculation with 3 points ahead and 3 points after
-                else:
-                    try:
-                        pointBefore = Point(path.coords[targetPointID - 3])
-                        pointBehind = Point(path.coords[targetPointID + 3])
-                    except:
-                        try:
-                            pointBefore = Point(path.coords[targetPointID - 2])
-                            pointBehind = Point(path.coords[targetPointID + 2])
-                        except:
-                            pointBefore = Point(path.coords[targetPointID - 2])
-                            pointBehind = Point(path.coords[targetPointID])
-
-                # using determined points for input in gradient calcualtion
-                slope = calculateSlope(pointBefore, pointBehind)
-
-                db.loc[index, "%s_gradient" % attr] = abs(slope)
+    if len(pointList) == 0:
+        return db
+    thalwegs = pS.PathStore.fromLines(db.index, db[pathName].to_numpy())
+    if pointIndex is None:
+        pointIndex = pS.locatePoints(thalwegs, db, pointList)
 
-    return db
+    # slope angles of all points of all thalwegs at once
+    indices = np.concatenate(
+        [pointIndex.loc[db.index, "%s_idx" % attr].to_numpy() for attr in pointList]
+    )
+    profileIds = np.tile(np.arange(len(db)), len(pointList))
+    forward = np.repeat(["orig" in attr for attr in pointList], len(db))
+    slopeAngles = windowSlopeAngles(thalwegs, profileIds, indices, halfWindow, forward)
 
+    for attr, angles in zip(pointList, np.split(slopeAngles, len(pointList))):
+        db[attr + "_gradient"] = np.where(
+            pointIndex.loc[db.index, "%s_idx" % attr].to_numpy() >= 0, angles, 0
+        )
 
-def calculateSlope(point1, point2):
-    deltaEle = point1.z - point2.z
-    dist = Point(point1).distance(Point(point2))
-    slope = np.rad2deg(np.arctan(deltaEle / dist))
-    return slope
+    return db
 
 
-def calculatetravelLine(m, avaPath, origin):
-    """calculates line based on travel angle
+def findDmaxCutOff(s, z, origin, betaAngles, minIndex=10):
+    """find the end of the profile for the Dmax fit: the furthest intersection of the profile with a
+    travel line from the origin, for the first beta angle whose intersection is more than minIndex points
+    beyond the origin
 
-     Parameters
-     -----------
-    m:
-         gradient of line
-    avaPath:
-        dict with s,z coordinated of thalweg to determine length and points along the line
-    origin:
-        point of starting point as id
+    the intersections with the travel lines of all beta angles are found at once as sign changes
+    (or zeros) of the profile elevation relative to the travel line
 
+    Parameters
+    -----------
+    s, z: numpy array
+        coordinate along profile and elevation of profile
+    origin: int
+        index of origin in s, z
+    betaAngles: list
+        travel angles [°] in order of use, e.g. [-22, -28, -32, -36, -38]
+    minIndex: int
+        minimum number of points between origin and intersection
 
-     Returns
-     --------
-     travelLine: Linestring with the coordinates of the travel line
+    Returns
+    --------
+    endPointID: int
+        number of points from the origin to the intersection (index relative to origin), len(s) if no travel
+        line intersects the profile far enough from the origin
     """
 
-    intercept = avaPath["z"][origin] - m * avaPath["s"][origin]
-    zValues = m * avaPath["s"] + intercept
+    sO = s[origin:]
+    zO = z[origin:]
+    gradients = np.tan(np.radians(np.asarray(betaAngles, dtype=np.float64)))[
+        :, np.newaxis
+    ]
+    # elevation of profile above travel lines, one row per beta angle
+    dz = zO - (zO[0] + gradients * (sO - sO[0]))
+
+    # intersections at points (excluding the origin) and between points
+    atPoint = dz == 0
+    atPoint[:, 0] = False
+    between = dz[:, :-1] * dz[:, 1:] < 0
+    nPoints = len(sO)
+    lastAtPoint = np.where(
+        atPoint.any(axis=1), nPoints - 1 - np.argmax(atPoint[:, ::-1], axis=1), -1
+    )
+    lastBetween = np.where(
+        between.any(axis=1), nPoints - 2 - np.argmax(between[:, ::-1], axis=1), -1
+    )
 
-    travelLine = LineString(list(zip(avaPath["s"][origin:], zValues[origin:])))
+    # closest point of the profile to the furthest intersection
+    k = np.maximum(lastBetween, 0)
+    if nPoints > 1:
+        rows = np.arange(len(dz))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sCross = sO[k] + (sO[k + 1] - sO[k]) * dz[rows, k] / (
+                dz[rows, k] - dz[rows, k + 1]
+            )
+        closest = np.where(sCross - sO[k] <= sO[k + 1] - sCross, k, k + 1)
+    else:
+        closest = k
+    cutOff = np.where(lastBetween >= lastAtPoint, closest, lastAtPoint)
+    cutOff = np.where((lastBetween < 0) & (lastAtPoint < 0), -1, cutOff)
+
+    found = np.flatnonzero(cutOff > minIndex)
+    if len(found) == 0:
+        return len(s)
+    return int(cutOff[found[0]])
 
-    return travelLine
 
+def funcParabola(s, a, b, c):
+    # a * (s**2) + b * s + c
+    # a * np.exp(-b *s**2)  + c
+    # a * np.exp(-b * s) + c
 
-def createCutOff(line, intersection):
-    """creates cut off between the thalweg line and the maximum travel angle, intersection between two lines
+    return a * (s**2) + b * s + c
 
-     Parameters
-     -----------
-    line:
-         travel angle line, Linestring (result from calculatetravelLine)
-    intersection:
-        thalweg to be intersected, Linestring
 
-     Returns
-     --------
-     endPointID: as ID for the point of intersection
-    """
-    maxX = None
-    furthestIntersec = None
-    for point in intersection.geoms:
-        xCoord = point.x
+def profileSums(values, offsets):
+    """return the sum of values over each profile defined by offsets, 0 for empty profiles"""
 
-        if maxX is None or xCoord > maxX:
-            maxX = xCoord
-            furthestIntersec = point
+    lengths = np.diff(offsets)
+    sums = np.zeros(len(lengths))
+    nonEmpty = lengths > 0
+    if nonEmpty.any():
+        sums[nonEmpty] = np.add.reduceat(values, offsets[:-1][nonEmpty])
+    return sums
 
-    x_values = [point[0] for point in line.coords]
-    endPointID = (np.abs(x_values - furthestIntersec.x)).argmin()
-    # Origin hinterm Grad, gerade schneidet zweimal aber irrelevant
-    return endPointID
 
+def fitStatistics(z, zFit, offsets):
+    """return coefficient of determination (as sklearn r2_score) and root mean square error of
+    the fits zFit to z of each profile defined by offsets, nan for profiles with less than 2 points
+    """
 
-def funcParabola(s, a, b, c):
-    # a * (s**2) + b * s + c
-    # a * np.exp(-b *s**2)  + c
-    # a * np.exp(-b * s) + c
+    lengths = np.diff(offsets)
+    profileIds = np.repeat(np.arange(len(lengths)), lengths)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        zMean = profileSums(z, offsets) / lengths
+        ssRes = profileSums((z - zFit) ** 2, offsets)
+        ssTot = profileSums((z - zMean[profileIds]) ** 2, offsets)
+        r2 = np.where(ssTot > 0, 1.0 - ssRes / ssTot, np.where(ssRes == 0, 1.0, 0.0))
+        rmse = np.sqrt(ssRes / lengths)
+    r2[lengths < 2] = np.nan
+    rmse[lengths < 1] = np.nan
 
-    return a * (s**2) + b * s + c
+    return r2, rmse
+
+
+def fitParabolas(s, z, offsets, uncertainty=None):
+    """fit funcParabola to all profiles at once by weighted linear least squares
 
+    minimises sum(((a * s**2 + b * s + c - z) / uncertainty)**2) of each profile as curve_fit with
+    sigma=uncertainty does; the normal equations of all profiles are solved as one stack, with s shifted
+    and scaled to [-1, 1] per profile to keep them well conditioned
 
-def fitCurveParabola(avaProfileFit, avaProfileLong, uncertainty=None):
-    """use scipy optimize and a parabola function to create a fit to a profile
-    options to define uncertainty of data
     Parameters
     -----------
-    avaProfile: dict
-        dictionary with s, coordinate along profile, z elevation of profile
+    s, z: numpy array
+        coordinate along profile and elevation of all profiles, profile after profile
+    offsets: numpy array
+        start of each profile in s and z plus the total length
     uncertainty: numpy array
-        array of uncertainty values of data - same length as s, z arrays, default is 1
+        uncertainty of each point, same length as s, default is 1
+
     Returns
     --------
-    avaProfile: dict
-        updated dict with zFit - array of elevation of fit
+    fitResult: dict
+        arrays with one entry per profile: popt (a, b, c), curvature (2a), b, c, r2 and rmse;
+        nan for profiles with less than 3 points
     """
 
-    popt, pcov = curve_fit(
-        funcParabola,
-        avaProfileFit["s"],
-        avaProfileFit["z"],
-        sigma=uncertainty,
-        maxfev=10000,
+    s = np.asarray(s, dtype=np.float64)
+    z = np.asarray(z, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.diff(offsets)
+    nProfiles = len(lengths)
+    profileIds = np.repeat(np.arange(nProfiles), lengths)
+    if uncertainty is None:
+        weights = np.ones(len(s))
+    else:
+        weights = 1.0 / np.asarray(uncertainty, dtype=np.float64) ** 2
+
+    # shift and scale s to t in [-1, 1]
+    sMin = np.zeros(nProfiles)
+    sMax = np.zeros(nProfiles)
+    nonEmpty = lengths > 0
+    if nonEmpty.any():
+        sMin[nonEmpty] = np.minimum.reduceat(s, offsets[:-1][nonEmpty])
+        sMax[nonEmpty] = np.maximum.reduceat(s, offsets[:-1][nonEmpty])
+    shift = (sMax + sMin) / 2.0
+    scale = np.where(sMax > sMin, (sMax - sMin) / 2.0, 1.0)
+    t = (s - shift[profileIds]) / scale[profileIds]
+
+    # normal equations of the weighted least squares problem in t
+    tSums = [profileSums(weights * t**k, offsets) for k in range(5)]
+    zSums = [profileSums(weights * z * t**k, offsets) for k in range(3)]
+    normalMatrix = np.stack(
+        [
+            np.stack([tSums[4], tSums[3], tSums[2]], axis=-1),
+            np.stack([tSums[3], tSums[2], tSums[1]], axis=-1),
+            np.stack([tSums[2], tSums[1], tSums[0]], axis=-1),
+        ],
+        axis=-2,
     )
-    curvature = 2 * popt[0]
-
-    avaProfileLong["zFit"] = funcParabola(avaProfileLong["s"], *popt)
-    avaProfileFit["zFit"] = funcParabola(avaProfileFit["s"], *popt)
+    rhs = np.stack([zSums[2], zSums[1], zSums[0]], axis=-1)
+
+    coeffsT = np.full((nProfiles, 3), np.nan)
+    valid = lengths >= 3
+    if valid.any():
+        try:
+            coeffsT[valid] = np.linalg.solve(
+                normalMatrix[valid], rhs[valid][..., None]
+            )[..., 0]
+        except np.linalg.LinAlgError:
+            # profiles with less than 3 distinct points, least squares solution via pseudo inverse
+            coeffsT[valid] = (
+                np.linalg.pinv(normalMatrix[valid]) @ rhs[valid][..., None]
+            )[..., 0]
+    if not valid.all():
+        log.warning(
+            "Cannot fit parabola to %d profiles with less than 3 points"
+            % np.count_nonzero(~valid)
+        )
+
+    # back to coefficients in s
+    aT, bT, cT = coeffsT.T
+    a = aT / scale**2
+    b = bT / scale - 2.0 * aT * shift / scale**2
+    c = aT * shift**2 / scale**2 - bT * shift / scale + cT
+    popt = np.column_stack([a, b, c])
+
+    zFit = funcParabola(s, a[profileIds], b[profileIds], c[profileIds])
+    r2, rmse = fitStatistics(z, zFit, offsets)
+
+    return {"popt": popt, "curvature": 2 * a, "b": b, "c": c, "r2": r2, "rmse": rmse}
+
+
+def fitCurves(func, s, z, offsets, uncertainty=None):
+    """fit func (e.g. a non polynomial profile model) to each profile using scipy curve_fit
+
+    same parameters and results as fitParabolas, curvature, b and c are 2 * popt[0], popt[1], popt[2];
+    nan for profiles with less points than func has parameters
+    """
 
-    return avaProfileLong, avaProfileFit, curvature, popt[1], popt[2]
+    lengths = np.diff(offsets)
+    # number of fit parameters of func - all arguments but s (as curve_fit determines it)
+    nParams = len(inspect.signature(func).parameters) - 1
+    popt = np.full((len(lengths), nParams), np.nan)
+    for position, (start, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+        if end - start < nParams:
+            continue
+        sigma = None if uncertainty is None else uncertainty[start:end]
+        popt[position], pcov = curve_fit(
+            func, s[start:end], z[start:end], sigma=sigma, maxfev=10000
+        )
+    if (lengths < nParams).any():
+        log.warning(
+            "Cannot fit curve to %d profiles with less than %d points"
+            % (np.count_nonzero(lengths < nParams), nParams)
+        )
+
+    profileIds = np.repeat(np.arange(len(lengths)), lengths)
+    zFit = func(s, *popt[profileIds].T)
+    r2, rmse = fitStatistics(z, zFit, offsets)
+
+    return {
+        "popt": popt,
+        "curvature": 2 * popt[:, 0],
+        "b": popt[:, 1],
+        "c": popt[:, 2],
+        "r2": r2,
+        "rmse": rmse,
+    }
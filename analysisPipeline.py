@@ -0,0 +1,453 @@
+"""
+    Per-event analysis chain (snapping, distances and angles, slope angles, intensity, fit), run in chunks of
+    events in a process pool, and the stages of the analysis from fetching the events to the fit
+"""
+
+import configparser
+import logging
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
+
+import avaframe.in3Utils.geoTrans as gT
+import pandas as pd
+
+import amaUtilities as aU
+import demCache as dC
+import fit as fit
+import grab_demo as gD
+import intensityAnalysis as iA
+import pathStore as pS
+import stagedPipeline as sP
+
+# create local logger
+log = logging.getLogger(__name__)
+
+
+def snapEvents(dbData, cfg, pathStores=None, pointIndex=None, demCache=None):
+    """snap the points of interest to the thalwegs, add travel lengths, angles and slope angles at the points
+
+    Parameters
+    -----------
+    dbData: pandas dataframe
+        filtered events with geometries in the projection projstr and resampled path lines
+    cfg: configparser object
+        configuration (amaConnectorCfg.ini)
+    pathStores: dict
+        optional - path stores of the events, the thalweg store is added
+    pointIndex, demCache:
+        not used, for the signature shared by all analysis steps
+
+    Returns
+    --------
+    dbData: pandas dataframe
+        events with snapped points, distances, angles and slope angles
+    pathStores: dict
+        path stores including the thalweg store
+    pointIndex: pandas dataframe
+        unchanged pointIndex
+    """
+
+    projstr = cfg["MAIN"]["projstr"]
+
+    # snap release, runout, origin, transit, deposition points to resampled thalweg for all events
+    dbData = gT.snapPtsToLine(
+        dbData,
+        projstr,
+        lineName="geom_path_ln3d",
+        pointsList=[
+            "geom_event_pt3d",
+            "geom_origin_pt3d",
+            "geom_transit_pt3d",
+            "geom_runout_pt3d",
+            "geom_event_pt3d",
+            "geom_rel_event_pt3d",
+        ],
+    )
+
+    # compute distance along thalweg between orig-transit, orig-depo, orig-runout
+    # here the snapped points are chosen also in terms of their elevation on the path line!
+    for pointName, name in [("transit", "orig-transit"), ("runout", "orig-depo"), ("event", "orig-runout")]:
+        dbData = aU.addXYDistAngle(
+            dbData,
+            "geom_path_ln3d_%s_resampled" % projstr,
+            "geom_origin_pt3d_%s_snapped" % projstr,
+            "geom_%s_pt3d_%s_snapped" % (pointName, projstr),
+            projstr,
+            name=name,
+        )
+
+    # thalwegs and the profiles derived from them are kept as ragged arrays shared by all stages
+    pathStores = {} if pathStores is None else pathStores
+    pathStores["thalweg"] = pS.PathStore.fromLines(dbData.index, dbData["geom_path_ln3d_%s_resampled" % projstr])
+
+    # the snapped points are located once on the thalwegs, all stages read their index and distance from the table
+    thalwegIndex = pS.locatePoints(pathStores["thalweg"], dbData, pointColumns(projstr))
+
+    # slope angle is computed over a window of +- gradientHalfWindow [m] along the path line around the point
+    dbData = aU.addGradientForPoint(
+        dbData,
+        "geom_path_ln3d_%s_resampled" % projstr,
+        pointColumns(projstr)[:3],
+        pointIndex=thalwegIndex,
+        halfWindow=cfg["FILTERING"].getfloat("gradientHalfWindow"),
+    )
+
+    return dbData, pathStores, pointIndex
+
+
+def analyseIntensity(dbData, cfg, pathStores=None, pointIndex=None, demCache=None):
+    """locate the snapped points on the thalwegs resampled to resamplePathFit and add the intensity characteristics
+
+    pointIndex is replaced by the index of the points on the resampled thalwegs (pS.locatePoints), the
+    intensity profiles are added to pathStores; DEMs are read with demCache, a new cache is created if None;
+    the signature and returns are those of snapEvents
+    """
+
+    resDist = cfg["MAIN"].getfloat("resamplePathFit")
+    if demCache is None:
+        demCache = newDemCache(cfg)
+
+    # index of the points on the thalwegs resampled to resamplePathFit
+    thalwegs = pS.getStore(pathStores, "thalweg", dbData, column="geom_path_ln3d_%s_resampled" % cfg["MAIN"]["projstr"])
+    pointIndex = pS.locatePoints(
+        demCache.getAvaPaths(dbData, thalwegs, resDist), dbData, pointColumns(cfg["MAIN"]["projstr"])
+    )
+
+    # Calculating intensity characteristics
+    dbData = iA.intensityCharacteristics(
+        dbData, resDist, cfg, pathStores=pathStores, demCache=demCache, pointIndex=pointIndex
+    )
+
+    return dbData, pathStores, pointIndex
+
+
+def analyseFit(dbData, cfg, pathStores=None, pointIndex=None, demCache=None):
+    """fit a parabola to the thalweg of each event (fit.fitThalweg) and add the profiles to pathStores
+
+    the signature and returns are those of snapEvents
+    """
+
+    if demCache is None:
+        demCache = newDemCache(cfg)
+
+    # Applying fit method
+    dbData = fit.fitThalweg(
+        dbData,
+        cfg["MAIN"].getfloat("slopeAngle1"),
+        cfg["MAIN"].getfloat("slopeAngle2"),
+        cfg["MAIN"].getfloat("resamplePathFit"),
+        cfg["MAIN"]["projstr"],
+        cfg["MAIN"].getfloat("dsMin"),
+        cfg,
+        pathStores=pathStores,
+        demCache=demCache,
+        pointIndex=pointIndex,
+    )
+
+    return dbData, pathStores, pointIndex
+
+
+# steps of the analysis chain, in this order
+ANALYSISSTEPS = (snapEvents, analyseIntensity, analyseFit)
+
+
+def pointColumns(projstr):
+    """return the names of the snapped point columns located on the thalwegs"""
+
+    return [
+        "geom_origin_pt3d_%s_snapped" % projstr,
+        "geom_transit_pt3d_%s_snapped" % projstr,
+        "geom_runout_pt3d_%s_snapped" % projstr,
+        "geom_rel_event_pt3d_%s_snapped" % projstr,
+        "geom_event_pt3d_%s_snapped" % projstr,
+    ]
+
+
+def newDemCache(cfg):
+    """return a DemCache set up according to cfg"""
+
+    # DEMs and resampled thalwegs are loaded once per path and shared by intensity and fit
+    # with demWindowBuffer only the part of the DEM around the thalweg is loaded
+    if cfg["MAIN"]["demWindowBuffer"] != "":
+        demWindowBuffer = cfg["MAIN"].getfloat("demWindowBuffer")
+    else:
+        demWindowBuffer = None
+
+    return dC.DemCache(
+        demDir=cfg["MAIN"]["avalancheDir"],
+        useSidecar=cfg["MAIN"].getboolean("useDemSidecar"),
+        windowBuffer=demWindowBuffer,
+    )
+
+
+def analyseEvents(dbData, cfg, steps=ANALYSISSTEPS, pathStores=None, pointIndex=None):
+    """run the steps of the analysis chain for the events of dbData, all steps share one DEM cache
+
+    Parameters
+    -----------
+    dbData: pandas dataframe
+        filtered events with geometries in the projection projstr and resampled path lines
+    cfg: configparser object
+        configuration (amaConnectorCfg.ini)
+    steps: list
+        analysis steps, functions with the signature of snapEvents, default: the whole chain
+    pathStores: dict
+        optional - path stores of the events computed by earlier steps
+    pointIndex: pandas dataframe
+        optional - point index of the events computed by earlier steps
+
+    Returns
+    --------
+    dbData: pandas dataframe
+        events with the analysis results
+    pathStores: dict
+        path stores (thalweg and the profiles of intensity and fit)
+    pointIndex: pandas dataframe
+        index of the snapped points on the thalwegs resampled to resamplePathFit (pS.locatePoints)
+    demStats: dict
+        number of DEM and profile cache hits and misses
+    """
+
+    demCache = newDemCache(cfg)
+    pathStores = {} if pathStores is None else pathStores
+    for step in steps:
+        dbData, pathStores, pointIndex = step(
+            dbData, cfg, pathStores=pathStores, pointIndex=pointIndex, demCache=demCache
+        )
+
+    return dbData, pathStores, pointIndex, demCache.stats
+
+
+def cfgToDict(cfg):
+    """return the sections of cfg as dict, configparser objects cannot be passed to worker processes"""
+
+    return {section: dict(cfg[section]) for section in cfg.sections()}
+
+
+def analyseChunk(dbChunk, cfgDict, steps=ANALYSISSTEPS, pathStores=None, pointIndex=None):
+    """worker function: run the analysis steps for a chunk of events, with its own DEM cache"""
+
+    # option names are looked up case-insensitively, as in the configuration read from file
+    cfg = configparser.ConfigParser()
+    cfg.read_dict(cfgDict)
+
+    return analyseEvents(dbChunk.copy(), cfg, steps=steps, pathStores=pathStores, pointIndex=pointIndex)
+
+
+def runPipeline(dbData, cfg, nWorkers=1, chunkSize=50, steps=ANALYSISSTEPS, pathStores=None, pointIndex=None):
+    """run the analysis chain for all events of dbData, partitioned in chunks of events
+
+    the chunks are analysed in a pool of nWorkers processes, each worker reads the DEMs it needs itself;
+    results are reassembled in the order of dbData. With nWorkers=1 all chunks are analysed one after
+    the other in this process - results are identical, e.g. for debugging
+
+    Parameters
+    -----------
+    dbData: pandas dataframe
+        filtered events with geometries in the projection projstr and resampled path lines
+    cfg: configparser object
+        configuration (amaConnectorCfg.ini)
+    nWorkers: int
+        number of worker processes
+    chunkSize: int
+        number of events per chunk, 0: one chunk per worker
+    steps: list
+        analysis steps, functions with the signature of snapEvents, default: the whole chain
+    pathStores: dict
+        optional - path stores of the events computed by earlier steps, passed on to the result
+    pointIndex: pandas dataframe
+        optional - point index of the events computed by earlier steps
+
+    Returns
+    --------
+    dbData: pandas dataframe
+        events with the analysis results
+    pathStores: dict
+        path stores (thalweg and the profiles of intensity and fit)
+    pointIndex: pandas dataframe
+        index of the snapped points on the thalwegs resampled to resamplePathFit (pS.locatePoints)
+    """
+
+    nWorkers = max(int(nWorkers), 1)
+    if chunkSize <= 0:
+        chunkSize = -(-len(dbData) // nWorkers)
+    chunkSize = max(int(chunkSize), 1)
+    chunks = [dbData.iloc[start : start + chunkSize] for start in range(0, len(dbData), chunkSize)]
+    cfgDict = cfgToDict(cfg)
+    log.info("Analysing %d events in %d chunks using %d processes" % (len(dbData), len(chunks), nWorkers))
+
+    # path stores and point index of earlier steps are split along with the events
+    pathStores = {} if pathStores is None else pathStores
+    if len(chunks) == 1:
+        chunkStores = [dict(pathStores)]
+        chunkIndex = [pointIndex]
+    else:
+        chunkStores = [{name: store.subset(chunk.index) for name, store in pathStores.items()} for chunk in chunks]
+        chunkIndex = [None if pointIndex is None else pointIndex.loc[chunk.index] for chunk in chunks]
+
+    if nWorkers == 1 or len(chunks) <= 1:
+        results = [
+            analyseChunk(dbChunk, cfgDict, steps, stores, index)
+            for dbChunk, stores, index in zip(chunks, chunkStores, chunkIndex)
+        ]
+    else:
+        with ProcessPoolExecutor(max_workers=min(nWorkers, len(chunks))) as executor:
+            # map returns the results in the order of the chunks
+            results = list(
+                executor.map(
+                    analyseChunk, chunks, [cfgDict] * len(chunks), [steps] * len(chunks), chunkStores, chunkIndex
+                )
+            )
+
+    if len(results) == 0:
+        return dbData, pathStores, pd.DataFrame() if pointIndex is None else pointIndex
+
+    dbResult = pd.concat([result[0] for result in results])
+    pathStores = {
+        name: pS.PathStore.concat([result[1][name] for result in results]) for name in results[0][1]
+    }
+    if results[0][2] is None:
+        pointIndex = pd.DataFrame()
+    else:
+        pointIndex = pd.concat([result[2] for result in results])
+
+    demStats = {key: sum(result[3][key] for result in results) for key in results[0][3]}
+    log.info(
+        "DEM cache: %d DEMs read, %d reused; profiles: %d prepared, %d reused"
+        % (demStats["demMisses"], demStats["demHits"], demStats["pathMisses"], demStats["pathHits"])
+    )
+
+    return dbResult, pathStores, pointIndex
+
+
+def fetchEvents(cfg):
+    """stage: fetch all info of the database according to queryString"""
+
+    dbData = gD.grabAllComplete(
+        pathlib.Path(cfg["MAIN"]["avalancheDir"]),
+        queryString=cfg["MAIN"]["queryString"],
+        accessfile=pathlib.Path(cfg["MAIN"]["accessFile"]),
+        cfgCache=cfg["CACHE"],
+    )
+    log.info("Fetched %d entries from data base " % (len(dbData)))
+    for index, row in dbData.iterrows():
+        log.info("%s, event id: %s, index %s" % (row["path_name"], row["event_id"], index))
+
+    return {"events": dbData}
+
+
+def filterEvents(cfg, fetched):
+    """stage: filter the events, convert geometries to projstr, resample the thalwegs, one event per path"""
+
+    # filter db according to nonEmptyCols and convert geometry entries to desired projection
+    # resample thalweg for higher resolution
+    dbFiltered = aU.fetchGeometryInfo(
+        fetched["events"],
+        "epsg:4326",
+        cfg["MAIN"]["projstr"],
+        cfg["FILTERING"]["geomStr"],
+        cfg["FILTERING"]["nonEmptyAttributes"].split("|"),
+        cfg["FILTERING"]["addAttributes"].split("|"),
+        cfg["FILTERING"].getfloat("resampleDist"),
+    )
+    log.info("Filtered db data and converted to %s" % cfg["MAIN"]["projstr"])
+    log.info("Events found for path name:")
+    for index, row in dbFiltered.iterrows():
+        log.info("%s, event id: %s" % (row["path_name"], row["event_id"]))
+
+    # TODO: this only keeps first event found per path - is this wanted?
+    # possible implications: for summary plots
+    mask = dbFiltered.duplicated(subset="path_id", keep="first")
+
+    return {"events": dbFiltered[~mask]}
+
+
+def runSteps(cfg, previous, steps):
+    """run analysis steps for the events of the result of a previous stage in analysisWorkers processes"""
+
+    dbData, pathStores, pointIndex = runPipeline(
+        previous["events"],
+        cfg,
+        nWorkers=cfg["MAIN"].getint("analysisWorkers"),
+        chunkSize=cfg["MAIN"].getint("analysisChunkSize"),
+        steps=steps,
+        pathStores=previous.get("pathStores"),
+        pointIndex=previous.get("pointIndex"),
+    )
+    result = {"events": dbData, "pathStores": pathStores}
+    if len(pointIndex) > 0:
+        result["pointIndex"] = pointIndex
+
+    return result
+
+
+def snapStage(cfg, filtered):
+    """stage: snapped points, travel lengths and angles, slope angles (snapEvents)"""
+    return runSteps(cfg, filtered, [snapEvents])
+
+
+def intensityStage(cfg, snapped):
+    """stage: intensity characteristics (analyseIntensity)"""
+    return runSteps(cfg, snapped, [analyseIntensity])
+
+
+def fitStage(cfg, intensity):
+    """stage: parabolic fit of the thalwegs (analyseFit)"""
+    return runSteps(cfg, intensity, [analyseFit])
+
+
+def analysisStages():
+    """return the stages of the analysis of runFetchDataAnalyseNew, from fetching the events to the fit
+
+    each stage lists the configuration options its result depends on; options that only change how a result
+    is computed (workers, chunks, DEM sidecars and windows, query cache) are not listed. Intensity and
+    fit also depend on the DEMs in avalancheDir, rerun them if the DEMs change
+    """
+
+    return [
+        sP.Stage("fetch", fetchEvents, cfgKeys=[("MAIN", "queryString"), ("MAIN", "accessFile")]),
+        sP.Stage(
+            "filter",
+            filterEvents,
+            inputs=["fetch"],
+            cfgKeys=[
+                ("MAIN", "projstr"),
+                ("FILTERING", "geomStr"),
+                ("FILTERING", "nonEmptyAttributes"),
+                ("FILTERING", "addAttributes"),
+                ("FILTERING", "resampleDist"),
+            ],
+        ),
+        sP.Stage(
+            "snap",
+            snapStage,
+            inputs=["filter"],
+            cfgKeys=[("MAIN", "projstr"), ("FILTERING", "gradientHalfWindow")],
+        ),
+        sP.Stage(
+            "intensity",
+            intensityStage,
+            inputs=["snap"],
+            cfgKeys=[
+                ("MAIN", "avalancheDir"),
+                ("MAIN", "projstr"),
+                ("MAIN", "resamplePathFit"),
+                ("MAIN", "g"),
+                ("MAIN", "density"),
+            ],
+        ),
+        sP.Stage(
+            "fit",
+            fitStage,
+            inputs=["intensity"],
+            cfgKeys=[
+                ("MAIN", "avalancheDir"),
+                ("MAIN", "projstr"),
+                ("MAIN", "resamplePathFit"),
+                ("MAIN", "slopeAngle1"),
+                ("MAIN", "slopeAngle2"),
+                ("MAIN", "dsMin"),
+                ("MAIN", "betaAngles"),
+            ],
+        ),
+    ]
@@ -1,13 +1,27 @@
 import amaConnector
+import hashlib
+import json
 import os
+import shutil
 from os import path
 import geopandas, pandas as pd
+import pyproj
+import shapely
 from osgeo import gdal
 from shapely import wkb
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+import demCache as dC
+import exportManifest as emF
+
+# GeoTIFF formats are written as compressed, tiled GeoTIFF
+tiffFormats = ['tif', 'tiff', 'geotiff']
+
+
 def checkDir(dir):
-    if not os.path.isdir(dir):
-        os.mkdir(dir)
+    #exist_ok: directories may be created concurrently by parallel exports
+    os.makedirs(dir, exist_ok=True)
     return dir
 
 def checkPath(filePath):
@@ -24,59 +38,510 @@ def checkPath(filePath):
             outPath=''
 
     return outPath
-def grabRaster(amaConnect, config, outdir, design_event=False, projstr ='', constraint=''):
+
+
+# per-config settings of the export, fetched once per database and configuration
+exportConfKeys = ['projection_raster', 'raster_buffer', 'raster_format', 'exportgeometry']
+_exportConfCache = {}
+
+
+def fetchExportConf(amaConnect, config):
+    """ return the export settings exportConfKeys of config as dict, fetched with a single query on first use
+        and cached for the rest of the run """
+
+    cacheKey = (amaConnect.connectionString(), config)
+    if cacheKey not in _exportConfCache:
+        confData = amaConnect.query("select confkey, getclosestconf('%s', confkey) as value "
+            "from unnest(array[%s]) as confkey" % (config, ', '.join("'%s'" % key for key in exportConfKeys)))
+        _exportConfCache[cacheKey] = dict(zip(confData['confkey'], confData['value']))
+    return _exportConfCache[cacheKey]
+
+
+def writeTiledTiff(tifFile):
+    """ rewrite a GeoTIFF as DEFLATE compressed, tiled GeoTIFF, so that windows can be read without
+        decompressing the whole raster """
+
+    ds = gdal.Open(tifFile)
+    dataType = gdal.GetDataTypeName(ds.GetRasterBand(1).DataType)
+    # floating point predictor for float rasters, horizontal differencing for integer rasters
+    predictor = 3 if dataType.startswith('Float') else 2
+    tmpFile = tifFile + '.tmp.tif'
+    gdal.Translate(tmpFile, ds, format='GTiff',
+        creationOptions=['COMPRESS=DEFLATE', 'TILED=YES', 'PREDICTOR=%d' % predictor])
+    ds = None
+    os.replace(tmpFile, tifFile)
+
+
+def writeNpyRaster(tifFile):
+    """ convert a GeoTIFF to a .npy raster plus .json header next to it (see demCache.writeSidecar),
+        rows are flipped to start in the south and nodata is stored as nan """
+
+    dem = dC.readGeoTiff(tifFile, dtype=None)
+    dC.writeSidecar(tifFile, dem)
+    return dC.sidecarPaths(tifFile)[0]
+
+
+def convertRaster(outfile, outputformat):
+    """ convert the exported tiff outfile to outputformat; runs in a worker process in parallel mode
+
+        returns the written files and the progress messages """
+
+    messages = []
+    if outputformat.lstrip(' .').lower() in tiffFormats:
+        messages.append('compressing tiff %s' % outfile)
+        writeTiledTiff(outfile)
+        outFiles = [outfile]
+    elif outputformat.lstrip(' .').lower() == 'npy':
+        npyFile = writeNpyRaster(outfile)
+        messages.append('raster written as %s, removing tiff %s' % (npyFile, outfile))
+        os.remove(outfile)
+        outFiles = [str(sidecar) for sidecar in dC.sidecarPaths(outfile)]
+    else:
+        messages.append('DB configuration suggests using raster format "%s"'% outputformat)
+        customOut = checkPath(outfile.replace('.tif', '.%s' % outputformat.lstrip(' .').lower()))
+        messages.append('Writing output file %s'%customOut)
+        ds = gdal.Open(outfile)
+        gdal.Translate(customOut, ds)
+        ds = None
+        outFiles = [outfile]
+        if os.path.isfile(customOut):
+            messages.append('file converted to selected output format, removing tiff %s'%outfile)
+            try:
+                os.remove(outfile)
+                outFiles = []
+            except:
+                messages.append('cannot remove file right now. you might have to live with a bit of additional hdd clutter for now, remove it yourself if you like')
+            #gdal may write the projection and auxiliary metadata next to the raster
+            outFiles = outFiles + [customFile for customFile in [customOut, path.splitext(customOut)[0] + '.prj',
+                customOut + '.aux.xml'] if path.isfile(customFile)]
+    return outFiles, messages
+
+
+def linkFile(srcFile, dstFile):
+    """ hard-link srcFile to dstFile, copy if linking is not possible (e.g. different file systems) """
+
+    dstFile = checkPath(dstFile)
+    if len(dstFile) == 0:
+        return False
+    try:
+        os.link(srcFile, dstFile)
+    except OSError:
+        shutil.copy2(srcFile, dstFile)
+    return True
+
+
+def rasterVersion(rasterHash, outputformat, epsg, buffersize, outfiles):
+    """ return the source version of a path raster export: raster hash, export settings and event locations """
+
+    locationsHash = hashlib.md5('|'.join(outfiles).encode('utf-8')).hexdigest()
+    return '%s|%s|%d|%d|%s' % (rasterHash, outputformat, epsg, buffersize, locationsHash)
+
+
+def exportPathRaster(amaConnect, outdir, epsg, buffersize, outputformat, path_id, outfiles, convertPool=None,
+    manifest=None):
+    """ fetch the DEM of path_id once, save and convert it for the first event and link the result into the
+        raster_dem locations of all other events of the path
+
+        if a manifest (exportManifest.ExportManifest) is given, the md5 hash of the raster is computed on the
+        server and compared to the recorded export; unchanged rasters with all output files still on disk are
+        not fetched again. if convertPool (a process pool) is given, the conversion runs in the pool
+
+        returns the progress messages """
+
+    messages = []
+    item = 'raster/path_%d' % path_id
+    rasterQuery = 'st_astiff(getraster(%d,%d,%d))' % (path_id, epsg, buffersize)
+    if manifest is not None and item in manifest.entries:
+        rasterHash = amaConnect.query('select md5(%s) as rastermd5' % rasterQuery)['rastermd5'][0]
+        if manifest.isCurrent(item, rasterVersion(rasterHash, outputformat, epsg, buffersize, outfiles)):
+            messages.append('raster of path_id %d unchanged, skipping.' % path_id)
+            return messages
+
+    outfile = checkPath(outfiles[0])
+    if len(outfile) == 0:
+        messages.append('skipping.')
+        return messages
+    rast = amaConnect.query('select * from %s' % rasterQuery)
+    rasterBytes = bytes(rast['st_astiff'][0])
+    messages.append('saving tiff to %s'%outfile)
+    with  open(outfile, 'wb') as savefile:
+        savefile.write(rasterBytes)
+    if convertPool is None:
+        outFiles, convertMessages = convertRaster(outfile, outputformat)
+    else:
+        outFiles, convertMessages = convertPool.submit(convertRaster, outfile, outputformat).result()
+    messages.extend(convertMessages)
+
+    #all events of the path share the raster - link the files of the first event into the other locations
+    stem = path.splitext(path.basename(outfile))[0]
+    checksums = {outFile: emF.fileChecksum(outFile) for outFile in outFiles}
+    for eventOutfile in outfiles[1:]:
+        eventStem = path.splitext(eventOutfile)[0]
+        for outFile in outFiles:
+            eventFile = eventStem + path.basename(outFile)[len(stem):]
+            if linkFile(outFile, eventFile):
+                checksums[eventFile] = checksums[outFile]
+    if len(outfiles) > 1:
+        messages.append('linked raster of path_id %d into %d further event locations' % (path_id, len(outfiles) - 1))
+
+    if manifest is not None:
+        manifest.record(item, rasterVersion(hashlib.md5(rasterBytes).hexdigest(), outputformat, epsg, buffersize,
+            outfiles), list(checksums), checksums=checksums)
+    return messages
+
+
+def runExportItems(exportFunc, items, nWorkers=1, name='item'):
+    """ call exportFunc(*item) for all items, in a thread pool of nWorkers threads if nWorkers > 1
+
+        exportFunc returns a list of progress messages; messages are printed in the order of items, also in
+        parallel mode. Errors of single items are reported and do not abort the export of the other items
+
+        returns the first entries (ids) of the failed items """
+
+    failed = []
+    nItems = len(items)
+
+    def report(number, item, getMessages):
+        label = str(item[0])
+        try:
+            messages = getMessages()
+        except Exception as error:
+            print('[%d/%d] exporting %s %s failed: %s' % (number, nItems, name, label, error))
+            failed.append(item[0])
+            return
+        for message in messages:
+            print(message)
+        print('[%d/%d] exported %s %s' % (number, nItems, name, label))
+
+    if nWorkers > 1:
+        with ThreadPoolExecutor(max_workers=nWorkers) as executor:
+            futures = [executor.submit(exportFunc, *item) for item in items]
+            for number, (item, future) in enumerate(zip(items, futures), start=1):
+                report(number, item, future.result)
+    else:
+        for number, item in enumerate(items, start=1):
+            report(number, item, partial(exportFunc, *item))
+
+    if len(failed) > 0:
+        print('export of %d of %d %ss failed: %s' % (len(failed), nItems, name, failed))
+    return failed
+
+
+def grabRaster(amaConnect, config, outdir, design_event=False, projstr ='', constraint='', rasterFormat='', nWorkers=1,
+    manifest=None):
     if (design_event):
         schema = 'design' # Design refers to reference avalanches meant for designing mitigation measures etc.
     else:
         schema = 'public' # Public refers to actual, real-life avalanches
+    exportConf = fetchExportConf(amaConnect, config)
     if projstr == '':
-        projstr = amaConnect.query("select * from getclosestconf('%s','projection_raster')"%config)['getclosestconf'][0]
+        projstr = exportConf['projection_raster']
     #getting the output projection config as stored in the config table
 
     epsg = int(projstr.lower().replace('epsg:','').strip())
     print('using output projection EPSG:%d'%epsg)
-    buffersize = int(amaConnect.query("select * from getclosestconf('%s','raster_buffer')"%config)['getclosestconf'][0])
+    buffersize = int(exportConf['raster_buffer'])
     print('using a buffer size of %d [coordinate system units]'%buffersize)
-    outputformat = amaConnect.query("select * from getclosestconf('%s','raster_format')"%config)['getclosestconf'][0]
+    if rasterFormat == '':
+        outputformat = exportConf['raster_format']
+    else:
+        outputformat = rasterFormat
+    #npy: .npy raster + .json header as read by the analysis (demCache), tif: compressed tiled GeoTIFF
     #
     pathList = amaConnect.query('select distinct path_id, event_id from %s.event_full' % schema, constraint)
-    for index, path in pathList.iterrows():
-        path_id= path['path_id']
-        event_id = path['event_id']
-        #rasterquery = "with extent as (select st_swapordinates(st_buffer(st_transform(ln,%s),%d),'xy') as ext from paths where paths.path_id = %d) \
-        #                            select st_astiff(st_union(st_clip(rast, ext))) as raster from dem right join extent on st_intersects(dem.rast, extent.ext) group by ext" % (
-        #epsg, buffersize, path_id)
-        rast = amaConnect.query("select * from st_astiff(getraster(%d,%d,%d))"%(path_id, epsg, buffersize))
-        outfile = checkPath(amaConnect.query("select * from getstructure(%d,'raster_dem','%s')"%(event_id,config))['getstructure'][0].replace('%outdir%',outdir))
-        if len(outfile)>0:
-            print('saving tiff to %s'%outfile)
-            with  open(outfile, 'wb') as savefile:
-                savefile.write(rast['st_astiff'][0])
-            if outputformat.lstrip(' .').lower() not in ['tif', 'tiff', 'geotiff']:
-                print('DB configuration suggests using raster format "%s"'% outputformat)
-                customOut = checkPath(outfile.replace('.tif', '.%s' % outputformat.lstrip(' .').lower()))
-                print('Writing output file %s'%customOut)
-                ds = gdal.Open(outfile)
-                gdal.Translate(customOut, ds)
-                ds = None
-                if os.path.isfile(customOut):
-                    print('file converted to selected output format, removing tiff %s'%outfile)
-                    try:
-                        os.remove(outfile)
-                    except:
-                        print('cannot remove file right now. you might have to live with a bit of additional hdd clutter for now, remove it yourself if you like')
-        else:
-            print('skipping.')
+    #rasterquery = "with extent as (select st_swapordinates(st_buffer(st_transform(ln,%s),%d),'xy') as ext from paths where paths.path_id = %d) \
+    #                            select st_astiff(st_union(st_clip(rast, ext))) as raster from dem right join extent on st_intersects(dem.rast, extent.ext) group by ext" % (
+    #epsg, buffersize, path_id)
+
+    #output locations of all events in one query, the raster of each path is fetched once for all its events
+    structures = amaConnect.query("select ids.ama_event_id, "
+        "getstructure(ids.ama_event_id, 'raster_dem', '%s') as struct "
+        "from unnest(%%(eventIds)s::int[]) as ids(ama_event_id)" % config,
+        params={'eventIds': [int(event_id) for event_id in pathList['event_id']]})
+    structures = dict(zip(structures['ama_event_id'], structures['struct']))
+    pathEvents = {}
+    for index, row in pathList.sort_values(['path_id', 'event_id']).iterrows():
+        outfile = structures[row['event_id']].replace('%outdir%', outdir).replace('/', path.sep).replace('\\', path.sep)
+        pathEvents.setdefault(int(row['path_id']), []).append(outfile)
+    items = [(path_id, outfiles) for path_id, outfiles in pathEvents.items()]
+    print('exporting rasters of %d paths for %d events' % (len(items), len(pathList)))
+
+    #with nWorkers > 1, DB queries and file writes run in a thread pool and the GDAL conversion in a process pool
+    if nWorkers > 1:
+        print('exporting rasters with %d workers' % nWorkers)
+        with ProcessPoolExecutor(max_workers=nWorkers) as convertPool:
+            exportFunc = partial(exportPathRaster, amaConnect, outdir, epsg, buffersize, outputformat,
+                convertPool=convertPool, manifest=manifest)
+            runExportItems(exportFunc, items, nWorkers=nWorkers, name='raster of path_id')
+    else:
+        exportFunc = partial(exportPathRaster, amaConnect, outdir, epsg, buffersize, outputformat,
+            manifest=manifest)
+        runExportItems(exportFunc, items, name='raster of path_id')
     return len(pathList)
 
 
-def grabEvents(amaConnect, config, outpath,design_event=False, projstr = 'epsg:31287', constraint = '' ):
+def shapefileFiles(outPath):
+    """ return the existing files of the shapefile outPath """
+
+    stem = path.splitext(outPath)[0]
+    return [stem + ext for ext in ['.shp', '.shx', '.dbf', '.prj', '.cpg'] if path.isfile(stem + ext)]
+
+
+def writeEventGeometry(geometry, attr, projstr, outpath):
+    """ write the geometry of one event with its attributes attr as shapefile to the location given in struct
+
+        returns the written files (None if the file could not be written) and the progress messages """
+
+    messages = []
+    if not (geometry['geom'].isnull()[0]): #only work with existing geometries
+        geometry['geom'] = geometry['geom'].apply(wkb.loads, hex=True)
+        # one may set different (or none at all) attributes to be included in paths, release lines etc.
+        attributes = pd.DataFrame([attr['value']]).rename(columns=attr['key']).reset_index(drop=True)
+        feature = geometry.join(attributes)
+        geodf =  geopandas.GeoDataFrame(feature, geometry='geom').set_crs(projstr)
+
+        outPath = geodf['struct'][0].replace('%outdir%',outpath)
+        #filling in the last variable, %outdir%, in the output path
+        outPath=checkPath(outPath)
+        if len(outPath)>0:
+        #this will prepare the subdirectory and change the output path if necessary; general aim is to get a valid, writeable path within an existing directory
+            messages.append('using output path %s'%outPath)
+            geodf.to_file(outPath, driver='ESRI Shapefile')
+            return shapefileFiles(outPath), messages
+        messages.append('skipping file')
+        return None, messages
+    messages.append('Geometry empty, skipping output!')
+    return [], messages
+
+
+def fetchSourceVersions(amaConnect, config, schema, projstr, geomCol, eventIds):
+    """ return the source version of geometry column geomCol of all events eventIds
+
+        the version is a md5 hash of the rows of exporteventgeom and extractattributes, computed by the database
+        in one query, and the output projection """
+
+    col = geomCol.strip()
+    versions = amaConnect.query("select ids.ama_event_id, "
+        "(select coalesce(md5(string_agg(exportgeom::text, '|' order by exportgeom::text)), '') "
+        "from %s.exporteventgeom(ids.ama_event_id, '%s', '%s') as exportgeom) || "
+        "(select coalesce(md5(string_agg(exportattr::text, '|' order by exportattr::text)), '') "
+        "from %s.extractattributes(ids.ama_event_id, '%s', '%s') as exportattr) as sourcehash "
+        "from unnest(%%(eventIds)s::int[]) as ids(ama_event_id)" % (schema, col, config, schema, col, config),
+        params={'eventIds': [int(event_id) for event_id in eventIds]})
+    return {int(event_id): '%s|%s' % (sourceHash, projstr) for event_id, sourceHash in
+        zip(versions['ama_event_id'], versions['sourcehash'])}
+
+
+def geometryItem(event_id, col):
+    return 'geometry/%d/%s' % (event_id, col)
+
+
+def exportEventGeometries(amaConnect, config, outpath, schema, projstr, geometryCols, event_id, manifest=None,
+    sourceVersions=None):
+    """ export all geometry columns geometryCols of event_id as shapefiles
+
+        with a manifest and the sourceVersions of each column (see fetchSourceVersions), geometries that are
+        unchanged since the recorded export are skipped
+
+        returns the progress messages """
+
+    messages = ['exporting event_id %d'%event_id]
+    for geomCol in geometryCols:
+        col = geomCol.strip()
+        if manifest is not None and manifest.isCurrent(geometryItem(event_id, col), sourceVersions[col][event_id]):
+            messages.append('geometry column %s unchanged, skipping' % col)
+            continue
+        messages.append('collecting data for geometry column %s' % col)
+        geometry = amaConnect.query("select * from %s.exporteventgeom(%d, '%s', '%s')"%(schema, event_id, col, config))
+        #this retrieves the geometry in combination with an output path according to the current config - structure_geom_xyz
+        attr = None
+        if not (geometry['geom'].isnull()[0]): #attributes are only required for existing geometries
+            attr = amaConnect.query(
+                "select * from %s.extractattributes(%d, '%s', '%s')" % (schema, event_id, col, config))
+            #this retrieves the selected set of attributes according to the current configuration and the current geometry column
+        outFiles, writeMessages = writeEventGeometry(geometry, attr, projstr, outpath)
+        messages.extend(writeMessages)
+        if manifest is not None and outFiles is not None:
+            manifest.record(geometryItem(event_id, col), sourceVersions[col][event_id], outFiles)
+        #exportfile(dataOut, geometry['struct'], outpath)
+    return messages
+
+
+def fetchColumnBatch(amaConnect, config, schema, geomCol, eventIds):
+    """ fetch geometries and attributes of geometry column geomCol of events eventIds with one query each
+
+        returns the geometries (with output structure) and attributes, both with the event id in ama_event_id """
+
+    col = geomCol.strip()
+    geometries = amaConnect.query("select ids.ama_event_id, geom.* "
+        "from unnest(%%(eventIds)s::int[]) as ids(ama_event_id) "
+        "cross join lateral %s.exporteventgeom(ids.ama_event_id, '%s', '%s') as geom" % (schema, col, config),
+        params={'eventIds': [int(event_id) for event_id in eventIds]})
+    attrs = amaConnect.query("select ids.ama_event_id, attr.* "
+        "from unnest(%%(eventIds)s::int[]) as ids(ama_event_id) "
+        "cross join lateral %s.extractattributes(ids.ama_event_id, '%s', '%s') as attr" % (schema, col, config),
+        params={'eventIds': [int(event_id) for event_id in eventIds]})
+    return geometries, attrs
+
+
+def exportColumnGeometries(amaConnect, config, outpath, schema, projstr, eventIds, geomCol, manifest=None,
+    sourceVersions=None, failedEvents=None):
+    """ export geometry column geomCol of all events eventIds as shapefiles
+
+        geometries, output structure and attributes of all events are fetched with one query each
+        (lateral join of exporteventgeom and extractattributes on the array of event ids). With a manifest and
+        the sourceVersions of the column (see fetchSourceVersions), only changed geometries are fetched.
+        Errors writing the geometry of single events are reported and do not abort the export of the other
+        events, the ids of these events are appended to failedEvents (if given)
+
+        returns the progress messages """
+
+    col = geomCol.strip()
+    eventIds = [int(event_id) for event_id in eventIds]
+    messages = []
+    if manifest is not None:
+        nEvents = len(eventIds)
+        eventIds = [event_id for event_id in eventIds if not manifest.isCurrent(geometryItem(event_id, col),
+            sourceVersions[col][event_id])]
+        if len(eventIds) < nEvents:
+            messages.append('geometry column %s unchanged for %d events, skipping' % (col, nEvents - len(eventIds)))
+        if len(eventIds) == 0:
+            return messages
+    messages.append('collecting data for geometry column %s of %d events' % (col, len(eventIds)))
+    geometries, attrs = fetchColumnBatch(amaConnect, config, schema, col, eventIds)
+    #this retrieves the geometries in combination with an output path according to the current config and the
+    #selected set of attributes of all events - one round trip per geometry column instead of per event and column
+    geometryGroups = dict(list(geometries.groupby('ama_event_id', sort=False)))
+    attrGroups = dict(list(attrs.groupby('ama_event_id', sort=False)))
+
+    failed = []
+
+    for event_id in eventIds:
+        if event_id not in geometryGroups:
+            messages.append('event_id %d: no geometry %s, skipping output!' % (event_id, col))
+            continue
+        try:
+            geometry = geometryGroups[event_id].drop(columns='ama_event_id').reset_index(drop=True)
+            attr = attrGroups.get(event_id, attrs.iloc[0:0]).reset_index(drop=True)
+            outFiles, writeMessages = writeEventGeometry(geometry, attr, projstr, outpath)
+            messages.extend(['event_id %d: %s' % (event_id, message) for message in writeMessages])
+            if manifest is not None and outFiles is not None:
+                manifest.record(geometryItem(event_id, col), sourceVersions[col][event_id], outFiles)
+        except Exception as error:
+            messages.append('event_id %d: exporting geometry %s failed: %s' % (event_id, col, error))
+            failed.append(event_id)
+
+    if len(failed) > 0:
+        messages.append('export of geometry column %s failed for %d of %d events: %s' % (col, len(failed),
+            len(eventIds), failed))
+        if failedEvents is not None:
+            failedEvents.extend((event_id, col) for event_id in failed)
+    return messages
+
+
+def columnTable(geometries, attrs, attrKeys):
+    """ return one row per event with event_id, one column per attribute key (as text) and the geometry geom,
+        events without geometry are dropped """
+
+    geometries = geometries[~geometries['geom'].isnull()].drop_duplicates('ama_event_id')
+    attributes = attrs.drop_duplicates(['ama_event_id', 'key']).pivot(index='ama_event_id', columns='key',
+        values='value').reindex(columns=attrKeys)
+    attributes = attributes.astype(object).where(attributes.notnull(), None)
+    table = pd.DataFrame({'event_id': geometries['ama_event_id'].to_numpy()})
+    table = table.join(attributes, on='event_id')
+    table['geom'] = shapely.from_wkb(geometries['geom'].to_numpy())
+    return table
+
+
+def emptyColumnTable(attrKeys):
+    """ return a table of columnTable without rows """
+
+    table = pd.DataFrame({'event_id': pd.Series([], dtype='int64')})
+    for key in attrKeys:
+        table[key] = pd.Series([], dtype=object)
+    table['geom'] = pd.Series([], dtype=object)
+    return table
+
+
+def geoParquetSchema(table, projstr):
+    """ return the arrow schema of a GeoParquet file for table (geometry geom as WKB, attributes as text) """
+
+    import pyarrow as pa
+
+    fields = [pa.field('event_id', pa.int64())] + [pa.field(str(col), pa.string()) for col in table.columns
+        if col not in ['event_id', 'geom']] + [pa.field('geom', pa.binary())]
+    geoMeta = {'version': '1.0.0', 'primary_column': 'geom', 'columns': {'geom': {'encoding': 'WKB',
+        'geometry_types': [], 'crs': pyproj.CRS(projstr).to_json_dict()}}}
+    return pa.schema(fields, metadata={b'geo': json.dumps(geoMeta).encode('utf-8')})
+
+
+def exportColumnFile(amaConnect, config, schema, projstr, eventIds, exportFormat, batchSize, geomCol, outFile):
+    """ export geometry column geomCol of all events eventIds to one file, fetched and written in batches of
+        batchSize events
+
+        exportFormat gpkg: one layer per geometry column in the GeoPackage outFile (appended batch by batch),
+        parquet: one GeoParquet file per geometry column (outFile), written with a pyarrow ParquetWriter.
+        Rows are keyed by event_id, attributes are stored as text columns
+
+        returns the progress messages """
+
+    col = geomCol.strip()
+    eventIds = [int(event_id) for event_id in eventIds]
+    messages = ['exporting geometry column %s of %d events to %s' % (col, len(eventIds), outFile)]
+    #attribute names of all events, the columns of the file are fixed before the first batch is written
+    attrKeys = sorted(amaConnect.query("select distinct attr.key "
+        "from unnest(%%(eventIds)s::int[]) as ids(ama_event_id) "
+        "cross join lateral %s.extractattributes(ids.ama_event_id, '%s', '%s') as attr" % (schema, col, config),
+        params={'eventIds': eventIds})['key'])
+
+    writer = None
+    nRows = 0
+    try:
+        for start in range(0, len(eventIds), batchSize):
+            geometries, attrs = fetchColumnBatch(amaConnect, config, schema, col, eventIds[start:start + batchSize])
+            table = columnTable(geometries, attrs, attrKeys)
+            if len(table) == 0:
+                continue
+            if exportFormat == 'gpkg':
+                geodf = geopandas.GeoDataFrame(table, geometry='geom', crs=projstr)
+                geodf.to_file(outFile, layer=col, driver='GPKG', mode=('a' if nRows > 0 else 'w'))
+            else:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+
+                if writer is None:
+                    schemaArrow = geoParquetSchema(table, projstr)
+                    writer = pq.ParquetWriter(outFile, schemaArrow)
+                table['geom'] = shapely.to_wkb(table['geom'].to_numpy(), flavor='iso')
+                writer.write_table(pa.Table.from_pandas(table, schema=schemaArrow, preserve_index=False))
+            nRows = nRows + len(table)
+        #without geometries an empty file or layer replaces the output of an earlier export
+        if nRows == 0:
+            table = emptyColumnTable(attrKeys)
+            if exportFormat == 'gpkg':
+                table['geom'] = geopandas.GeoSeries([], crs=projstr)
+                geodf = geopandas.GeoDataFrame(table, geometry='geom', crs=projstr)
+                geodf.to_file(outFile, layer=col, driver='GPKG', mode='w')
+            else:
+                import pyarrow.parquet as pq
+
+                writer = pq.ParquetWriter(outFile, geoParquetSchema(table, projstr))
+    finally:
+        if writer is not None:
+            writer.close()
+    messages.append('written %d geometries of column %s' % (nRows, col))
+    return messages
+
+
+def grabEvents(amaConnect, config, outpath,design_event=False, projstr = 'epsg:31287', constraint = '', nWorkers=1,
+    batched=False, manifest=None, exportFormat='shapefile', batchSize=500):
     if (design_event):
         schema = 'design' # Design refers to reference avalanches meant for designing mitigation measures etc.
     else:
         schema = 'public' # Public refers to actual, real-life avalanches
+    exportConf = fetchExportConf(amaConnect, config)
     if projstr == '':
-        projstr = amaConnect.query("select * from getclosestconf('%s','projection_raster')" % config)['getclosestconf'][0]
+        projstr = exportConf['projection_raster']
     # getting the output projection config as stored in the config table
 
     epsg = int(projstr.lower().replace('epsg:', '').strip())
@@ -85,42 +550,46 @@ def grabEvents(amaConnect, config, outpath,design_event=False, projstr = 'epsg:3
     #this retrieves the event_ids of all relevant events
 
 
-    geometryCols = amaConnect.query("select * from getclosestconf('%s','exportgeometry')"%config)
-    #geometryCols = {'getclosestconf': ['geom_event_pt, geom_path_ln, geom_event_ln, geom_rel_pt, geom_rel_ln']}
+    geometryCols = exportConf['exportgeometry'].split(',')
+    #geometryCols = 'geom_event_pt, geom_path_ln, geom_event_ln, geom_rel_pt, geom_rel_ln'
     #this asks the database for the stored geometry column names which should get exported in the current configuration
 
-    for index, event in eventList.iterrows():
-        event_id = event['event_id']
-        print('exporting event_id %d'%event_id)
-        for geomCol in geometryCols['getclosestconf'][0].split(','):
-            col = geomCol.strip()
-            print('collecting data for geometry column %s' % col)
-            geometry = amaConnect.query("select * from %s.exporteventgeom(%d, '%s', '%s')"%(schema, event_id, col, config))
-            #this retrieves the geometry in combination with an output path according to the current config - structure_geom_xyz
-
-
-            if not (geometry['geom'].isnull()[0]): #only work with existing geometries
-                geometry['geom'] = geometry['geom'].apply(wkb.loads, hex=True)
-
-                attr = amaConnect.query(
-                    "select * from %s.extractattributes(%d, '%s', '%s')" % (schema, event_id, col, config))
-                #this retrieves the selected set of attributes according to the current configuration and the current geometry column
-                # one may set different (or none at all) attributes to be included in paths, release lines etc.
-                attributes = pd.DataFrame([attr['value']]).rename(columns=attr['key']).reset_index(drop=True)
-                feature = geometry.join(attributes)
-                geodf =  geopandas.GeoDataFrame(feature, geometry='geom').set_crs(projstr)
-
-                outPath = geodf['struct'][0].replace('%outdir%',outpath)
-                #filling in the last variable, %outdir%, in the output path
-                outPath=checkPath(outPath)
-                if len(outPath)>0:
-                #this will prepare the subdirectory and change the output path if necessary; general aim is to get a valid, writeable path within an existing directory
-                    print('using output path %s'%outPath)
-                    geodf.to_file(outPath, driver='ESRI Shapefile')
-                else:
-                    print('skipping file')
-            else:
-                print('Geometry empty, skipping output!')
-            #exportfile(dataOut, geometry['struct'], outpath)
+    #single file export: each geometry column as layer of one GeoPackage or as one GeoParquet file
+    if exportFormat in ['gpkg', 'parquet']:
+        geomCols = [geomCol.strip() for geomCol in geometryCols]
+        checkDir(outpath)
+        if exportFormat == 'gpkg':
+            #layers of one GeoPackage cannot be written concurrently
+            items = [(geomCol, path.join(outpath, 'events.gpkg')) for geomCol in geomCols]
+            nWorkers = 1
+        else:
+            items = [(geomCol, path.join(outpath, 'events_%s.parquet' % geomCol)) for geomCol in geomCols]
+        exportFunc = partial(exportColumnFile, amaConnect, config, schema, projstr, list(eventList['event_id']),
+            exportFormat, batchSize)
+        runExportItems(exportFunc, items, nWorkers=nWorkers, name='geometry column')
+        return len(eventList)
+
+    #with a manifest, the source versions of all geometries are fetched (one query per column) to skip unchanged items
+    sourceVersions = None
+    if manifest is not None:
+        sourceVersions = {geomCol.strip(): fetchSourceVersions(amaConnect, config, schema, projstr, geomCol,
+            eventList['event_id']) for geomCol in geometryCols}
+
+    if batched:
+        #one query per geometry column for all events, with nWorkers > 1 columns are exported in parallel
+        failedEvents = []
+        exportFunc = partial(exportColumnGeometries, amaConnect, config, outpath, schema, projstr,
+            list(eventList['event_id']), manifest=manifest, sourceVersions=sourceVersions, failedEvents=failedEvents)
+        items = [(geomCol.strip(), ) for geomCol in geometryCols]
+        runExportItems(exportFunc, items, nWorkers=nWorkers, name='geometry column')
+        if len(failedEvents) > 0:
+            print('export of %d event geometries failed (event_id, geometry column): %s' % (len(failedEvents),
+                sorted(failedEvents)))
+    else:
+        exportFunc = partial(exportEventGeometries, amaConnect, config, outpath, schema, projstr, geometryCols,
+            manifest=manifest, sourceVersions=sourceVersions)
+        items = [(int(event['event_id']), ) for index, event in eventList.iterrows()]
+        #with nWorkers > 1, events are exported in a thread pool, each event uses its own DB connection
+        runExportItems(exportFunc, items, nWorkers=nWorkers, name='event')
 
     return len(eventList)
@@ -0,0 +1,353 @@
+"""
+    Cache of path DEMs and prepared thalweg profiles shared between the analysis stages
+"""
+
+import json
+import logging
+import os
+import pathlib
+
+import avaframe.in2Trans.ascUtils as IOf
+import avaframe.in3Utils.geoTrans as gT
+import numpy as np
+
+import pathStore as pS
+
+# create local logger
+log = logging.getLogger(__name__)
+
+
+def sidecarPaths(demPath):
+    """return the paths of the binary raster (.npy) and header (.json) sidecar of demPath"""
+
+    demPath = pathlib.Path(demPath)
+    return demPath.with_suffix(".npy"), demPath.with_suffix(".json")
+
+
+def writeSidecar(demPath, dem):
+    """write dem as .npy raster plus .json header next to demPath
+
+    the raster is stored as read by IOf.readRaster (row 0 is the southern row, nodata as nan), files are
+    written to a temporary name first so that concurrent readers never see partially written sidecars
+
+    Parameters
+    -----------
+    demPath: pathlib path or str
+        path to the DEM the sidecar belongs to (e.g. dem_path_1.asc)
+    dem: dict
+        dem dictionary with header and rasterData
+    """
+
+    dataFile, headerFile = sidecarPaths(demPath)
+    tmpSuffix = ".tmp%d" % os.getpid()
+
+    tmpDataFile = dataFile.with_name(dataFile.name + tmpSuffix)
+    with open(tmpDataFile, "wb") as fi:
+        np.save(fi, np.ascontiguousarray(dem["rasterData"]))
+    tmpHeaderFile = headerFile.with_name(headerFile.name + tmpSuffix)
+    with open(tmpHeaderFile, "w") as fi:
+        json.dump({key: dem["header"][key] for key in dem["header"]}, fi)
+
+    os.replace(tmpDataFile, dataFile)
+    os.replace(tmpHeaderFile, headerFile)
+
+
+def readSidecar(demPath, mmap=True):
+    """read the sidecar of demPath, with mmap=True the raster is memory-mapped read-only
+
+    Returns
+    --------
+    dem: dict
+        dem dictionary with header and rasterData, None if no sidecar exists
+    """
+
+    dataFile, headerFile = sidecarPaths(demPath)
+    if not (dataFile.is_file() and headerFile.is_file()):
+        return None
+
+    with open(headerFile, "r") as fi:
+        header = json.load(fi)
+    rasterData = np.load(dataFile, mmap_mode=("r" if mmap else None))
+
+    return {"header": header, "rasterData": rasterData}
+
+
+def windowIndices(header, bounds):
+    """return the row (south-up) and column ranges of a raster covering bounds
+
+    Parameters
+    -----------
+    header: dict
+        raster header with ncols, nrows, xllcenter, yllcenter, cellsize
+    bounds: tuple
+        xMin, yMin, xMax, yMax of the window
+
+    Returns
+    --------
+    rows, cols: tuple
+        start and end (exclusive) of the window rows and columns, clipped to the raster
+    """
+
+    xMin, yMin, xMax, yMax = bounds
+    cellsize = header["cellsize"]
+    col0 = max(int(np.floor((xMin - header["xllcenter"]) / cellsize)), 0)
+    col1 = min(int(np.ceil((xMax - header["xllcenter"]) / cellsize)) + 1, header["ncols"])
+    row0 = max(int(np.floor((yMin - header["yllcenter"]) / cellsize)), 0)
+    row1 = min(int(np.ceil((yMax - header["yllcenter"]) / cellsize)) + 1, header["nrows"])
+
+    return (row0, max(row1, row0)), (col0, max(col1, col0))
+
+
+def windowHeader(header, rows, cols):
+    """return the header of the window rows, cols of a raster"""
+
+    windowHead = dict(header)
+    windowHead["xllcenter"] = header["xllcenter"] + cols[0] * header["cellsize"]
+    windowHead["yllcenter"] = header["yllcenter"] + rows[0] * header["cellsize"]
+    windowHead["ncols"] = cols[1] - cols[0]
+    windowHead["nrows"] = rows[1] - rows[0]
+
+    return windowHead
+
+
+def cropDem(dem, bounds):
+    """return the part of dem covering bounds, rasterData is a view (of the memory-mapped sidecar)"""
+
+    rows, cols = windowIndices(dem["header"], bounds)
+    return {
+        "header": windowHeader(dem["header"], rows, cols),
+        "rasterData": dem["rasterData"][rows[0]:rows[1], cols[0]:cols[1]],
+    }
+
+
+def readGeoTiff(tifPath, bounds=None, dtype=np.float64):
+    """read a (tiled) GeoTIFF DEM, only the tiles covering bounds are read and decompressed
+
+    Parameters
+    -----------
+    tifPath: pathlib path or str
+        path to GeoTIFF DEM
+    bounds: tuple
+        optional - xMin, yMin, xMax, yMax of the window to read, default whole raster
+    dtype: numpy dtype
+        data type of rasterData, None: smallest float type holding the values of the raster band
+
+    Returns
+    --------
+    dem: dict
+        dem dictionary with header and rasterData (row 0 is the southern row, nodata as nan)
+    """
+
+    try:
+        from osgeo import gdal
+    except ImportError as error:
+        message = "Reading GeoTIFF DEMs requires gdal, cannot read %s" % tifPath
+        log.error(message)
+        raise ImportError(message) from error
+
+    ds = gdal.Open(str(tifPath))
+    band = ds.GetRasterBand(1)
+    xOrigin, cellsize, _, yOrigin, _, _ = ds.GetGeoTransform()
+    header = {
+        "ncols": ds.RasterXSize,
+        "nrows": ds.RasterYSize,
+        "xllcenter": xOrigin + cellsize / 2.0,
+        "yllcenter": yOrigin - ds.RasterYSize * cellsize + cellsize / 2.0,
+        "cellsize": cellsize,
+        "nodata_value": np.nan,
+    }
+
+    if bounds is None:
+        rows, cols = (0, header["nrows"]), (0, header["ncols"])
+    else:
+        rows, cols = windowIndices(header, bounds)
+    # gdal rows start in the north
+    rasterData = band.ReadAsArray(cols[0], header["nrows"] - rows[1], cols[1] - cols[0], rows[1] - rows[0])
+    if dtype is None:
+        dtype = np.result_type(rasterData.dtype, np.float32)
+    rasterData = np.flipud(rasterData.astype(dtype))
+    noData = band.GetNoDataValue()
+    if noData is not None:
+        rasterData[rasterData == noData] = np.nan
+    ds = None
+
+    return {"header": windowHeader(header, rows, cols), "rasterData": rasterData}
+
+
+def readDem(demPath, useSidecar=True, bounds=None):
+    """read a DEM, from its binary sidecar if available and up to date
+
+    the DEM is looked up as binary sidecar (.npy + .json, written on export or converted from the .asc file),
+    .asc file or GeoTIFF (.tif). If useSidecar is True and the sidecar is missing or older than the .asc file,
+    the .asc file is parsed and converted to a sidecar for the next runs
+
+    Parameters
+    -----------
+    demPath: pathlib path or str
+        path to DEM, the suffix is replaced to find the available formats
+    useSidecar: bool
+        read from and write to the binary sidecar
+    bounds: tuple
+        optional - xMin, yMin, xMax, yMax; only the part of the DEM covering bounds is returned
+
+    Returns
+    --------
+    dem: dict
+        dem dictionary with header and rasterData
+    """
+
+    demPath = pathlib.Path(demPath)
+    ascPath = demPath.with_suffix(".asc")
+    tifPath = demPath.with_suffix(".tif")
+
+    dataFile, headerFile = sidecarPaths(demPath)
+    sidecarValid = dataFile.is_file() and headerFile.is_file()
+    if sidecarValid and ascPath.is_file():
+        sidecarValid = useSidecar and (
+            min(dataFile.stat().st_mtime, headerFile.stat().st_mtime) >= ascPath.stat().st_mtime
+        )
+
+    if sidecarValid:
+        dem = readSidecar(demPath)
+    elif ascPath.is_file():
+        dem = IOf.readRaster(ascPath)
+        if useSidecar:
+            try:
+                writeSidecar(demPath, dem)
+            except OSError as error:
+                log.warning("Cannot write DEM sidecar for %s: %s" % (demPath, error))
+    elif tifPath.is_file():
+        return readGeoTiff(tifPath, bounds=bounds)
+    else:
+        message = "No DEM found for %s (.npy, .asc or .tif)" % demPath
+        log.error(message)
+        raise FileNotFoundError(message)
+
+    if bounds is not None:
+        dem = cropDem(dem, bounds)
+
+    return dem
+
+
+class DemCache:
+    """DEMs and prepared thalweg profiles of the paths, loaded once per run
+
+    DEMs are cached by path id, prepared profiles (resampled thalweg with z and s from gT.prepareLine) by
+    path id and resample distance - all events of a path share the path geometry and DEM. Cached arrays are
+    read-only, getAvaPath returns a new dict per call, so stages can replace entries but not modify the
+    shared arrays in place
+
+    Parameters
+    -----------
+    demDir: pathlib path or str
+        directory of the exported DEMs, with one subdirectory per path name
+    useSidecar: bool
+        read DEMs from binary sidecars, converting the .asc files on first use
+    windowBuffer: float
+        optional - only load the part of the DEM within windowBuffer (coordinate system units) around the
+        thalweg of the path, None: load whole DEM
+    """
+
+    def __init__(self, demDir=pathlib.Path("data", "amaExports"), useSidecar=True, windowBuffer=None):
+        self.demDir = pathlib.Path(demDir)
+        self.useSidecar = useSidecar
+        self.windowBuffer = windowBuffer
+        self.dems = {}
+        self.avaPaths = {}
+        self.stats = {"demHits": 0, "demMisses": 0, "pathHits": 0, "pathMisses": 0}
+
+    def demPath(self, pathName, pathId):
+        """return the path to the DEM of a path"""
+
+        return self.demDir / pathName / ("dem_path_%d.asc" % pathId)
+
+    def getDem(self, pathName, pathId, bounds=None):
+        """return the DEM of a path, read from disk on first use
+
+        bounds (xMin, yMin, xMax, yMax) restricts the DEM to a window and is only used when the DEM is read
+        """
+
+        pathId = int(pathId)
+        if pathId in self.dems:
+            self.stats["demHits"] = self.stats["demHits"] + 1
+            return self.dems[pathId]
+
+        self.stats["demMisses"] = self.stats["demMisses"] + 1
+        dem = readDem(self.demPath(pathName, pathId), useSidecar=self.useSidecar, bounds=bounds)
+        self.dems[pathId] = dem
+
+        return dem
+
+    def getAvaPath(self, pathName, pathId, x, y, resDist):
+        """return the thalweg x, y resampled to resDist and projected on the DEM of the path
+
+        Parameters
+        -----------
+        pathName: str
+            name of path
+        pathId: int
+            id of path
+        x, y: numpy array
+            coordinates of thalweg, only used if the profile is not cached yet
+        resDist: float
+            resampling distance
+
+        Returns
+        --------
+        avaPath: dict
+            x, y, z, s of the resampled thalweg as read-only arrays
+        """
+
+        key = (int(pathId), float(resDist))
+        if key in self.avaPaths:
+            self.stats["pathHits"] = self.stats["pathHits"] + 1
+            return dict(self.avaPaths[key])
+
+        self.stats["pathMisses"] = self.stats["pathMisses"] + 1
+        x = np.asarray(x)
+        y = np.asarray(y)
+        bounds = None
+        if self.windowBuffer is not None:
+            # all events of a path share the thalweg, so the window fits every event of the path
+            bounds = (
+                x.min() - self.windowBuffer,
+                y.min() - self.windowBuffer,
+                x.max() + self.windowBuffer,
+                y.max() + self.windowBuffer,
+            )
+        dem = self.getDem(pathName, pathId, bounds=bounds)
+        avaPath, _ = gT.prepareLine(dem, {"x": x, "y": y}, distance=resDist, Point=None)
+        avaPath = {name: np.asarray(avaPath[name]) for name in ["x", "y", "z", "s"]}
+        for values in avaPath.values():
+            values.setflags(write=False)
+        self.avaPaths[key] = avaPath
+
+        return dict(avaPath)
+
+    def getAvaPaths(self, dbData, thalwegs, resDist):
+        """return the prepared profiles (x, y, z, s) of all events of dbData as path store
+
+        Parameters
+        -----------
+        dbData: pandas dataframe
+            dataframe with path_name and path_id of each event
+        thalwegs: PathStore
+            thalweg (x, y) of each event
+        resDist: float
+            resampling distance
+        """
+
+        avaPaths = []
+        for index, row in dbData.iterrows():
+            thalweg = thalwegs.get(index)
+            avaPaths.append(self.getAvaPath(row["path_name"], row["path_id"], thalweg["x"], thalweg["y"], resDist))
+
+        return pS.PathStore.fromArrays(dbData.index, avaPaths, fieldNames=["x", "y", "z", "s"])
+
+    def logStats(self):
+        """log the number of cache hits and misses"""
+
+        log.info(
+            "DEM cache: %d DEMs read, %d reused; profiles: %d prepared, %d reused"
+            % (self.stats["demMisses"], self.stats["demHits"], self.stats["pathMisses"], self.stats["pathHits"])
+        )
@@ -0,0 +1,123 @@
+""" manifest of exported files, stored as JSON lines, used to resume interrupted exports and to skip unchanged items """
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+
+# create local logger
+log = logging.getLogger(__name__)
+
+
+def fileChecksum(filePath):
+    """ return the sha256 checksum of a file """
+
+    sha = hashlib.sha256()
+    with open(filePath, 'rb') as fi:
+        for block in iter(lambda: fi.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class ExportManifest:
+    """ record of exported items (rasters, event geometries) with their output files and source version
+
+        every recorded item is appended as one JSON line to the manifest file, the last line of an item wins.
+        An interrupted export therefore keeps all items completed before the interruption; a truncated last
+        line is ignored when loading
+
+        Parameters
+        -----------
+        manifestFile: pathlib path or str
+            path to manifest file (JSON lines)
+        verifyChecksums: bool
+            if True, isCurrent also compares the sha256 checksums of the files, otherwise only their sizes
+    """
+
+    def __init__(self, manifestFile, verifyChecksums=False):
+        self.manifestFile = pathlib.Path(manifestFile)
+        self.verifyChecksums = verifyChecksums
+        self.entries = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """ read all entries of the manifest file """
+
+        self.entries = {}
+        if not self.manifestFile.is_file():
+            return
+        with open(self.manifestFile, 'r') as fi:
+            for line in fi:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    log.warning('Skipping incomplete line in export manifest %s' % self.manifestFile)
+                    continue
+                self.entries[entry['item']] = entry
+        log.info('Read %d items from export manifest %s' % (len(self.entries), self.manifestFile))
+
+    def isCurrent(self, item, version):
+        """ return True if item was exported from source version and all its files are unchanged on disk
+
+            Parameters
+            -----------
+            item: str
+                key of the exported item, e.g. raster/path_1 or geometry/12/geom_event_ln
+            version: str
+                version of the source data, e.g. a hash computed by the database
+        """
+
+        entry = self.entries.get(item)
+        if entry is None or entry['version'] != version:
+            return False
+        for fileInfo in entry['files']:
+            filePath = pathlib.Path(fileInfo['path'])
+            if not filePath.is_file() or filePath.stat().st_size != fileInfo['size']:
+                return False
+            if self.verifyChecksums and fileChecksum(filePath) != fileInfo['sha256']:
+                return False
+        return True
+
+    def record(self, item, version, files, checksums=None):
+        """ record item as exported from source version to files
+
+            Parameters
+            -----------
+            item: str
+                key of the exported item
+            version: str
+                version of the source data
+            files: list
+                paths of all files written for the item
+            checksums: dict
+                optional - sha256 checksum by file path, computed for files not in checksums
+        """
+
+        checksums = {} if checksums is None else checksums
+        fileInfos = []
+        for filePath in files:
+            filePath = str(filePath)
+            fileInfos.append({'path': filePath, 'size': os.path.getsize(filePath),
+                'sha256': checksums.get(filePath) or fileChecksum(filePath)})
+        entry = {'item': item, 'version': version, 'files': fileInfos, 'exported': time.time()}
+
+        with self._lock:
+            self.entries[item] = entry
+            self.manifestFile.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.manifestFile, 'a') as fi:
+                fi.write(json.dumps(entry) + '\n')
+                fi.flush()
+
+    def compact(self):
+        """ rewrite the manifest file with one line per item """
+
+        with self._lock:
+            tmpFile = self.manifestFile.with_name(self.manifestFile.name + '.tmp')
+            with open(tmpFile, 'w') as fi:
+                for entry in self.entries.values():
+                    fi.write(json.dumps(entry) + '\n')
+            os.replace(tmpFile, self.manifestFile)
@@ -9,59 +9,92 @@ Created on Mon Aug 19 10:45:59 2024
     Fitting each AMA thalweg within the dataframe according to the choosen fit method
 """
 
-import math
-import pathlib
+import logging
 
-import avaframe.in2Trans.ascUtils as IOf
-import avaframe.in3Utils.geoTrans as gT
 import numpy as np
-from shapely import get_coordinates
-from shapely.geometry import Point, LineString
-from sklearn.metrics import r2_score
+from shapely.geometry import Point
 
 import amaUtilities as aU
+import demCache as dC
+import pathStore as pS
+
+# create local logger
+log = logging.getLogger(__name__)
+
+
+def fitThalweg(
+    dbData,
+    slope1,
+    slope2,
+    resDist,
+    projstr,
+    dsMin,
+    cfg,
+    fitmethod="all",
+    pathStores=None,
+    demCache=None,
+    pointIndex=None,
+    func=None,
+):
+    """fit a parabola to the thalweg profile of each event
+
+    the thalweg is read from pathStores["thalweg"] if available, otherwise from the resampled path line column;
+    the profiles avaPathLong, avaPath (x, y, z, s) and curveFitLong, curveFit (s, z) are added to pathStores,
+    or, if pathStores is None, added to dbData as line columns; DEMs and resampled thalwegs are taken from
+    demCache, a new cache is created if demCache is None; the origin is read from pointIndex (pS.locatePoints
+    on the resampled thalwegs), located here if pointIndex is None; the parabola (aU.funcParabola) is fitted to
+    all events at once by linear least squares, other profile models func are fitted per event with curve_fit
+    """
+
+    if demCache is None:
+        demCache = dC.DemCache()
+    thalwegs = pS.getStore(
+        pathStores, "thalweg", dbData, column="geom_path_ln3d_%s_resampled" % projstr
+    )
+    originColumn = "geom_origin_pt3d_%s_snapped" % projstr
+    if pointIndex is None:
+        pointIndex = pS.locatePoints(
+            demCache.getAvaPaths(dbData, thalwegs, resDist), dbData, [originColumn]
+        )
+    # events without origin (index -1) get empty profiles and no fit
+    origins = pointIndex.loc[dbData.index, "%s_idx" % originColumn].to_numpy()
+    missingOrigin = origins < 0
+    if missingOrigin.any():
+        log.warning(
+            "Missing origin, no fit for events: %s" % list(dbData.index[missingOrigin])
+        )
+    # beta angles for crop with thalweg (Dmax)
+    betaAngles = [float(angle) for angle in cfg["MAIN"]["betaAngles"].split("|")]
+    profiles = {"avaPathLong": [], "avaPath": [], "curveFitLong": [], "curveFit": []}
+    uncertainties = []
 
+    for position, (index, row) in enumerate(dbData.iterrows()):
 
-def fitThalweg(dbData, slope1, slope2, resDist, projstr, dsMin, cfg, fitmethod="all"):
-
-    for index, row in dbData.iterrows():
+        origin = int(origins[position])
+        dbData.loc[index, "origin"] = origin
+        if missingOrigin[position]:
+            emptyPath = {key: np.empty(0) for key in ["x", "y", "z", "s"]}
+            profiles["avaPathLong"].append(emptyPath)
+            profiles["avaPath"].append(emptyPath)
+            uncertainties.append(np.empty(0))
+            continue
 
         # coordinates for the whole thalweg profile, extending the O-point
-        x = get_coordinates(row["geom_path_ln3d_%s_resampled" % projstr])[:, 0]
-        y = get_coordinates(row["geom_path_ln3d_%s_resampled" % projstr])[:, 1]
+        thalweg = thalwegs.get(index)
+        x = thalweg["x"]
+        y = thalweg["y"]
 
-        # fetch DEM
-        demPath = pathlib.Path(
-            "data", "amaExports", row["path_name"], ("dem_path_%d.asc" % row["path_id"])
-        )
-        dem = IOf.readRaster(demPath)
-
-        # setup avaPath to get parabolic fit
-        avaPath = {"x": x, "y": y}
+        # setup avaPath to get parabolic fit - DEM and resampled thalweg are shared with the other stages
         # first resample path and make smoother - TODO check if required - double resampling check line 56
-        avaPath, projPoint = gT.prepareLine(dem, avaPath, distance=resDist, Point=None)
+        avaPath = demCache.getAvaPath(row["path_name"], row["path_id"], x, y, resDist)
 
         # TODO: is this resampling to resamplePathFit distance required?
-        # it also involves finding the index of the points again on the newly resampled path line
-        # crop at origin point - find id of origin on avapath
-        oPoint = {
-            "x": [row["geom_origin_pt3d_%s_snapped" % projstr].x],
-            "y": [row["geom_origin_pt3d_%s_snapped" % projstr].y],
-        }
-        origin = gT.findClosestPoint(avaPath["x"], avaPath["y"], oPoint)
-        dbData.loc[index, "origin"] = origin
-
+        # crop at origin point - origin is the id of origin on avapath
         # subtract the resolution * the index of origin from the distances, to set origin to distance 0
-        avaPath["s"] -= resDist * int(origin)
+        # avaPath arrays are shared via demCache - do not modify in place
+        avaPath["s"] = avaPath["s"] - resDist * int(origin)
         avaPathLong = avaPath.copy()
 
-        dbData.at[index, "geom_avaPathLong_s_z"] = LineString(
-            list(zip(avaPathLong["s"], avaPathLong["z"]))
-        )
-        dbData.at[index, "geom_avaPathLong_ln3d_%s_resampled" % projstr] = LineString(
-            list(zip(avaPathLong["x"], avaPathLong["y"], avaPathLong["z"]))
-        )
-
         if fitmethod == "all":
 
             avaPath["x"] = avaPath["x"][origin:]
@@ -79,34 +112,11 @@ def fitThalweg(dbData, slope1, slope2, resDist, projstr, dsMin, cfg, fitmethod="
 
         if fitmethod == "Dmax":
 
-            # Crop before origin, to avoid intersection with crop line before that point
-            avaPathCrop = avaPath
-
-            # beta angles for crop with thalweg (Dmax)
-            m6 = math.tan(math.radians(cfg["MAIN"].getfloat("m6")))
-            m5 = math.tan(math.radians(cfg["MAIN"].getfloat("m5")))
-            m4 = math.tan(math.radians(cfg["MAIN"].getfloat("m4")))
-            m3 = math.tan(math.radians(cfg["MAIN"].getfloat("m3")))
-            m2 = math.tan(math.radians(cfg["MAIN"].getfloat("m2")))
-            gradients = [m6, m5, m4, m3, m2]
-
-            for m in gradients:
-                d = aU.calculatetravelLine(m, avaPathCrop, origin)
-                intersec = d.intersection(
-                    LineString(list(zip(avaPath["s"], avaPath["z"])))
-                )
-
-                # TODO: why index of 10?
-                if intersec.geom_type == "MultiPoint":
-                    endPointID = aU.createCutOff(d, intersec)
-                    if endPointID > 10:
-                        break
-
-                else:
-                    continue
-
-                if endPointID <= 10:
-                    endPointID = len(avaPath["s"])
+            # crop at the intersection with the travel line of the first beta angle intersecting
+            # the profile more than 10 points beyond the origin
+            endPointID = aU.findDmaxCutOff(
+                avaPath["s"], avaPath["z"], origin, betaAngles
+            )
 
             avaPath["x"] = avaPath["x"][origin:]
             avaPath["y"] = avaPath["y"][origin:]
@@ -118,30 +128,59 @@ def fitThalweg(dbData, slope1, slope2, resDist, projstr, dsMin, cfg, fitmethod="
             avaPath["z"] = avaPath["z"][:endPointID]
             avaPath["s"] = avaPath["s"][:endPointID]
 
-        # Do a fit Curve Parabola Fit
-        point = {
-            "x": row["geom_origin_pt3d_epsg:31287_snapped"].xy[0],
-            "y": row["geom_origin_pt3d_%s_snapped" % projstr].xy[1],
-        }
-        restraint = gT.findClosestPoint(avaPath["x"], avaPath["y"], point)
+        # avaPath is cropped at the origin, so the origin (restraint of the fit) is its first point
+        restraint = 0
         uncertainty = np.zeros(len(avaPath["s"])) + 1.0
         uncertainty[restraint] = 0.001
+        uncertainties.append(uncertainty)
 
-        curveProfileLong, curveProfileFit, curvature, b, c = aU.fitCurveParabola(
-            avaPath, avaPathLong, uncertainty
-        )  # NOTICE curveProfile z values = z values from avaProfile, zFit = fitted z Values
+        # Fitted path with s, z coordinates, avapath with x, y, z, s coordinates
+        profiles["avaPathLong"].append(
+            {key: avaPathLong[key] for key in ["x", "y", "z", "s"]}
+        )
+        profiles["avaPath"].append({key: avaPath[key] for key in ["x", "y", "z", "s"]})
+
+    # Do a fit Curve Parabola Fit of all events
+    fitStores = {
+        name: pS.PathStore.fromArrays(
+            dbData.index, profiles[name], fieldNames=["x", "y", "z", "s"]
+        )
+        for name in ["avaPathLong", "avaPath"]
+    }
+    fitPaths = fitStores["avaPath"]
+    if func is None or func is aU.funcParabola:
+        func = aU.funcParabola
+        fitResult = aU.fitParabolas(
+            fitPaths.fields["s"],
+            fitPaths.fields["z"],
+            fitPaths.offsets,
+            np.concatenate(uncertainties + [np.empty(0)]),
+        )
+    else:
+        fitResult = aU.fitCurves(
+            func,
+            fitPaths.fields["s"],
+            fitPaths.fields["z"],
+            fitPaths.offsets,
+            np.concatenate(uncertainties + [np.empty(0)]),
+        )
+    dbData["r_squaredcf"] = fitResult["r2"]
+    dbData["rmse"] = fitResult["rmse"]
+
+    for position, index in enumerate(dbData.index):
+        # NOTICE curveProfile z values = z values from avaProfile, zFit = fitted z Values
+        avaPathLong = fitStores["avaPathLong"].get(index)
+        sFit = fitPaths.get(index)["s"]
+        popt = fitResult["popt"][position]
+        if missingOrigin[position]:
+            profiles["curveFitLong"].append({"s": np.empty(0), "z": np.empty(0)})
+            profiles["curveFit"].append({"s": np.empty(0), "z": np.empty(0)})
+            continue
         curveProfileDictLong = {
-            "s": curveProfileLong["s"],
-            "z": curveProfileLong["zFit"],
+            "s": avaPathLong["s"],
+            "z": func(avaPathLong["s"], *popt),
         }
-        curveProfileDictFit = {"s": curveProfileFit["s"], "z": curveProfileFit["zFit"]}
-
-        r_squaredcf = r2_score(avaPath["z"], curveProfileDictFit["z"])
-        dbData.at[index, "r_squaredcf"] = r_squaredcf
-
-        mse = np.square(np.subtract(avaPath["z"], curveProfileDictFit["z"])).mean()
-        rmse = math.sqrt(mse)
-        dbData.at[index, "rmse"] = rmse
+        curveProfileDictFit = {"s": sFit, "z": func(sFit, *popt)}
 
         # TODO: when is the SOI used? is this still required?
         soi1cf = aU.findAngleInProfile(slope1, avaPathLong, curveProfileDictLong, dsMin)
@@ -159,22 +198,29 @@ def fitThalweg(dbData, slope1, slope2, resDist, projstr, dsMin, cfg, fitmethod="
             )
             dbData.at[index, "soi_%s°_s" % slope2] = soi2cf["s"]
 
-        # Fitted path added with z, s coordinates
-        # Avapath added with x,y,z as well as another column with z, s
-        dbData.at[index, "geom_avaPath_ln3d_%s_resampled" % projstr] = LineString(
-            list(zip(avaPath["x"], avaPath["y"], avaPath["z"]))
-        )
-        dbData.at[index, "avaPath_s_z"] = LineString(
-            list(zip(avaPath["s"], avaPath["z"]))
-        )
-        dbData.at[index, "curveFitLong_s_z"] = LineString(
-            list(zip(curveProfileLong["s"], curveProfileLong["zFit"]))
-        )
-        dbData.at[index, "curveFit_s_z"] = LineString(
-            list(zip(curveProfileDictFit["s"], curveProfileDictFit["z"]))
-        )
-        dbData.at[index, "curvature"] = curvature
-        dbData.at[index, "b"] = b
-        dbData.at[index, "c"] = c
+        profiles["curveFitLong"].append(curveProfileDictLong)
+        profiles["curveFit"].append(curveProfileDictFit)
+
+    dbData["curvature"] = fitResult["curvature"]
+    dbData["b"] = fitResult["b"]
+    dbData["c"] = fitResult["c"]
+    dbData.loc[missingOrigin, ["r_squaredcf", "rmse", "curvature", "b", "c"]] = np.nan
+
+    for name in ["curveFitLong", "curveFit"]:
+        fitStores[name] = pS.PathStore.fromArrays(dbData.index, profiles[name])
+    if pathStores is not None:
+        pathStores.update(fitStores)
+    else:
+        # former layout: profiles as line columns
+        dbData["geom_avaPathLong_s_z"] = fitStores["avaPathLong"].toLines(("s", "z"))
+        dbData["geom_avaPathLong_ln3d_%s_resampled" % projstr] = fitStores[
+            "avaPathLong"
+        ].toLines()
+        dbData["geom_avaPath_ln3d_%s_resampled" % projstr] = fitStores[
+            "avaPath"
+        ].toLines()
+        dbData["avaPath_s_z"] = fitStores["avaPath"].toLines(("s", "z"))
+        dbData["curveFitLong_s_z"] = fitStores["curveFitLong"].toLines(("s", "z"))
+        dbData["curveFit_s_z"] = fitStores["curveFit"].toLines(("s", "z"))
 
     return dbData
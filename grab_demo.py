@@ -3,14 +3,27 @@
 import logging
 import pathlib
 
+import pandas as pd
+
 # local imports
 import amaConnector
+import queryCache as qC
 
 # create local logger
 log = logging.getLogger(__name__)
 
 
-def grabAllComplete(outDir, queryString="select * from event_full", accessfile=pathlib.Path('access.txt')):
+def checkAccessFile(accessfile):
+    """ raise a FileNotFoundError if accessfile does not exist """
+
+    if not accessfile.is_file():
+        message = 'Access file is not a file, check path: %s' % (str(accessfile))
+        log.error(message)
+        raise FileNotFoundError(message)
+
+
+def grabAllComplete(outDir, queryString="select * from event_full", accessfile=pathlib.Path('access.txt'),
+    cfgCache=None):
     """ fetch all event entries of the DB and return a dataFrame with all info for each event
 
         Parameters
@@ -24,6 +37,9 @@ def grabAllComplete(outDir, queryString="select * from event_full", accessfile=p
             optional - path to access file needed to access database
             a csv-file (including header, seperator: ';') with the following parameters: host, port,
             database, username, password
+        cfgCache: configparser section
+            optional - CACHE section of the configuration; if useCache is True, results are stored in
+            outDir/cache and served from there as long as they are valid (cacheTTL, probeQuery)
 
         Returns
         --------
@@ -32,22 +48,151 @@ def grabAllComplete(outDir, queryString="select * from event_full", accessfile=p
     """
 
     # check if accessfile is available
-    if not accessfile.is_file():
-        message = 'Access file is not a file, check path: %s' % (str(accessfile))
-        log.error(message)
-        raise FileNotFoundError(message)
-
-    # connect to DB
-    amaConnect=amaConnector.amaAccess(accessfile)
+    checkAccessFile(accessfile)
 
-    # select all entries according to queryString
-    dbData = amaConnect.query(queryString)
+    # connect to DB and select all entries according to queryString, connections are released afterwards
+    with amaConnector.amaAccess(accessfile) as amaConnect:
+        if cfgCache is not None and cfgCache.getboolean('useCache'):
+            cacheTTL = cfgCache['cacheTTL']
+            amaConnect.enableCache(pathlib.Path(outDir, 'cache'), ttl=(float(cacheTTL) if cacheTTL else None),
+                probeQuery=cfgCache['probeQuery'])
+            if cfgCache.getboolean('invalidateCache'):
+                nRemoved = amaConnect.invalidateCache()
+                log.info('Removed %d cached query results' % nRemoved)
+        dbData = amaConnect.query(queryString)
 
     # throw error if duplicated event id s exist
-    if any(dbData.duplicated(subset=['event_id'])):
-        dbDuplicated = dbData[dbData.duplicated(subset=['event_id'])]
-        message = 'Duplicated event_id in dataset - event_id: %s' % dbDuplicated['event_id'].to_list()
+    checkDuplicatedEvents(dbData)
+
+    return dbData
+
+
+def checkDuplicatedEvents(dbData, idColumn='event_id'):
+    """ raise a ValueError if dbData contains duplicated event ids """
+
+    if any(dbData.duplicated(subset=[idColumn])):
+        dbDuplicated = dbData[dbData.duplicated(subset=[idColumn])]
+        message = 'Duplicated %s in dataset - %s: %s' % (idColumn, idColumn, dbDuplicated[idColumn].to_list())
         log.error(message)
         raise ValueError(message)
 
-    return dbData
+
+def grabAllCompleteChunks(outDir, queryString="select * from event_full", accessfile=pathlib.Path('access.txt'),
+    chunkSize=5000):
+    """ fetch all event entries of the DB chunk-wise using a server-side cursor
+        and yield one dataFrame per chunk - the full table is never held in memory
+
+        the check for duplicated event ids is performed incrementally across all chunks, the error
+        is raised for the first chunk that contains an event_id that has already been seen
+
+        Parameters
+        -----------
+        outDir: pathlib path or str
+            path where data shall be exported to
+        queryString: str
+            command to perform query - which entries of the DB shall be fetched
+            default is select all entries from available events
+        accessfile: pathlib path
+            optional - path to access file needed to access database
+        chunkSize: int
+            maximum number of events per chunk
+
+        Yields
+        --------
+        dbChunk: pandas DF
+            DF with one row per event of the current chunk including all available info on event
+    """
+
+    # check if accessfile is available
+    checkAccessFile(accessfile)
+
+    seenIds = set()
+    with amaConnector.amaAccess(accessfile) as amaConnect:
+        for dbChunk in amaConnect.queryChunks(queryString, chunkSize=chunkSize):
+            # throw error if event ids are duplicated within the chunk or have been found in a previous chunk
+            duplicated = dbChunk.duplicated(subset=['event_id']) | dbChunk['event_id'].isin(seenIds)
+            if any(duplicated):
+                message = 'Duplicated event_id in dataset - event_id: %s' % dbChunk[duplicated]['event_id'].to_list()
+                log.error(message)
+                raise ValueError(message)
+            seenIds.update(dbChunk['event_id'].to_list())
+
+            yield dbChunk
+
+
+def syncIncremental(outDir, queryString="select * from event_full", accessfile=pathlib.Path('access.txt'),
+    syncColumn='updated_at', idColumn='event_id'):
+    """ update the locally stored result of queryString with the events inserted or updated since the last sync
+
+        the dataset and the sync watermark (maximum of syncColumn) are stored per query in outDir/sync;
+        on the first call all events are fetched. Afterwards only rows with syncColumn >= watermark are fetched
+        and replace their local version (by id), events that are no longer returned by the query are removed
+        (id-set diff); rows at the watermark are fetched again, so rows committed later with the same syncColumn
+        value are not missed. Rows with a null syncColumn are only picked up by a full fetch
+
+        Parameters
+        -----------
+        outDir: pathlib path or str
+            path where data shall be exported to
+        queryString: str
+            command to perform query - which entries of the DB shall be fetched
+        accessfile: pathlib path
+            optional - path to access file needed to access database
+        syncColumn: str
+            name of the column holding the insert/update time (or another increasing version) of an event
+        idColumn: str
+            name of the unique event id column
+
+        Returns
+        --------
+        dbData: pandas DF
+            DF with one row per found event including all available info on event
+        syncInfo: dict
+            number of 'new', 'updated' and 'deleted' events fetched in this sync and 'total' number of events
+    """
+
+    # check if accessfile is available
+    checkAccessFile(accessfile)
+
+    syncDir = pathlib.Path(outDir, 'sync')
+    queryString = queryString.strip().rstrip(';')
+    syncMeta = qC.readCacheMeta(syncDir, queryString)
+    dbLocal = None
+    if syncMeta is not None and syncMeta.get('watermark') is not None:
+        dbLocal = qC.readCache(syncDir, queryString)
+
+    with amaConnector.amaAccess(accessfile) as amaConnect:
+        if dbLocal is None:
+            log.info('No previous sync found for query - fetching all events')
+            dbData = amaConnect.query(queryString)
+            checkDuplicatedEvents(dbData, idColumn=idColumn)
+            syncInfo = {'new': len(dbData), 'updated': 0, 'deleted': 0}
+        else:
+            dbDelta = amaConnect.query('select * from (%s) as syncQuery where syncQuery."%s" >= %%(watermark)s'
+                % (queryString, syncColumn), params={'watermark': syncMeta['watermark']})
+            checkDuplicatedEvents(dbDelta, idColumn=idColumn)
+            currentIds = amaConnect.query('select syncQuery."%s" from (%s) as syncQuery' % (idColumn, queryString))
+
+            deleted = ~dbLocal[idColumn].isin(currentIds[idColumn])
+            updated = dbLocal[idColumn].isin(dbDelta[idColumn])
+            # rows at the watermark that are already stored with the same syncColumn value are not counted as updated
+            isNew = ~dbDelta[idColumn].isin(dbLocal[idColumn])
+            unchanged = dbDelta[idColumn].map(dbLocal.set_index(idColumn)[syncColumn]) == dbDelta[syncColumn]
+            syncInfo = {'new': int(isNew.sum()), 'updated': int((~isNew & ~unchanged).sum()),
+                'deleted': int(deleted.sum())}
+
+            # replace updated events, drop deleted ones and append the new ones
+            dbData = pd.concat([dbLocal[~(deleted | updated)], dbDelta], ignore_index=True)
+            checkDuplicatedEvents(dbData, idColumn=idColumn)
+
+    syncInfo['total'] = len(dbData)
+    if len(dbData) > 0 and dbData[syncColumn].notna().any():
+        watermark = str(dbData[syncColumn].max())
+    else:
+        watermark = None if syncMeta is None else syncMeta.get('watermark')
+    qC.writeCache(syncDir, queryString, dbData, extraMeta={'watermark': watermark})
+
+    log.info('Synced events: %d new, %d updated, %d deleted, %d in total' % (syncInfo['new'],
+        syncInfo['updated'], syncInfo['deleted'], syncInfo['total']))
+
+    return dbData, syncInfo
@@ -10,119 +10,208 @@ Created on Tue Aug 20 10:56:31 2024
 Intensity characteristics AMA thalwege
 """
 
-import math
-import pathlib
+import logging
 
-import avaframe.in2Trans.ascUtils as IOf
-import avaframe.in3Utils.geoTrans as gT
 import numpy as np
-from shapely import get_coordinates
 
-
-def intensityCharacteristics(dbData, resDist, cfg):
-
-    for index, row in dbData.iterrows():
-
-        # total length of thalweg
-        x = get_coordinates(
-            row["geom_path_ln3d_%s_resampled" % cfg["MAIN"]["projstr"]]
-        )[:, 0]
-        y = get_coordinates(
-            row["geom_path_ln3d_%s_resampled" % cfg["MAIN"]["projstr"]]
-        )[:, 1]
-
-        # fetch DEM
-        demPath = pathlib.Path(
-            "data", "amaExports", row["path_name"], ("dem_path_%d.asc" % row["path_id"])
+import demCache as dC
+import pathStore as pS
+
+# create local logger
+log = logging.getLogger(__name__)
+
+
+def segmentPositions(store, start, end):
+    """return the buffer positions of the profile parts start:end of all profiles of store
+
+    Returns
+    --------
+    positions: numpy array
+        positions of the selected points in the buffers of store, profile after profile
+    offsets: numpy array
+        start of each selected part in positions plus the total length
+    """
+
+    lengths = np.maximum(end - start, 0)
+    offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+    positions = np.arange(offsets[-1]) + np.repeat(
+        store.offsets[:-1] + start - offsets[:-1], lengths
+    )
+
+    return positions, offsets
+
+
+def intensityProfiles(s, z, offsets, g, density):
+    """compute velocity, pressure and travel time along the origin - deposition part
+    of the thalwegs of all events at once
+
+    Velocity Z(δ) =  Z(O) - Z(S) - S * (Z(O)-Z(D))/S(D), v = √(Z(δ) ∗ 2g), p = v² ρ;
+    the travel time of a step is its length in xyz divided by the mean velocity of the
+    step (by the velocity at the origin for the first step), steps starting at a point
+    with zero velocity are skipped
+
+    Parameters
+    -----------
+    s, z: numpy array
+        distance along thalweg and elevation of all profiles, profile after profile
+    offsets: numpy array
+        start of each profile in s and z plus the total length
+    g: float
+        gravity acceleration
+    density: float
+        density of snow
+
+    Returns
+    --------
+    profiles: dict
+        velocity [m/s], pressure [kPa] and time (cumulative travel time [s]) of each point
+    nSteps: numpy array
+        number of steps with travel time of each profile
+    """
+
+    lengths = np.diff(offsets)
+    nonEmpty = lengths > 0
+    first = offsets[:-1][nonEmpty]
+    last = offsets[1:][nonEmpty] - 1
+    profileIds = np.repeat(np.arange(np.count_nonzero(nonEmpty)), lengths[nonEmpty])
+
+    zO = z[first][profileIds]
+    zD = z[last][profileIds]
+    sD = s[last][profileIds]
+    zdelta = np.abs(zO - z - s * ((zO - zD) / sD))
+    velocity = np.sqrt(zdelta * 2.0 * g)
+    pressure = ((velocity**2.0) * density) / 1000.0
+
+    # travel time of the step from each point to the next point of the profile
+    isFirst = np.zeros(len(s), dtype=bool)
+    isFirst[first] = True
+    isStep = np.ones(len(s), dtype=bool)
+    isStep[last] = False
+    isStep = isStep & (velocity != 0)
+    steps = np.flatnonzero(isStep)
+    meanVelocity = np.where(
+        isFirst[steps],
+        velocity[steps],
+        1 / 2 * (velocity[steps - 1] + velocity[steps]),
+    )
+    stepTime = np.zeros(len(s))
+    stepTime[steps] = (
+        np.sqrt((z[steps + 1] - z[steps]) ** 2 + (s[steps + 1] - s[steps]) ** 2)
+        / meanVelocity
+    )
+
+    # cumulative time at each point, 0 at the origin - running sum over all profiles minus
+    # the sum at the origin of each profile; the last point of a profile has no step
+    timeSum = np.cumsum(stepTime) - stepTime
+    time = timeSum - timeSum[first][profileIds]
+
+    nSteps = np.zeros(len(lengths), dtype=np.int64)
+    nSteps[nonEmpty] = np.add.reduceat(isStep.astype(np.int64), first)
+
+    return {"velocity": velocity, "pressure": pressure, "time": time}, nSteps
+
+
+def intensityCharacteristics(
+    dbData, resDist, cfg, pathStores=None, demCache=None, pointIndex=None
+):
+    """compute maximum velocity, destructiveness and travel time between origin and
+    deposition point of each event
+
+    the thalweg is read from pathStores["thalweg"] if available, otherwise from the
+    resampled path line column; DEMs and resampled thalwegs are taken from demCache,
+    a new cache is created if demCache is None; origin, transit and deposition are
+    read from pointIndex (pS.locatePoints on the resampled thalwegs), located here
+    if pointIndex is None. The profiles s (along the resampled thalweg), velocity,
+    pressure and time from origin to deposition are added to pathStores["intensity"],
+    or, if pathStores is None, added to dbData as s/value line columns
+    """
+
+    if demCache is None:
+        demCache = dC.DemCache()
+    projstr = cfg["MAIN"]["projstr"]
+    g = cfg["MAIN"].getfloat("g")
+    density = cfg["MAIN"].getfloat("density")
+    thalwegs = pS.getStore(
+        pathStores,
+        "thalweg",
+        dbData,
+        column="geom_path_ln3d_%s_resampled" % projstr,
+    )
+    pointColumns = [
+        "geom_origin_pt3d_%s_snapped" % projstr,
+        "geom_transit_pt3d_%s_snapped" % projstr,
+        "geom_runout_pt3d_%s_snapped" % projstr,
+    ]
+    # DEMs and resampled thalwegs are shared with the other stages
+    avaPaths = demCache.getAvaPaths(dbData, thalwegs, resDist)
+    if pointIndex is None:
+        pointIndex = pS.locatePoints(avaPaths, dbData, pointColumns)
+
+    # index of origin, transit and deposition point on avaPath
+    origin, transit, depo = [
+        pointIndex.loc[dbData.index, "%s_idx" % column].to_numpy()
+        for column in pointColumns
+    ]
+    dbData["depoID"] = depo.astype(float)
+    dbData["transitID"] = transit.astype(float)
+    dbData["origID"] = origin.astype(float)
+
+    # events without origin or deposition point (index -1) or with the origin not before
+    # the deposition point get an empty profile
+    invalid = (origin < 0) | (depo < 0) | (origin >= depo)
+    if invalid.any():
+        log.warning(
+            "Missing origin or deposition point or origin not before deposition point "
+            "for events: %s" % list(dbData.index[invalid])
+        )
+    start = np.where(invalid, 0, origin)
+    end = np.where(invalid, 0, depo)
+
+    # origin to deposition part of all thalwegs
+    positions, offsets = segmentPositions(avaPaths, start, end)
+    s = avaPaths.fields["s"][positions]
+    z = avaPaths.fields["z"][positions]
+    profiles, nSteps = intensityProfiles(s, z, offsets, g, density)
+
+    nonEmpty = np.diff(offsets) > 0
+    if not (nonEmpty | invalid).all():
+        log.warning(
+            "No thalweg between origin and deposition point for events: %s"
+            % list(dbData.index[~(nonEmpty | invalid)])
+        )
+    velocityMax = np.full(len(dbData), np.nan)
+    pressureMax = np.full(len(dbData), np.nan)
+    if nonEmpty.any():
+        velocityMax[nonEmpty] = np.maximum.reduceat(
+            profiles["velocity"], offsets[:-1][nonEmpty]
+        )
+        pressureMax[nonEmpty] = np.maximum.reduceat(
+            profiles["pressure"], offsets[:-1][nonEmpty]
         )
-        dem = IOf.readRaster(demPath)
-
-        # setup avaPath to get parabolic fit
-        avaPath = {"x": x, "y": y}
-        # first resample path and make smoother - TODO check if required - double resampling check line 56
-        avaPath, projPoint = gT.prepareLine(dem, avaPath, distance=resDist, Point=None)
-
-        # TODO: is this resampling to resamplePathFit distance required?
-        # it also involves finding the index of the points again on the newly resampled path line
-        opoint = {
-            "x": row["geom_origin_pt3d_%s_snapped" % cfg["MAIN"]["projstr"]].xy[0],
-            "y": row["geom_origin_pt3d_%s_snapped" % cfg["MAIN"]["projstr"]].xy[1],
-        }
-        origin = gT.findClosestPoint(avaPath["x"], avaPath["y"], opoint)
-
-        tpoint = {
-            "x": row["geom_transit_pt3d_%s_snapped" % cfg["MAIN"]["projstr"]].xy[0],
-            "y": row["geom_transit_pt3d_%s_snapped" % cfg["MAIN"]["projstr"]].xy[1],
-        }
-        transit = gT.findClosestPoint(avaPath["x"], avaPath["y"], tpoint)
-
-        dpoint = {
-            "x": row["geom_runout_pt3d_%s_snapped" % cfg["MAIN"]["projstr"]].xy[0],
-            "y": row["geom_runout_pt3d_%s_snapped" % cfg["MAIN"]["projstr"]].xy[1],
-        }
-        depo = gT.findClosestPoint(avaPath["x"], avaPath["y"], dpoint)
-
-        dbData.at[index, "depoID"] = depo
-        dbData.at[index, "transitID"] = transit
-        dbData.at[index, "origID"] = origin
-
-        # Velocity Z(δ) =  Z(O) - Z(S) - S * (Z(O)-Z(Min))/S(Min)
-        # Vmax = √(Z(δ)max ∗2g)
-
-        sxy = avaPath["s"][origin:depo]
-        z = avaPath["z"][origin:depo]
-        ds = np.diff(sxy)
-        dz = np.diff(z)
-
-        zO = z[0]
-        zD = z[-1]
-        sD = sxy[-1]
-
-        velocities_kmh = []
-        velocities_ms = []
-        velocities_kPa = []
-        times = []
-
-        for i, dist in enumerate(sxy):
-
-            zdelta = abs(zO - z[i] - sxy[i] * ((zO - zD) / sD))
-            veloc = math.sqrt(zdelta * 2.0 * cfg["MAIN"].getfloat("g"))
-            velocities_ms.append(veloc)
-            velocities_kmh.append(veloc * 3.6)
-            velocities_kPa.append(
-                ((veloc**2.0) * cfg["MAIN"].getfloat("density")) / 1000.0
-            )
-
-            if i < len(dz):
-                if veloc == 0:
-                    continue
-                else:
-                    if len(velocities_ms) > 1:
-                        v1 = velocities_ms[-1]
-                        v2 = velocities_ms[-2]
-                        mv = 1 / 2 * (v2 + v1)
-                        dsxyz = math.sqrt(dz[i] ** 2 + ds[i] ** 2)
-                        time = dsxyz / mv
-                        times.append(time)
-
-                    else:
-                        dsxyz = math.sqrt(dz[i] ** 2 + ds[i] ** 2)
-                        time = dsxyz / veloc
-                        times.append(time)
-
-        cumTimes = np.cumsum(times)
-
-        dbData.at[index, "velocitiesMax_km/h"] = max(velocities_kmh)
-        dbData.at[index, "velocitiesMax_m/s"] = max(velocities_ms)
-        dbData.at[index, "destructivnessMax_kPa"] = max(velocities_kPa)
-
-        """
-        dbData.at[index,'velocitiesT_km/h'] = velocities_kmh[transit-1]
-        dbData.at[index,'velocitiesT_m/s'] = velocities_ms[transit-1]
-        dbData.at[index,'destructivnessT_kPa'] = velocities_kPa[transit]
-        """
-
-        if len(cumTimes) > 1:
-            dbData.at[index, "times(s)"] = cumTimes[-1]
+    dbData["velocitiesMax_km/h"] = velocityMax * 3.6
+    dbData["velocitiesMax_m/s"] = velocityMax
+    dbData["destructivnessMax_kPa"] = pressureMax
+
+    """
+    dbData.at[index,'velocitiesT_km/h'] = velocities_kmh[transit-1]
+    dbData.at[index,'velocitiesT_m/s'] = velocities_ms[transit-1]
+    dbData.at[index,'destructivnessT_kPa'] = velocities_kPa[transit]
+    """
+
+    # travel time only if at least two steps
+    hasTime = nSteps > 1
+    if hasTime.any():
+        dbData.loc[hasTime, "times(s)"] = profiles["time"][offsets[1:][hasTime] - 1]
+    if invalid.any():
+        dbData.loc[invalid, "times(s)"] = np.nan
+
+    intensityStore = pS.PathStore(dbData.index, offsets, dict(s=s, **profiles))
+    if pathStores is not None:
+        pathStores["intensity"] = intensityStore
+    else:
+        # former layout: profiles as line columns
+        dbData["velocity_s_v"] = intensityStore.toLines(("s", "velocity"))
+        dbData["pressure_s_p"] = intensityStore.toLines(("s", "pressure"))
+        dbData["time_s_t"] = intensityStore.toLines(("s", "time"))
 
     return dbData
@@ -0,0 +1,282 @@
+"""
+    Column-oriented store of path profiles (thalwegs, s/z profiles, fits) as ragged arrays
+"""
+
+import json
+import logging
+import pathlib
+
+import numpy as np
+import pandas as pd
+import shapely
+
+# create local logger
+log = logging.getLogger(__name__)
+
+
+class PathStore:
+    """ragged array store of one profile per event
+
+    all profiles share flat float64 buffers per field (e.g. x, y, z, s); the profile of the i-th event
+    spans offsets[i]:offsets[i+1] of every buffer. Profiles are returned as views into the buffers (no copies),
+    so the same arrays can be shared between analysis stages and buffers can be memory-mapped from disk
+
+    Parameters
+    -----------
+    keys: list or pandas index
+        one key per event, typically the index of the event dataframe
+    offsets: numpy array
+        start of each profile in the buffers plus the total length (len(keys) + 1 entries)
+    fields: dict
+        flat float64 buffer per field name
+    """
+
+    def __init__(self, keys, offsets, fields):
+        self.keys = pd.Index(keys)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.fields = {name: np.asarray(values, dtype=np.float64) for name, values in fields.items()}
+
+        if len(self.offsets) != len(self.keys) + 1:
+            message = "PathStore needs len(keys) + 1 offsets, got %d keys and %d offsets" % (
+                len(self.keys),
+                len(self.offsets),
+            )
+            log.error(message)
+            raise ValueError(message)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def lengths(self):
+        """return the number of points of each profile"""
+        return np.diff(self.offsets)
+
+    def get(self, key):
+        """return the profile of key as dict of array views, one entry per field"""
+        position = self.keys.get_loc(key)
+        start, end = self.offsets[position], self.offsets[position + 1]
+        return {name: values[start:end] for name, values in self.fields.items()}
+
+    __getitem__ = get
+
+    def eventIds(self):
+        """return the position of the profile each buffer entry belongs to"""
+        return np.repeat(np.arange(len(self.keys)), self.lengths())
+
+    def abscissa(self):
+        """return the distance along the profile (xy plane) of every buffer entry, the s field if available"""
+
+        if "s" in self.fields:
+            return self.fields["s"]
+
+        x = self.fields["x"]
+        y = self.fields["y"]
+        if len(x) == 0:
+            return np.empty(0)
+        s = np.concatenate([[0.0], np.cumsum(np.hypot(np.diff(x), np.diff(y)))])
+        starts = np.minimum(self.offsets[:-1], len(s) - 1)
+        return s - np.repeat(s[starts], self.lengths())
+
+    def closestIndex(self, x, y):
+        """return the index of the point of each profile closest to x[i], y[i] (xy plane)
+
+        the nearest points of all profiles are found in one pass over the buffers, ties are resolved
+        to the first point as in gT.findClosestPoint; -1 for nan coordinates and empty profiles
+        """
+
+        lengths = self.lengths()
+        indices = np.full(len(self), -1, dtype=np.int64)
+        dist = (self.fields["x"] - np.repeat(x, lengths)) ** 2 + (self.fields["y"] - np.repeat(y, lengths)) ** 2
+        dist[~np.isfinite(dist)] = np.inf
+
+        nonEmpty = lengths > 0
+        if not nonEmpty.any():
+            return indices
+        minDist = np.full(len(self), np.inf)
+        minDist[nonEmpty] = np.minimum.reduceat(dist, self.offsets[:-1][nonEmpty])
+
+        positions = np.flatnonzero((dist == np.repeat(minDist, lengths)) & np.isfinite(dist))
+        profiles, first = np.unique(self.eventIds()[positions], return_index=True)
+        indices[profiles] = positions[first] - self.offsets[profiles]
+
+        return indices
+
+    @classmethod
+    def fromArrays(cls, keys, profiles, fieldNames=None):
+        """create a store from one dict of equally long arrays per key
+
+        Parameters
+        -----------
+        keys: list or pandas index
+            one key per profile
+        profiles: list
+            dicts of arrays (e.g. avaPath dicts with x, y, z, s); None for missing profiles
+        fieldNames: list
+            optional - fields to store, default all fields of the first available profile
+        """
+
+        if fieldNames is None:
+            fieldNames = next((list(profile.keys()) for profile in profiles if profile is not None), [])
+        profiles = [profile if profile is not None else {name: [] for name in fieldNames} for profile in profiles]
+
+        lengths = [len(profile[fieldNames[0]]) if fieldNames else 0 for profile in profiles]
+        offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+        fields = {
+            name: np.concatenate([np.asarray(profile[name], dtype=np.float64) for profile in profiles] + [np.empty(0)])
+            for name in fieldNames
+        }
+
+        return cls(keys, offsets, fields)
+
+    @classmethod
+    def fromLines(cls, keys, lines, fieldNames=("x", "y", "z")):
+        """create a store from shapely lines, coordinates are stored in the order of fieldNames
+
+        use fieldNames=("s", "z") for lines holding a profile in s, z coordinates
+        """
+
+        lines = np.asarray(lines, dtype=object)
+        coords, index = shapely.get_coordinates(lines, include_z=(len(fieldNames) > 2), return_index=True)
+        lengths = np.bincount(index, minlength=len(lines))
+        offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+        fields = {name: np.ascontiguousarray(coords[:, i]) for i, name in enumerate(fieldNames)}
+
+        return cls(keys, offsets, fields)
+
+    def toLines(self, fieldNames=("x", "y", "z")):
+        """return one shapely line per key built from fieldNames, e.g. ("s", "z") for s/z profiles"""
+
+        coords = np.column_stack([self.fields[name] for name in fieldNames])
+        lengths = self.lengths()
+        lines = np.full(len(self.keys), None, dtype=object)
+
+        # profiles with less than two points cannot be represented as line
+        valid = lengths > 1
+        if valid.any():
+            pointMask = np.repeat(valid, lengths)
+            indices = np.repeat(np.arange(np.count_nonzero(valid)), lengths[valid])
+            lines[valid] = shapely.linestrings(coords[pointMask], indices=indices)
+
+        return lines
+
+    def subset(self, keys):
+        """return a new store with the profiles of keys (copied into new buffers)"""
+
+        return PathStore.fromArrays(keys, [self.get(key) for key in keys], fieldNames=list(self.fields))
+
+    @classmethod
+    def concat(cls, stores):
+        """concatenate stores with the same fields into one store"""
+
+        stores = [store for store in stores if store is not None]
+        fieldNames = list(stores[0].fields)
+        keys = pd.Index(np.concatenate([np.asarray(store.keys) for store in stores]))
+        lengths = np.concatenate([store.lengths() for store in stores])
+        offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+        fields = {name: np.concatenate([store.fields[name] for store in stores]) for name in fieldNames}
+
+        return cls(keys, offsets, fields)
+
+    def save(self, dirPath):
+        """save buffers, offsets and keys as .npy files to dirPath"""
+
+        dirPath = pathlib.Path(dirPath)
+        dirPath.mkdir(parents=True, exist_ok=True)
+        np.save(dirPath / "offsets.npy", self.offsets)
+        np.save(dirPath / "keys.npy", np.asarray(self.keys), allow_pickle=(self.keys.dtype == object))
+        for name, values in self.fields.items():
+            np.save(dirPath / ("field_%s.npy" % name), values)
+        with open(dirPath / "fields.json", "w") as fi:
+            json.dump(list(self.fields), fi)
+
+    @classmethod
+    def load(cls, dirPath, mmap=True):
+        """load a store saved with save; with mmap=True the buffers are memory-mapped read-only"""
+
+        dirPath = pathlib.Path(dirPath)
+        mmapMode = "r" if mmap else None
+        with open(dirPath / "fields.json", "r") as fi:
+            fieldNames = json.load(fi)
+        keys = np.load(dirPath / "keys.npy", allow_pickle=True)
+        offsets = np.load(dirPath / "offsets.npy")
+        fields = {name: np.load(dirPath / ("field_%s.npy" % name), mmap_mode=mmapMode) for name in fieldNames}
+
+        return cls(keys, offsets, fields)
+
+
+def saveStores(pathStores, dirPath):
+    """save a dict of path stores to one subdirectory per store name in dirPath"""
+
+    for name, store in pathStores.items():
+        store.save(pathlib.Path(dirPath, name))
+
+
+def loadStores(dirPath, mmap=True):
+    """load all path stores saved with saveStores from dirPath"""
+
+    return {
+        storeDir.name: PathStore.load(storeDir, mmap=mmap)
+        for storeDir in sorted(pathlib.Path(dirPath).iterdir())
+        if (storeDir / "fields.json").is_file()
+    }
+
+
+def getStore(pathStores, name, dbData, column=None, fieldNames=("x", "y", "z")):
+    """return the store name from pathStores or, if not available, build it from a line column of dbData
+
+    Parameters
+    -----------
+    pathStores: dict or None
+        path stores by name
+    name: str
+        name of store
+    dbData: pandas dataframe
+        dataframe with one row per event
+    column: str
+        optional - name of line column in dbData used if the store is not available, default name
+    fieldNames: tuple
+        names of the coordinates of the line column, e.g. ("s", "z") for s/z profiles
+    """
+
+    if pathStores is not None and name in pathStores:
+        return pathStores[name]
+
+    column = name if column is None else column
+    return PathStore.fromLines(dbData.index, dbData[column].to_numpy(), fieldNames=fieldNames)
+
+
+def locatePoints(store, dbData, pointColumns):
+    """locate points of interest on the profile of each event once, for all later stages
+
+    Parameters
+    -----------
+    store: PathStore
+        profiles (x, y and optionally s) the points are located on
+    dbData: pandas dataframe
+        dataframe with one row per key of store
+    pointColumns: list
+        names of point columns in dbData, e.g. the snapped origin, transit and runout points
+
+    Returns
+    --------
+    pointIndex: pandas dataframe
+        one row per key of store with the columns <point>_idx (index of the closest point of the profile,
+        -1 if the point is missing) and <point>_s (distance along the profile, nan if missing)
+    """
+
+    abscissa = store.abscissa()
+    table = {}
+    for column in pointColumns:
+        points = dbData.loc[store.keys, column].to_numpy(dtype=object)
+        points = np.where(shapely.is_geometry(points), points, None)
+        indices = store.closestIndex(shapely.get_x(points), shapely.get_y(points))
+        found = indices >= 0
+        s = np.full(len(indices), np.nan)
+        s[found] = abscissa[store.offsets[:-1][found] + indices[found]]
+        table["%s_idx" % column] = indices
+        table["%s_s" % column] = s
+
+    return pd.DataFrame(table, index=store.keys)
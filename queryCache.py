@@ -0,0 +1,139 @@
+""" on-disk cache of query results, stored as Parquet files keyed by a hash of the sql string """
+
+import hashlib
+import json
+import logging
+import pathlib
+import time
+
+import pandas as pd
+
+# create local logger
+log = logging.getLogger(__name__)
+
+
+def cacheKey(sqlString):
+    """ return the cache key of a sql string (query and constraint) """
+
+    return hashlib.sha256(" ".join(sqlString.split()).encode("utf-8")).hexdigest()[:24]
+
+
+def _cachePaths(cacheDir, sqlString):
+    key = cacheKey(sqlString)
+    cacheDir = pathlib.Path(cacheDir)
+    return cacheDir / ("%s.parquet" % key), cacheDir / ("%s.json" % key)
+
+
+def readCache(cacheDir, sqlString, ttl=None, probe=None):
+    """ read the cached result of sqlString if available and still valid
+
+        Parameters
+        -----------
+        cacheDir: pathlib path or str
+            path to cache directory
+        sqlString: str
+            full sql string (query and constraint) the data was fetched with
+        ttl: float
+            optional - maximum age of cached data in seconds, None: no expiry
+        probe: str
+            optional - fingerprint of the current DB state (e.g. row count and max(updated_at));
+            cached data is only valid if it was stored with the same fingerprint
+
+        Returns
+        --------
+        dbData: pandas DF or None
+            cached data, None if no valid cache entry exists
+    """
+
+    dataFile, metaFile = _cachePaths(cacheDir, sqlString)
+    if not (dataFile.is_file() and metaFile.is_file()):
+        return None
+
+    with open(metaFile, "r") as fi:
+        meta = json.load(fi)
+
+    if ttl is not None and (time.time() - meta["created"]) > ttl:
+        log.info("Cached data for query is older than %.0f s - refetching" % ttl)
+        return None
+    if probe is not None and meta.get("probe") != probe:
+        log.info("DB state changed since data was cached - refetching")
+        return None
+
+    try:
+        dbData = pd.read_parquet(dataFile)
+    except (ImportError, ValueError, OSError) as error:
+        log.warning("Cannot read cached data %s: %s" % (dataFile, error))
+        return None
+
+    log.info("Read %d entries from cache %s" % (len(dbData), dataFile))
+    return dbData
+
+
+def readCacheMeta(cacheDir, sqlString):
+    """ return the metadata stored along with the cached result of sqlString, None if not cached """
+
+    dataFile, metaFile = _cachePaths(cacheDir, sqlString)
+    if not (dataFile.is_file() and metaFile.is_file()):
+        return None
+
+    with open(metaFile, "r") as fi:
+        return json.load(fi)
+
+
+def writeCache(cacheDir, sqlString, dbData, probe=None, extraMeta=None):
+    """ write dbData fetched with sqlString to the cache
+
+        Parameters
+        -----------
+        cacheDir: pathlib path or str
+            path to cache directory
+        sqlString: str
+            full sql string (query and constraint) the data was fetched with
+        dbData: pandas DF
+            fetched data
+        probe: str
+            optional - fingerprint of the DB state at the time of fetching
+        extraMeta: dict
+            optional - additional json serializable info stored with the data
+    """
+
+    cacheDir = pathlib.Path(cacheDir)
+    cacheDir.mkdir(parents=True, exist_ok=True)
+    dataFile, metaFile = _cachePaths(cacheDir, sqlString)
+
+    try:
+        dbData.to_parquet(dataFile)
+    except (ImportError, ValueError, TypeError) as error:
+        log.warning("Data not cached, cannot write parquet file: %s" % error)
+        return
+
+    meta = {"sql": sqlString, "created": time.time(), "probe": probe, "rows": len(dbData)}
+    if extraMeta is not None:
+        meta.update(extraMeta)
+    with open(metaFile, "w") as fi:
+        json.dump(meta, fi)
+
+
+def invalidateCache(cacheDir, sqlString=None):
+    """ remove the cache entry of sqlString or, if sqlString is None, all cache entries in cacheDir
+
+        Returns
+        --------
+        nRemoved: int
+            number of removed cache entries
+    """
+
+    cacheDir = pathlib.Path(cacheDir)
+    if sqlString is None:
+        dataFiles = list(cacheDir.glob("*.parquet"))
+    else:
+        dataFiles = [_cachePaths(cacheDir, sqlString)[0]]
+
+    nRemoved = 0
+    for dataFile in dataFiles:
+        if dataFile.is_file():
+            nRemoved = nRemoved + 1
+        dataFile.unlink(missing_ok=True)
+        dataFile.with_suffix(".json").unlink(missing_ok=True)
+
+    return nRemoved
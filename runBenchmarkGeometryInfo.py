@@ -0,0 +1,124 @@
+"""
+    Benchmark of amaUtilities.fetchGeometryInfo against the former per-column implementation
+    (row-wise WKB parsing, one GeoDataFrame and to_crs call per geometry column) on a synthetic event table
+"""
+
+import time
+
+import geopandas
+import numpy as np
+import pandas as pd
+import shapely
+from shapely import wkb, LineString, length
+
+import amaUtilities as aU
+
+# +++++++++SETUP BENCHMARK++++++++++++++++++++++++
+nEvents = 1000
+nPointCols = 16
+nVerticesPath = 40
+resampleDist = 5.0
+srcprojstr = "epsg:4326"
+projstr = "epsg:31287"
+nRepeat = 3
+
+
+def fetchGeometryInfoLoop(dbData, srcprojstr, projstr, geomStr, nonEmptyCols, addAttributes, resampleDist):
+    """former implementation of aU.fetchGeometryInfo, kept as reference for the benchmark"""
+
+    crsVal = projstr.split("epsg:")[1]
+    for nECol in nonEmptyCols:
+        dbFiltered = dbData[~pd.isnull(dbData[nECol])]
+    dbFilteredGeom = dbFiltered.filter(regex=geomStr).copy()
+    for col in dbFilteredGeom.columns:
+        convertedGeo = dbFilteredGeom[col].apply(wkb.loads, hex=True)
+        dbFilteredGeom.loc[:, col] = convertedGeo
+        gdf = geopandas.GeoDataFrame(dbFilteredGeom, geometry=col, crs=srcprojstr)
+        gdfConvert = gdf.to_crs(epsg=crsVal)
+        dbFilteredGeom.insert(0, (col + "_" + projstr), gdfConvert[col])
+
+    lineResampled = []
+    dbFilteredGeom["pathLength"] = np.empty(len(dbFilteredGeom))
+    for index, row in dbFilteredGeom.iterrows():
+        line = row["geom_path_ln3d_" + projstr]
+        distInt = int(np.ceil(line.length / resampleDist))
+        distances = np.linspace(0, line.length, distInt)
+        lineR = LineString([line.interpolate(dist) for dist in distances])
+        lineResampled.append(lineR)
+        dbFilteredGeom.loc[index, "pathLength"] = length(line)
+    dbFilteredGeom.insert(0, "geom_path_ln3d_%s_resampled" % projstr, lineResampled)
+    dbFilteredGeom = dbFilteredGeom.join(dbFiltered[addAttributes])
+
+    return dbFilteredGeom
+
+
+def syntheticEventTable(nEvents, nPointCols, nVerticesPath, seed=42):
+    """create an event table with hex WKB geometry columns in lon/lat as fetched from event_full"""
+
+    rng = np.random.default_rng(seed)
+    lon0 = rng.uniform(10.0, 14.0, nEvents)
+    lat0 = rng.uniform(46.8, 47.6, nEvents)
+
+    # thalwegs of about 1-3 km descending from 2500 m
+    steps = np.linspace(0.0, 1.0, nVerticesPath)
+    pathLength = rng.uniform(0.01, 0.03, nEvents)
+    paths3d = [
+        LineString(
+            np.column_stack(
+                [
+                    lon0[i] + pathLength[i] * steps,
+                    lat0[i] + 0.3 * pathLength[i] * np.sin(3 * steps),
+                    2500.0 - 1200.0 * steps,
+                ]
+            )
+        )
+        for i in range(nEvents)
+    ]
+    dbData = pd.DataFrame(
+        {
+            "event_id": np.arange(nEvents),
+            "path_id": np.arange(nEvents),
+            "path_name": ["path%d" % i for i in range(nEvents)],
+            "rel_event_pt": ["x"] * nEvents,
+            "geom_path_ln3d": shapely.to_wkb(paths3d, hex=True),
+            "geom_path_ln": shapely.to_wkb(shapely.force_2d(paths3d), hex=True),
+        }
+    )
+    for col in range(nPointCols):
+        fraction = rng.uniform(0.0, 1.0, nEvents)
+        points = shapely.line_interpolate_point(paths3d, fraction, normalized=True)
+        dbData["geom_point%d_pt3d" % col] = shapely.to_wkb(points, hex=True)
+
+    # hex strings are returned as object columns by read_sql_query
+    return dbData.astype(object)
+
+
+if __name__ == "__main__":
+    dbData = syntheticEventTable(nEvents, nPointCols, nVerticesPath)
+    args = (dbData, srcprojstr, projstr, "geom", ["rel_event_pt"], ["path_name", "event_id", "path_id"], resampleDist)
+
+    timings = {}
+    results = {}
+    for name, func in [("loop", fetchGeometryInfoLoop), ("vectorised", aU.fetchGeometryInfo)]:
+        runTimes = []
+        for _ in range(nRepeat):
+            startTime = time.perf_counter()
+            results[name] = func(*args)
+            runTimes.append(time.perf_counter() - startTime)
+        timings[name] = min(runTimes)
+        print("%-10s: %.3f s (best of %d)" % (name, timings[name], nRepeat))
+
+    # check that both implementations agree
+    for col in results["loop"].columns:
+        loopValues = results["loop"][col].to_numpy()
+        vectorValues = results["vectorised"][col].to_numpy()
+        if col.startswith("geom"):
+            assert shapely.equals_exact(
+                shapely.from_wkb(shapely.to_wkb(loopValues)), vectorValues, tolerance=1.0e-6
+            ).all(), col
+        else:
+            assert np.array_equal(loopValues, vectorValues) or np.allclose(loopValues, vectorValues), col
+    assert list(results["loop"].columns) == list(results["vectorised"].columns)
+
+    print("%d events, %d geometry columns: speedup %.1fx" % (
+        nEvents, nPointCols + 2, timings["loop"] / timings["vectorised"]))
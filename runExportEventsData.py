@@ -7,46 +7,66 @@ import amaConnector
 import grab_demo as gD
 import amaUtilities as aU
 import avaframeExport as aExport
+import exportManifest as emF
 from avaframe.in3Utils import cfgUtils
 from avaframe.in3Utils import logUtils
 import avaframe.in3Utils.fileHandlerUtils as fU
 
 
-# +++++++++SETUP CONFIGURATION++++++++++++++++++++++++
-# log file name; leave empty to use default runLog.log
-logName = 'runExportEventsData'
-
-# Load avalanche directory and accessFile path from general configuration file
-dirPath = pathlib.Path(__file__).parents[0]
-cfgMain = cfgUtils.getGeneralConfig(nameFile=(dirPath / 'amaConnectorCfg.ini'))
-avalancheDir = pathlib.Path(cfgMain['MAIN']['avalancheDir'])
-fU.makeADir(avalancheDir)
-accessfile = pathlib.Path(cfgMain['MAIN']['accessFile'])
-
-# Start logging
-log = logUtils.initiateLogger(avalancheDir, logName, modelInfo='AmaConnector')
-log.info('MAIN SCRIPT')
-log.info('Current search: %s', avalancheDir)
-
-# load info on config of fetching data
-configuration = cfgMain['MAIN']['dBConfiguration']
-eventType = cfgMain['MAIN']['eventType']
-constraint = cfgMain['MAIN']['constraint']
-projstr = cfgMain['MAIN']['projstr']
-
-# connect to db
-amaConnect = amaConnector.amaAccess(accessfile)
-log.info('Exporting db using export configuration "%s"' % configuration)
-log.info('Type of events is: %s' % eventType)
-log.info('Using constraint: %s' % constraint)
-
-# fetch and export all event data for given query
-if eventType == 'design':
-    useDesignEvents = True
-else:
-    useDesignEvents = False
-eventsRes = aExport.grabEvents(amaConnect, configuration, str(avalancheDir), useDesignEvents, projstr, constraint)
-rasterRes = aExport.grabRaster(amaConnect, configuration, str(avalancheDir), useDesignEvents, projstr, constraint)
-
-log.info('Written %d events' % eventsRes)
-log.info('Written %d path rasters' % rasterRes)
+# the export runs in the main guard - worker processes of the parallel raster export import this script
+if __name__ == '__main__':
+    # +++++++++SETUP CONFIGURATION++++++++++++++++++++++++
+    # log file name; leave empty to use default runLog.log
+    logName = 'runExportEventsData'
+
+    # Load avalanche directory and accessFile path from general configuration file
+    dirPath = pathlib.Path(__file__).parents[0]
+    cfgMain = cfgUtils.getGeneralConfig(nameFile=(dirPath / 'amaConnectorCfg.ini'))
+    avalancheDir = pathlib.Path(cfgMain['MAIN']['avalancheDir'])
+    fU.makeADir(avalancheDir)
+    accessfile = pathlib.Path(cfgMain['MAIN']['accessFile'])
+
+    # Start logging
+    log = logUtils.initiateLogger(avalancheDir, logName, modelInfo='AmaConnector')
+    log.info('MAIN SCRIPT')
+    log.info('Current search: %s', avalancheDir)
+
+    # load info on config of fetching data
+    configuration = cfgMain['MAIN']['dBConfiguration']
+    eventType = cfgMain['MAIN']['eventType']
+    constraint = cfgMain['MAIN']['constraint']
+    projstr = cfgMain['MAIN']['projstr']
+    nWorkers = max(cfgMain['MAIN'].getint('exportWorkers'), 1)
+
+    # connect to db - all export queries share the pooled connections, every export worker needs its own
+    # connection, so the pool keeps at least nWorkers connections open
+    amaConnect = amaConnector.amaAccess(accessfile,
+        minConnections=max(cfgMain['MAIN'].getint('minConnections'), nWorkers),
+        maxConnections=max(cfgMain['MAIN'].getint('maxConnections'), nWorkers))
+    log.info('Exporting db using export configuration "%s"' % configuration)
+    log.info('Type of events is: %s' % eventType)
+    log.info('Using constraint: %s' % constraint)
+    log.info('Using %d export workers' % nWorkers)
+
+    # fetch and export all event data for given query
+    if eventType == 'design':
+        useDesignEvents = True
+    else:
+        useDesignEvents = False
+    # the manifest records every exported item, so an interrupted or repeated export only writes changed items
+    manifest = None
+    if cfgMain['MAIN'].getboolean('resumeExport'):
+        manifest = emF.ExportManifest(avalancheDir / 'exportManifest.jsonl')
+    with amaConnect:
+        eventsRes = aExport.grabEvents(amaConnect, configuration, str(avalancheDir), useDesignEvents, projstr,
+            constraint, nWorkers=nWorkers, batched=cfgMain['MAIN'].getboolean('batchedExport'), manifest=manifest,
+            exportFormat=cfgMain['MAIN']['exportFormat'], batchSize=cfgMain['MAIN'].getint('exportBatchSize'))
+        rasterRes = aExport.grabRaster(amaConnect, configuration, str(avalancheDir), useDesignEvents, projstr,
+            constraint, rasterFormat=cfgMain['MAIN']['rasterFormat'], nWorkers=nWorkers, manifest=manifest)
+    if manifest is not None:
+        manifest.compact()
+
+    log.info('Written %d events' % eventsRes)
+    log.info('Written %d path rasters' % rasterRes)
+    log.info('Database connections: %d opened, %d reused' % (amaConnect.connectionStats['opened'],
+        amaConnect.connectionStats['reused']))
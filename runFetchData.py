@@ -25,6 +25,22 @@ log.info('MAIN SCRIPT')
 log.info('Current search: %s', avalancheDir)
 
 # fetch all info of the database according to queryString and return dataFrame
-dbData = gD.grabAllComplete(avalancheDir, queryString=cfgMain['MAIN']['queryString'], accessfile=accessfile)
+chunkSize = cfgMain['MAIN'].getint('queryChunkSize')
+if cfgMain['SYNC'].getboolean('useSync'):
+    # only fetch events that changed since the last sync and merge them into the stored dataset
+    dbData, syncInfo = gD.syncIncremental(avalancheDir, queryString=cfgMain['MAIN']['queryString'],
+        accessfile=accessfile, syncColumn=cfgMain['SYNC']['syncColumn'])
+    nEntries = len(dbData)
+elif chunkSize > 0:
+    # stream the events chunk-wise instead of holding the whole table in memory
+    nEntries = 0
+    for dbChunk in gD.grabAllCompleteChunks(avalancheDir, queryString=cfgMain['MAIN']['queryString'],
+        accessfile=accessfile, chunkSize=chunkSize):
+        nEntries = nEntries + len(dbChunk)
+        log.info('Fetched chunk of %d entries' % len(dbChunk))
+else:
+    dbData = gD.grabAllComplete(avalancheDir, queryString=cfgMain['MAIN']['queryString'], accessfile=accessfile,
+        cfgCache=cfgMain['CACHE'])
+    nEntries = len(dbData)
 
-log.info('Fetched %d entries from data base ' % (len(dbData)))
+log.info('Fetched %d entries from data base ' % nEntries)
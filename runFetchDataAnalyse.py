@@ -38,7 +38,8 @@ log.info('MAIN SCRIPT')
 log.info('Current search: %s', avalancheDir)
 
 # fetch all info of the database according to queryString and return dataFrame
-dbData = gD.grabAllComplete(avalancheDir, queryString=queryString, accessfile=accessfile)
+dbData = gD.grabAllComplete(avalancheDir, queryString=queryString, accessfile=accessfile,
+    cfgCache=cfgMain['CACHE'])
 log.info('Fetched %d entries from data base ' % (len(dbData)))
 for index, row in dbData.iterrows():
     log.info('%s, event id: %s, index %s' % (row['path_name'], row['event_id'], index))
@@ -62,13 +63,13 @@ dbFiltered = gT.snapPtsToLine(dbFiltered, cfgMain['MAIN']['projstr'], lineName='
 # here the snapped points are chosen also in terms of their elevation on the path line!
 projstr = cfgMain['MAIN']['projstr']
 dbFiltered = aU.addXYDistAngle(dbFiltered, 'geom_path_ln3d_%s_resampled' % projstr, 'geom_rel_event_pt3d_%s_snapped' % projstr,
-    'geom_event_pt3d_%s_snapped' % projstr, projstr, name='rel-runout')
+    'geom_event_pt3d_%s_snapped' % projstr, projstr, name='rel-runout', addLines=True)
 
 dbFiltered = aU.addXYDistAngle(dbFiltered, 'geom_path_ln3d_%s_resampled' % projstr, 'geom_origin_pt3d_%s_snapped' % projstr,
-    'geom_transit_pt3d_%s_snapped' % projstr, projstr, name='orig-transit')
+    'geom_transit_pt3d_%s_snapped' % projstr, projstr, name='orig-transit', addLines=True)
 
 dbFiltered = aU.addXYDistAngle(dbFiltered, 'geom_path_ln3d_%s_resampled' % projstr, 'geom_origin_pt3d_%s_snapped' % projstr,
-    'geom_runout_pt3d_%s_snapped' % projstr, projstr, name='orig-depo')
+    'geom_runout_pt3d_%s_snapped' % projstr, projstr, name='orig-depo', addLines=True)
 
 #++++++++++++++create plots and save dataframe to file
 outFile = avalancheDir / 'data.csv'
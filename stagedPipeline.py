@@ -0,0 +1,265 @@
+"""
+    Pipeline of analysis stages with checkpoints: each stage declares the stages it reads and the configuration
+    options its result depends on, results are stored on disk (Parquet + ragged arrays) and a stage is only
+    recomputed if the result of an input stage or one of its options changed
+"""
+
+import hashlib
+import json
+import logging
+import pathlib
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+import shapely
+
+import exportManifest as emF
+import pathStore as pS
+
+# create local logger
+log = logging.getLogger(__name__)
+
+
+class Stage:
+    """one stage of a StagedPipeline
+
+    Parameters
+    -----------
+    name: str
+        name of the stage, also name of its checkpoint directory
+    func: callable
+        func(cfg, *inputResults) computes the result of the stage from the configuration and the results of
+        the input stages; a result is a dict with any of "events", "pointIndex" (pandas dataframes) and
+        "pathStores" (dict of pS.PathStore); func must not modify the input results in place
+    inputs: list
+        names of the stages whose results func takes, in this order
+    cfgKeys: list
+        (section, option) tuples of the configuration the result depends on
+    """
+
+    def __init__(self, name, func, inputs=(), cfgKeys=()):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.cfgKeys = [tuple(cfgKey) for cfgKey in cfgKeys]
+
+
+def stageKey(stage, cfg, inputFingerprints):
+    """return the key of a stage result: hash of the stage name, its options and the fingerprints of its inputs"""
+
+    settings = {
+        "stage": stage.name,
+        "cfg": [[section, option, cfg.get(section, option, fallback=None)] for section, option in stage.cfgKeys],
+        "inputs": inputFingerprints,
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()[:24]
+
+
+def geometryColumns(dbData):
+    """return the names of the columns of dbData holding shapely geometries (and missing values)"""
+
+    columns = []
+    for column in dbData.columns:
+        if dbData[column].dtype != object:
+            continue
+        values = dbData[column].to_numpy()
+        isGeometry = shapely.is_geometry(values)
+        if isGeometry.any() and (isGeometry | pd.isna(values)).all():
+            columns.append(column)
+    return columns
+
+
+def writeFrame(dbData, filePath):
+    """write dbData to a parquet file, geometries as WKB; return the names of the geometry columns"""
+
+    columns = geometryColumns(dbData)
+    dbData = dbData.copy()
+    for column in columns:
+        values = dbData[column].to_numpy()
+        wkb = np.full(len(values), None, dtype=object)
+        isGeometry = shapely.is_geometry(values)
+        wkb[isGeometry] = shapely.to_wkb(values[isGeometry])
+        dbData[column] = wkb
+    dbData.to_parquet(filePath)
+
+    return columns
+
+
+def readFrame(filePath, columns):
+    """read a parquet file written with writeFrame and restore the geometries of columns"""
+
+    dbData = pd.read_parquet(filePath)
+    for column in columns:
+        dbData[column] = shapely.from_wkb(dbData[column].to_numpy(dtype=object))
+
+    return dbData
+
+
+def readCheckpointMeta(stageDir):
+    """return the metadata of the checkpoint in stageDir, None if there is no complete checkpoint"""
+
+    metaFile = pathlib.Path(stageDir, "stage.json")
+    if not metaFile.is_file():
+        return None
+
+    with open(metaFile, "r") as fi:
+        return json.load(fi)
+
+
+def writeCheckpoint(stageDir, result, key):
+    """write the result of a stage to stageDir
+
+    dataframes are stored as parquet files, path stores as .npy buffers (pS.saveStores); the metadata
+    file stage.json is written last, an interrupted write leaves no valid checkpoint
+
+    Parameters
+    -----------
+    stageDir: pathlib path
+        checkpoint directory of the stage, existing content is removed
+    result: dict
+        result of the stage
+    key: str
+        key of the result (stageKey)
+
+    Returns
+    --------
+    fingerprint: str
+        hash of the checkpoint files, None if the result cannot be checkpointed
+    """
+
+    stageDir = pathlib.Path(stageDir)
+    if stageDir.is_dir():
+        shutil.rmtree(stageDir)
+    stageDir.mkdir(parents=True)
+
+    meta = {"key": key, "created": time.time(), "frames": {}, "pathStores": []}
+    try:
+        for name in ["events", "pointIndex"]:
+            if result.get(name) is not None:
+                meta["frames"][name] = writeFrame(result[name], stageDir / ("%s.parquet" % name))
+    except (ImportError, ValueError, TypeError) as error:
+        log.warning("No checkpoint written to %s, cannot write parquet file: %s" % (stageDir, error))
+        shutil.rmtree(stageDir)
+        return None
+    if result.get("pathStores"):
+        pS.saveStores(result["pathStores"], stageDir / "pathStores")
+        meta["pathStores"] = list(result["pathStores"])
+
+    # the fingerprint identifies the content of the result, stages reading it are recomputed if it changes
+    sha = hashlib.sha256()
+    for filePath in sorted(stageDir.rglob("*")):
+        if filePath.is_file():
+            sha.update(("%s %s\n" % (filePath.relative_to(stageDir).as_posix(), emF.fileChecksum(filePath))).encode())
+    meta["fingerprint"] = sha.hexdigest()[:24]
+
+    with open(stageDir / "stage.json", "w") as fi:
+        json.dump(meta, fi)
+
+    return meta["fingerprint"]
+
+
+def readCheckpoint(stageDir, mmap=True):
+    """read the result of a stage from its checkpoint in stageDir, with mmap=True path stores are memory-mapped"""
+
+    stageDir = pathlib.Path(stageDir)
+    meta = readCheckpointMeta(stageDir)
+    result = {name: readFrame(stageDir / ("%s.parquet" % name), columns) for name, columns in meta["frames"].items()}
+    if meta["pathStores"]:
+        pathStores = pS.loadStores(stageDir / "pathStores", mmap=mmap)
+        result["pathStores"] = {name: pathStores[name] for name in meta["pathStores"]}
+
+    return result
+
+
+class StagedPipeline:
+    """run stages in order, reusing the checkpointed results of stages that are up to date
+
+    a stage is up to date if its checkpoint was computed with the same options (cfgKeys) from input results
+    with the same fingerprints; results of up to date stages are only read from disk if a later stage needs them
+
+    Parameters
+    -----------
+    stages: list
+        Stage objects, inputs of a stage must be earlier stages
+    cfg: configparser object
+        configuration passed to the stage functions
+    checkpointDir: pathlib path or str
+        optional - directory of the checkpoints, one subdirectory per stage; None: no checkpoints,
+        all stages are computed
+    rerunStages: list
+        optional - names of stages that are recomputed even if their checkpoint is up to date, e.g. the
+        stage fetching data from the database; later stages are only recomputed if its result changed
+    """
+
+    def __init__(self, stages, cfg, checkpointDir=None, rerunStages=()):
+        self.stages = list(stages)
+        self.cfg = cfg
+        self.checkpointDir = None if checkpointDir is None else pathlib.Path(checkpointDir)
+        self.rerunStages = set(rerunStages)
+        self.results = {}
+        self.fingerprints = {}
+        self.recomputed = []
+
+        names = []
+        for stage in self.stages:
+            missing = [name for name in stage.inputs if name not in names]
+            if stage.name in names or missing:
+                message = "Stage %s is defined twice or reads stages %s not defined before it" % (
+                    stage.name,
+                    missing,
+                )
+                log.error(message)
+                raise ValueError(message)
+            names.append(stage.name)
+        unknown = self.rerunStages - set(names)
+        if unknown:
+            message = "Stages %s to rerun are not stages of the pipeline %s" % (sorted(unknown), names)
+            log.error(message)
+            raise ValueError(message)
+
+    def stageDir(self, name):
+        """return the checkpoint directory of stage name"""
+        return self.checkpointDir / name
+
+    def isUpToDate(self, stage, key):
+        """return True if the checkpoint of stage was computed with key and is not to be rerun"""
+
+        if self.checkpointDir is None or stage.name in self.rerunStages:
+            return False
+        meta = readCheckpointMeta(self.stageDir(stage.name))
+        return meta is not None and meta["key"] == key
+
+    def result(self, name):
+        """return the result of stage name, read from its checkpoint if it was not computed in this run"""
+
+        if name not in self.results:
+            log.info("Reading result of stage %s from checkpoint" % name)
+            self.results[name] = readCheckpoint(self.stageDir(name))
+        return self.results[name]
+
+    def run(self, target=None):
+        """run all stages up to stage target (default: the last stage) and return the result of target"""
+
+        names = [stage.name for stage in self.stages]
+        target = names[-1] if target is None else target
+        for stage in self.stages[: names.index(target) + 1]:
+            inputFingerprints = [self.fingerprints[name] for name in stage.inputs]
+            # without fingerprints of all inputs the key of the result is unknown - recompute
+            key = None if None in inputFingerprints else stageKey(stage, self.cfg, inputFingerprints)
+            if key is not None and self.isUpToDate(stage, key):
+                log.info("Stage %s is up to date" % stage.name)
+                self.fingerprints[stage.name] = readCheckpointMeta(self.stageDir(stage.name))["fingerprint"]
+                continue
+
+            log.info("Running stage %s" % stage.name)
+            result = stage.func(self.cfg, *[self.result(name) for name in stage.inputs])
+            self.results[stage.name] = result
+            self.recomputed.append(stage.name)
+            if self.checkpointDir is None or key is None:
+                self.fingerprints[stage.name] = None
+            else:
+                self.fingerprints[stage.name] = writeCheckpoint(self.stageDir(stage.name), result, key)
+
+        return self.result(target)
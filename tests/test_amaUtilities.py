@@ -0,0 +1,27 @@
+"""Tests for amaUtilities"""
+
+import pandas as pd
+import pytest
+import shapely
+from shapely import LineString
+
+import amaUtilities as aU
+
+PROJSTR = "epsg:31287"
+
+
+@pytest.mark.parametrize("zeroPosition", [1, 2])
+def test_fetchGeometryInfoZeroLengthPath(zeroPosition):
+    """a zero length path line gets an empty resampled line, the other events are resampled as before"""
+
+    lines = [LineString([(0, 0, 10), (30, 0, 0)]), LineString([(0, 0, 5), (0, 40, 0)])]
+    lines.insert(zeroPosition, LineString([(5, 5, 1), (5, 5, 1)]))
+    dbData = pd.DataFrame({"geom_path_ln3d": shapely.to_wkb(lines, hex=True), "event_id": [1, 2, 3]})
+
+    dbFiltered = aU.fetchGeometryInfo(dbData, PROJSTR, PROJSTR, "geom", ["geom_path_ln3d"], ["event_id"], 5.0)
+
+    resampled = dbFiltered["geom_path_ln3d_%s_resampled" % PROJSTR].to_numpy()
+    nPoints = [len(line.coords) for line in resampled]
+    assert resampled[zeroPosition].is_empty
+    assert nPoints == [6, 8][:zeroPosition] + [0] + [6, 8][zeroPosition:]
+    assert dbFiltered["event_id"].tolist() == [1, 2, 3]
@@ -0,0 +1,60 @@
+"""Tests for fit"""
+
+import configparser
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import amaUtilities as aU
+import fit
+import pathStore as pS
+
+PROJSTR = "epsg:31287"
+ORIGINCOLUMN = "geom_origin_pt3d_%s_snapped_idx" % PROJSTR
+FITCOLUMNS = ["r_squaredcf", "rmse", "curvature", "b", "c"]
+
+
+class _PathCache:
+    """stands in for the DEM cache, returns a fixed resampled thalweg"""
+
+    def __init__(self, avaPath):
+        self.avaPath = avaPath
+
+    def getAvaPath(self, pathName, pathId, x, y, resDist):
+        return dict(self.avaPath)
+
+
+def _funcExponential(s, a, b, c):
+    return a * np.exp(-b * s / 1000.0) + c
+
+
+@pytest.mark.parametrize("func", [None, _funcExponential])
+def test_fitThalwegMissingOrigin(func):
+    """an event without origin that is not the first event gets empty profiles and no fit"""
+
+    keys = [3, 5, 7]
+    s = np.arange(20) * 10.0
+    avaPath = {"x": s, "y": np.zeros(20), "z": 2000.0 - 6.0 * s + 0.01 * s**2, "s": s}
+    store = pS.PathStore.fromArrays(keys, [avaPath for _ in keys])
+    pointIndex = pd.DataFrame({ORIGINCOLUMN: [2, -1, 4]}, index=keys)
+    cfg = configparser.ConfigParser()
+    cfg.read_dict({"MAIN": {"betaAngles": "-22|-28|-32"}})
+    dbData = pd.DataFrame({"path_name": ["path"] * 3, "path_id": [1] * 3}, index=keys)
+    pathStores = {"thalweg": store}
+
+    dbData = fit.fitThalweg(
+        dbData, 30, 20, 10.0, PROJSTR, 0.0, cfg, pathStores=pathStores, demCache=_PathCache(avaPath),
+        pointIndex=pointIndex, func=func,
+    )
+
+    assert dbData["origin"].tolist() == [2, -1, 4]
+    assert dbData.loc[5, FITCOLUMNS].isna().all()
+    assert dbData.loc[[3, 7], FITCOLUMNS].notna().all().all()
+    for name in ["avaPathLong", "avaPath", "curveFitLong", "curveFit"]:
+        assert pathStores[name].lengths().tolist()[1] == 0
+    assert pathStores["avaPath"].lengths().tolist() == [18, 0, 16]
+    assert pathStores["avaPath"].get(7)["s"][0] == 0.0
+    if func is None:
+        assert dbData.loc[[3, 7], "r_squaredcf"].to_numpy() == pytest.approx(1.0)
+        assert dbData.loc[[3, 7], "curvature"].to_numpy() == pytest.approx(0.02)
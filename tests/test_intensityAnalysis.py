@@ -0,0 +1,77 @@
+"""Tests for intensityAnalysis"""
+
+import configparser
+
+import numpy as np
+import pandas as pd
+
+import intensityAnalysis as iA
+import pathStore as pS
+
+PROJSTR = "epsg:31287"
+POINTCOLUMNS = ["geom_%s_pt3d_%s_snapped_idx" % (name, PROJSTR) for name in ["origin", "transit", "runout"]]
+
+
+class _PathCache:
+    """stands in for the DEM cache, returns fixed resampled thalwegs"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def getAvaPaths(self, dbData, thalwegs, resDist):
+        return self.store.subset(dbData.index)
+
+
+def _setup(keys, origins, depos):
+    s = np.arange(20) * 10.0
+    profiles = [{"x": s, "y": np.zeros(20), "z": 2000.0 - 6.0 * s + 0.01 * s**2, "s": s} for _ in keys]
+    store = pS.PathStore.fromArrays(keys, profiles)
+    pointIndex = pd.DataFrame(
+        {POINTCOLUMNS[0]: origins, POINTCOLUMNS[1]: np.full(len(keys), 8), POINTCOLUMNS[2]: depos}, index=keys
+    )
+    cfg = configparser.ConfigParser()
+    cfg.read_dict({"MAIN": {"projstr": PROJSTR, "g": "9.81", "density": "200."}})
+    dbData = pd.DataFrame({"path_name": ["path %d" % key for key in keys]}, index=keys)
+    return dbData, cfg, store, pointIndex
+
+
+def test_intensityCharacteristicsMissingOrigin():
+    """an event without origin that is not the first event gets no intensity, the others are unchanged"""
+
+    keys = [3, 5, 7]
+    dbData, cfg, store, pointIndex = _setup(keys, [2, -1, 4], [15, 15, 18])
+    pathStores = {"thalweg": store}
+    dbData = iA.intensityCharacteristics(
+        dbData, 10.0, cfg, pathStores=pathStores, demCache=_PathCache(store), pointIndex=pointIndex
+    )
+
+    assert np.isnan(dbData.at[5, "velocitiesMax_m/s"])
+    assert np.isnan(dbData.at[5, "destructivnessMax_kPa"])
+    assert np.isnan(dbData.at[5, "times(s)"])
+    assert len(pathStores["intensity"].get(5)["s"]) == 0
+
+    # the other events give the same results as without the event missing its origin
+    dbValid, cfg, store, pointIndexValid = _setup([3, 7], [2, 4], [15, 18])
+    dbValid = iA.intensityCharacteristics(
+        dbValid, 10.0, cfg, pathStores={"thalweg": store}, demCache=_PathCache(store), pointIndex=pointIndexValid
+    )
+    for column in ["velocitiesMax_m/s", "destructivnessMax_kPa", "times(s)"]:
+        assert np.allclose(dbData.loc[[3, 7], column], dbValid[column])
+    assert np.all(np.isfinite(dbValid["times(s)"]))
+    assert np.array_equal(pathStores["intensity"].get(7)["s"], store.get(7)["s"][4:18])
+
+
+def test_intensityProfilesTime():
+    """travel time is cumulative per profile and starts at 0 at the origin of each profile"""
+
+    s = np.array([0.0, 10.0, 20.0, 30.0, 0.0, 10.0, 20.0])
+    z = np.array([100.0, 85.0, 75.0, 70.0, 50.0, 40.0, 38.0])
+    offsets = np.array([0, 4, 7])
+    profiles, nSteps = iA.intensityProfiles(s, z, offsets, 9.81, 200.0)
+    single, _ = iA.intensityProfiles(s[4:], z[4:], np.array([0, 3]), 9.81, 200.0)
+
+    assert profiles["time"][0] == 0.0 and profiles["time"][4] == 0.0
+    assert np.all(np.diff(profiles["time"][0:4]) >= 0) and profiles["time"][3] > 0
+    assert np.allclose(profiles["time"][4:], single["time"])
+    # the step from the origin starts at zero velocity and is skipped
+    assert list(nSteps) == [2, 1]
@@ -10,15 +10,25 @@ Created on Fri Jun 21 07:57:33 2024
 script for creating thalweg analyse plots
 """
 
+import logging
 import pathlib
+from concurrent.futures import ProcessPoolExecutor
 
 # local imports
-import avaframe.in3Utils.geoTrans as gT
 import avaframe.out3Plot.plotUtils as pU
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import seaborn as sns
+from matplotlib.figure import Figure
+
+import pathStore as pS
+
+# create local logger
+log = logging.getLogger(__name__)
+
+# figure reused for all plots rendered by a process (renderSlopeAngleVariants)
+_slopeAngleFigure = None
 
 
 def plotBoxPlot(
@@ -31,6 +41,7 @@ def plotBoxPlot(
     renameTitle=[],
     renameY=[],
     renameX=[],
+    ax=None,
 ):
     """create a violin plot of colList from dbData
 
@@ -52,10 +63,13 @@ def plotBoxPlot(
         if specified, individual names for plots
     renameY: array of stings
         if specified, individual names for yaxis
+    ax: matplotlib axes
+        optional - draw into ax instead of a new figure, nothing is saved; with split and
+        several columns an array of one axes per column
     --------------------------------------------
 
     return:
-        path where the plot is saved
+        path where the plot is saved, None if drawn into ax
 
     """
 
@@ -64,15 +78,19 @@ def plotBoxPlot(
         colPalette = ["#a1cfca", "#b8cc91", "#f3bd50", "#e17f6f"]
 
         # creats general plot size
-        fig, axes = plt.subplots(1, len(colList), figsize=(10, 6))
+        if ax is None:
+            fig, axes = plt.subplots(1, len(colList), figsize=(10, 6))
+        else:
+            axes = ax
         for i, col in enumerate(colList):
             # if only one column is provided, only one characteristic is analysed
             if len(colList) == 1:
                 sn = sns.violinplot(
-                    data=dbData[col], color="#a3a3a3", fill=False, cut=0
+                    data=dbData[col], ax=axes, color="#a3a3a3", fill=False, cut=0
                 )
                 sn = sns.stripplot(
                     data=dbData[col],
+                    ax=axes,
                     jitter=True,
                     color="grey",
                     size=2,
@@ -80,12 +98,19 @@ def plotBoxPlot(
                     alpha=0.45,
                 )
                 sn = sns.violinplot(
-                    data=dbData, x=split, y=col, palette=colPalette, fill=False, cut=0
+                    data=dbData,
+                    x=split,
+                    y=col,
+                    ax=axes,
+                    palette=colPalette,
+                    fill=False,
+                    cut=0,
                 )
                 sns.stripplot(
                     data=dbData,
                     x=split,
                     y=col,
+                    ax=axes,
                     jitter=True,
                     color="grey",
                     size=2,
@@ -167,7 +192,8 @@ def plotBoxPlot(
                 axes.grid(linestyle="-", color="lightgrey", alpha=0.4, axis="y")
                 # axes.set_xlabel(split, fontsize=18)
                 axes.set_xlabel(r"$D_{max}$", fontsize=18)
-                plt.subplots_adjust(left=0.15)
+                if ax is None:
+                    plt.subplots_adjust(left=0.15)
                 # rect = Rectangle((0, 0), 1, 1, transform=fig.transFigure, color="darkgrey", fill=False, lw=1)
                 # fig.patches.append(rect)
 
@@ -292,12 +318,23 @@ def plotBoxPlot(
             "#0fbddb",
             "#1c5761",
         ]
-        fig = plt.figure(figsize=(6 * int(len(colList)), 8))
-        ax3 = plt.subplot(111)
+        if ax is None:
+            fig = plt.figure(figsize=(6 * int(len(colList)), 8))
+            ax3 = plt.subplot(111)
+        else:
+            ax3 = ax
         sns.stripplot(
-            data=dbData[colList], jitter=True, color="grey", alpha=0.5, size=2, zorder=1
+            data=dbData[colList],
+            ax=ax3,
+            jitter=True,
+            color="grey",
+            alpha=0.5,
+            size=2,
+            zorder=1,
+        )
+        sn = sns.violinplot(
+            data=dbData[colList], ax=ax3, palette=colPalette, fill=False, cut=0
         )
-        sn = sns.violinplot(data=dbData[colList], palette=colPalette, fill=False, cut=0)
 
         if ylim != 0:
             sn.set(ylim=ylim)
@@ -344,12 +381,75 @@ def plotBoxPlot(
         sns.set(style="whitegrid")
         ax3.tick_params(axis="both", labelsize=20)
         outFile = "violinplots_%s" % namePlot
+    if ax is not None:
+        return None
+
     # save figure
     plotPath = pU.saveAndOrPlot({"pathResult": outDir}, outFile, fig)
 
     return plotPath
 
 
+def plotSummaryPlate(
+    panels, name, title, outDir, ncols=2, panelSize=(12, 8), savePanels=True
+):
+    """draw the violin plots of panels as axes of one figure (summary plate) and save it
+
+    the panels are drawn directly into the axes of the plate, the plate is rendered once
+
+    Parameters
+    -----------
+    panels: list of dicts
+        keyword arguments of plotBoxPlot for each panel (dbData, colList, namePlot, ylim,
+        renameTitle, ...), outDir is added; without split
+    name: str
+        name of the plate
+    title: str
+        title of the plate
+    outDir: pathlib path or str
+        path to folder where plots shall be saved to
+    ncols: int
+        number of panels per row
+    panelSize: tuple
+        width and height of each panel, default: size of a single plot of two columns
+    savePanels: bool
+        if True, each panel is also saved as a single plot (plotBoxPlot)
+
+    Returns
+    --------
+    plotPath: pathlib path
+        path where the plate is saved
+    panelPaths: list
+        paths where the single plots are saved, empty if savePanels is False
+    """
+
+    panelPaths = []
+    if savePanels:
+        panelPaths = [plotBoxPlot(outDir=outDir, **panel) for panel in panels]
+
+    ncols = min(ncols, len(panels))
+    nrows = -(-len(panels) // ncols)
+    fig, axes = plt.subplots(
+        nrows=nrows,
+        ncols=ncols,
+        figsize=(panelSize[0] * ncols, panelSize[1] * nrows),
+        squeeze=False,
+        layout="constrained",
+    )
+    fig.suptitle(title, fontsize=22)
+
+    for ax, panel in zip(axes.flatten(), panels):
+        plotBoxPlot(outDir=outDir, ax=ax, **panel)
+
+    # hide axes without panel
+    for ax in axes.flatten()[len(panels) :]:
+        ax.set_axis_off()
+
+    plotPath = pU.saveAndOrPlot({"pathResult": outDir}, name, fig)
+
+    return plotPath, panelPaths
+
+
 def multiplePlots3(plist, name, title, outdir):
     """puts multiple plots next to each other and underneath each other,
     saves them as new plot and delets single plots"""
@@ -396,7 +496,15 @@ def multiplePlots2(plist, name, title, outdir):
 
 
 def plotSlopeAngelAnalysis(
-    db, avaPathLine, avaPathsz, pointList, cfg, pathList=[], name1=""
+    db,
+    avaPathLine,
+    avaPathsz,
+    pointList,
+    cfg,
+    pathList=[],
+    name1="",
+    pathStores=None,
+    pointIndex=None,
 ):
     """
     create x-y plot of thalweg using s(distances) and z-coordinates
@@ -417,6 +525,12 @@ def plotSlopeAngelAnalysis(
         list with column names of fitted paths
     name1: str
         name to be added to plate name to indicate what options are used
+    pathStores: dict
+        optional - path stores by name; if avaPathLine, avaPathsz or the entries of pathList
+        are names of stores, the profiles are read from the stores instead of line columns
+    pointIndex: pandas dataframe
+        optional - index of the points of pointList on the thalwegs (pS.locatePoints),
+        located on avaPathLine if None
 
 
     """
@@ -424,136 +538,320 @@ def plotSlopeAngelAnalysis(
     avalancheDir = pathlib.Path(cfg["MAIN"]["avalancheDir"])
     fitOption = cfg["FILTERING"]["fit"]
 
+    lineStore = pS.getStore(pathStores, avaPathLine, db)
+    szStore = pS.getStore(pathStores, avaPathsz, db, fieldNames=("s", "z"))
+    fitStores = {
+        path: pS.getStore(pathStores, path, db, fieldNames=("s", "z"))
+        for path in pathList
+    }
+    if pointIndex is None:
+        pointIndex = pS.locatePoints(lineStore, db, pointList)
+
     # loop over all events in dbData
-    for index, row in db.iterrows():
+    for job in slopeAngleJobs(
+        db, lineStore, szStore, fitStores, pointIndex, pointList, fitOption
+    ):
+        fig, axes = plt.subplots(figsize=(8, 5))
+        drawSlopeAngleProfile(axes, job, pointList, pathList)
+        outFile = slopeAngleFileName(job["row"], name1)
+        _ = pU.saveAndOrPlot({"pathResult": avalancheDir}, outFile, fig)
+
+
+# columns of the event dataframe used by drawSlopeAngleProfile and slopeAngleFileName
+SLOPEANGLECOLUMNS = [
+    "path_name",
+    "path_id",
+    "maxpotsize",
+    "origID",
+    "depoID",
+    "orig-transit_Angle",
+    "orig-depo_Angle",
+    "orig-runout_Angle",
+]
+
+
+def slopeAngleJobs(db, lineStore, szStore, fitStores, pointIndex, pointList, fitOption):
+    """yield the data of one slope angle plot per event of db
+
+    only the profiles, point indices and columns of db needed by drawSlopeAngleProfile are
+    collected, so that the jobs can be sent to worker processes
+    """
+
+    columns = [column for column in SLOPEANGLECOLUMNS if column in db.columns]
+    for index, row in db[columns].iterrows():
         avaPath = {
-            "x": row[avaPathLine].xy[0],
-            "y": row[avaPathLine].xy[1],
-            "z": row[avaPathsz].xy[1],
-            "s": row[avaPathsz].xy[0],
+            "x": lineStore.get(index)["x"],
+            "y": lineStore.get(index)["y"],
+            "z": szStore.get(index)["z"],
+            "s": szStore.get(index)["s"],
+        }
+        yield {
+            "row": row,
+            "avaPath": avaPath,
+            "fitProfiles": {
+                path: store.get(index) for path, store in fitStores.items()
+            },
+            "pointIndex": {
+                point: int(pointIndex.at[index, "%s_idx" % point])
+                for point in pointList
+            },
+            "fitOption": fitOption,
         }
 
-        fig, axes = plt.subplots(figsize=(8, 5))
-        if pathList != []:
-            for path in pathList:
-                if path == "curveFit_s_z":
-                    label = "parabolic fit until: " + str(fitOption)
-                    # label = r'fit: $a \cdot \exp(-b \cdot s^2) + c$'
-                    # label = r'fit: $a \cdot \exp(-b \cdot s) + c$'
-                    plt.plot(
-                        row[path].xy[0],
-                        row[path].xy[1],
-                        label=label,
-                        color="blue",
-                        alpha=1,
-                        lw=1,
-                    )
-                else:
-                    plt.plot(row[path].xy[0], row[path].xy[1], "--", color="blue", lw=1)
 
-        if "maxpotsize" in row:
-            label = "thalweg maxpotsize: " + str(row["maxpotsize"])
+def slopeAngleFileName(row, name1):
+    """return the name of the slope angle plot of the event in row"""
+
+    outFile = "%s_%s_analysis_%s" % (row["path_name"], row["path_id"], name1)
+    outFile = outFile.replace(" ", "")
+    outFile = outFile.replace("/", "_")
+    return outFile
+
+
+def drawSlopeAngleProfile(axes, job, pointList, pathList=[]):
+    """draw the thalweg profile, fitted profiles of pathList and points of pointList of one
+    event into axes
+
+    Parameters
+    -----------
+    axes: matplotlib axes
+        axes to draw into
+    job: dict
+        data of the event, as yielded by slopeAngleJobs
+    pointList: list of strings
+        list with column names of points which should be plotted on thalweg
+    pathList: list with strings
+        list with names of fitted paths
+    """
+
+    row = job["row"]
+    avaPath = job["avaPath"]
+    for path in pathList:
+        fitProfile = job["fitProfiles"][path]
+        if path in ["curveFit_s_z", "curveFit"]:
+            label = "parabolic fit until: " + str(job["fitOption"])
+            # label = r'fit: $a \cdot \exp(-b \cdot s^2) + c$'
+            # label = r'fit: $a \cdot \exp(-b \cdot s) + c$'
+            axes.plot(
+                fitProfile["s"],
+                fitProfile["z"],
+                label=label,
+                color="blue",
+                alpha=1,
+                lw=1,
+            )
         else:
-            label = "full thalweg"
-        plt.plot(avaPath["s"], avaPath["z"], "--", color="grey", label=label)
-        plt.plot(
-            avaPath["s"][int(row["origID"]) : int(row["depoID"])],
-            avaPath["z"][int(row["origID"]) : int(row["depoID"])],
-            label="thalweg section of interest",
-            color="k",
-            lw=1.5,
-        )
+            axes.plot(fitProfile["s"], fitProfile["z"], "--", color="blue", lw=1)
 
-        for point in pointList:
+    if "maxpotsize" in row:
+        label = "thalweg maxpotsize: " + str(row["maxpotsize"])
+    else:
+        label = "full thalweg"
+    axes.plot(avaPath["s"], avaPath["z"], "--", color="grey", label=label)
+    axes.plot(
+        avaPath["s"][int(row["origID"]) : int(row["depoID"])],
+        avaPath["z"][int(row["origID"]) : int(row["depoID"])],
+        label="thalweg section of interest",
+        color="k",
+        lw=1.5,
+    )
+
+    for point in pointList:
+
+        # index of point on avaPath, -1 if point is missing
+        pointAvapath = job["pointIndex"][point]
+        if pointAvapath >= 0:
+
+            if "rel" in point:
+                legend = "release point"
+                # legend = 'depo γ(depo): ' +str(round(row['orig-depo_Angle'],2))
+                axes.plot(
+                    avaPath["s"][pointAvapath],
+                    avaPath["z"][pointAvapath],
+                    "*",
+                    markersize=10,
+                    color="lightgrey",
+                    label=legend,
+                )
 
-            if pd.notna(row[point]):
-                pointDict = {"x": [row[point].x], "y": [row[point].y]}
-                pointAvapath = gT.findClosestPoint(
-                    avaPath["x"], avaPath["y"], pointDict
+            if "orig" in point:
+                legend = "O-point"
+                axes.plot(
+                    avaPath["s"][pointAvapath],
+                    avaPath["z"][pointAvapath],
+                    "c*",
+                    markersize=10,
+                    label=legend,
                 )
 
-                if "rel" in point:
-                    legend = "release point"
-                    # legend = 'depo γ(depo): ' +str(round(row['orig-depo_Angle'],2))
-                    plt.plot(
-                        avaPath["s"][pointAvapath],
-                        avaPath["z"][pointAvapath],
-                        "*",
-                        markersize=10,
-                        color="lightgrey",
-                        label=legend,
-                    )
+            if "transit" in point:
+                legend = "T-point $\gamma_T:$" + str(
+                    round(row["orig-transit_Angle"], 2)
+                )
+                # legend = 'transit point'
+                axes.plot(
+                    avaPath["s"][pointAvapath],
+                    avaPath["z"][pointAvapath],
+                    "g*",
+                    markersize=10,
+                    label=legend,
+                )
 
-                if "orig" in point:
-                    legend = "O-point"
-                    label = round(
-                        row["geom_origin_pt3d_epsg:31287_snapped_gradient"], 2
-                    )
-                    plt.plot(
-                        avaPath["s"][pointAvapath],
-                        avaPath["z"][pointAvapath],
-                        "c*",
-                        markersize=10,
-                        label=legend,
-                    )
-                    # plt.text(avaPath['s'][pointAvapath], avaPath['z'][pointAvapath], label, fontsize=7, va='top', ha='right')
+            if "runout" in point:
+                # legend = 'deposition point'
+                legend = r"D-point $\gamma_D =\beta:$" + str(
+                    round(row["orig-depo_Angle"], 2)
+                )
+                axes.plot(
+                    avaPath["s"][pointAvapath],
+                    avaPath["z"][pointAvapath],
+                    "*",
+                    markersize=10,
+                    color="#ad1d22",
+                    label=legend,
+                )
 
-                if "transit" in point:
-                    legend = "T-point $\gamma_T:$" + str(
-                        round(row["orig-transit_Angle"], 2)
-                    )
-                    # legend = 'transit point'
-                    label = round(
-                        row["geom_transit_pt3d_epsg:31287_snapped_gradient"], 2
-                    )
-                    plt.plot(
-                        avaPath["s"][pointAvapath],
-                        avaPath["z"][pointAvapath],
-                        "g*",
-                        markersize=10,
-                        label=legend,
-                    )
-                    # plt.text(avaPath['s'][pointAvapath], avaPath['z'][pointAvapath], label, fontsize=7, va='top', ha='right')
+            if "geom_event_pt3d" in point:
+                legend = r"R-point $\gamma_R =\alpha:$" + str(
+                    round(row["orig-runout_Angle"], 2)
+                )
+                # legend = 'depo γ(depo): ' +str(round(row['orig-depo_Angle'],2))
+                axes.plot(
+                    avaPath["s"][pointAvapath],
+                    avaPath["z"][pointAvapath],
+                    "*",
+                    markersize=10,
+                    color="grey",
+                    label=legend,
+                )
 
-                if "runout" in point:
-                    label = round(
-                        row["geom_runout_pt3d_epsg:31287_snapped_gradient"], 2
-                    )
-                    # legend = 'deposition point'
-                    legend = r"D-point $\gamma_D =\beta:$" + str(
-                        round(row["orig-depo_Angle"], 2)
-                    )
-                    plt.plot(
-                        avaPath["s"][pointAvapath],
-                        avaPath["z"][pointAvapath],
-                        "*",
-                        markersize=10,
-                        color="#ad1d22",
-                        label=legend,
-                    )
+    axes.set_xlabel(r"$s_{xy}$ [m]", fontsize=18)
+    axes.set_ylabel(r"$z_s$ [m]", fontsize=18)
+    axes.legend(facecolor="white", fontsize="large")
+    axes.grid(color="lightgrey", linestyle="--")
+    axes.set_facecolor("xkcd:white")
+    axes.tick_params(axis="both", labelsize=16)
 
-                if "geom_event_pt3d" in point:
-                    legend = r"R-point $\gamma_R =\alpha:$" + str(
-                        round(row["orig-runout_Angle"], 2)
-                    )
-                    # legend = 'depo γ(depo): ' +str(round(row['orig-depo_Angle'],2))
-                    plt.plot(
-                        avaPath["s"][pointAvapath],
-                        avaPath["z"][pointAvapath],
-                        "*",
-                        markersize=10,
-                        color="grey",
-                        label=legend,
-                    )
 
-        plt.xlabel(r"$s_{xy}$ [m]", fontsize=18)
-        plt.ylabel(r"$z_s$ [m]", fontsize=18)
-        plt.legend(facecolor="white", fontsize="large")
-        plt.grid(color="lightgrey", linestyle="--")
-        axes.set_facecolor("xkcd:white")
-        axes.tick_params(axis="both", labelsize=16)
+def renderSlopeAngleVariants(job, variants, outDir):
+    """render and save the slope angle plots of all variants for one event
 
-        outFile = "%s_%s_analysis_%s" % (row["path_name"], row["path_id"], name1)
-        outFile = outFile.replace(" ", "")
-        outFile = outFile.replace("/", "_")
-        _ = pU.saveAndOrPlot({"pathResult": avalancheDir}, outFile, fig)
+    all plots of a process are drawn into one figure that is not managed by pyplot and saved
+    with the Agg renderer; the figure is cleared before each plot
+
+    Returns
+    --------
+    outPaths: list
+        paths of the saved plots
+    """
+
+    global _slopeAngleFigure
+    if _slopeAngleFigure is None:
+        _slopeAngleFigure = Figure(figsize=(8, 5))
+    fig = _slopeAngleFigure
+
+    outPaths = []
+    for variant in variants:
+        # clearing the axes alone keeps layout state of the previous plot, clear the figure
+        fig.clear()
+        axes = fig.add_subplot(111)
+        drawSlopeAngleProfile(
+            axes, job, variant["pointList"], variant.get("pathList", [])
+        )
+        outFile = slopeAngleFileName(job["row"], variant["name1"]).replace(".", "_")
+        outPath = pathlib.Path(outDir, "%s.%s" % (outFile, pU.outputFormat))
+        fig.savefig(outPath)
+        outPaths.append(outPath)
+
+    return outPaths
+
+
+def plotSlopeAngleVariants(
+    db,
+    avaPathLine,
+    avaPathsz,
+    variants,
+    cfg,
+    pathStores=None,
+    pointIndex=None,
+    nWorkers=1,
+):
+    """create the x-y plots of plotSlopeAngelAnalysis for several variants in one pass over
+    the events, rendered without display in nWorkers processes
+
+    each process draws all its plots into one reused figure (renderSlopeAngleVariants), plots
+    are saved to avalancheDir independent of the showPlot and savePlot flags
+
+    Parameters
+    -----------
+    db: pandas dataframe
+        dataframe with data of geometries which should be plotted
+    avaPathLine: string
+        name of thalweg store or column in db, with x,y,z coordinates
+    avaPathsz: string
+        name of thalweg store or column in db, with s and z coordinates
+    variants: list of dicts
+        one dict per variant with pointList (names of point columns to plot), pathList
+        (optional, names of fitted paths to plot) and name1 (added to plot name)
+    cfg: configuration File
+        information about: fit option and working Dir
+    pathStores: dict
+        optional - path stores by name, see plotSlopeAngelAnalysis
+    pointIndex: pandas dataframe
+        optional - index of the points of all variants on the thalwegs (pS.locatePoints),
+        located on avaPathLine if None
+    nWorkers: int
+        number of worker processes, 1: render in this process
+
+    Returns
+    --------
+    outPaths: list
+        paths of the saved plots
+    """
+
+    avalancheDir = pathlib.Path(cfg["MAIN"]["avalancheDir"])
+    avalancheDir.mkdir(parents=True, exist_ok=True)
+    fitOption = cfg["FILTERING"]["fit"]
+
+    pointList = list(
+        dict.fromkeys(point for variant in variants for point in variant["pointList"])
+    )
+    pathList = list(
+        dict.fromkeys(
+            path for variant in variants for path in variant.get("pathList", [])
+        )
+    )
+    lineStore = pS.getStore(pathStores, avaPathLine, db)
+    szStore = pS.getStore(pathStores, avaPathsz, db, fieldNames=("s", "z"))
+    fitStores = {
+        path: pS.getStore(pathStores, path, db, fieldNames=("s", "z"))
+        for path in pathList
+    }
+    if pointIndex is None:
+        pointIndex = pS.locatePoints(lineStore, db, pointList)
+
+    jobs = slopeAngleJobs(
+        db, lineStore, szStore, fitStores, pointIndex, pointList, fitOption
+    )
+    nWorkers = max(int(nWorkers), 1)
+    log.info(
+        "Rendering %d slope angle plots using %d processes"
+        % (len(db) * len(variants), nWorkers)
+    )
+    if nWorkers == 1:
+        results = [
+            renderSlopeAngleVariants(job, variants, avalancheDir) for job in jobs
+        ]
+    else:
+        with ProcessPoolExecutor(max_workers=nWorkers) as executor:
+            results = list(
+                executor.map(
+                    renderSlopeAngleVariants,
+                    jobs,
+                    [variants] * len(db),
+                    [avalancheDir] * len(db),
+                    chunksize=max(len(db) // (4 * nWorkers), 1),
+                )
+            )
+
+    return [outPath for outPaths in results for outPath in outPaths]